@@ -10,8 +10,9 @@ from utils.memory_integration import process_memory, get_memory_enhanced_prompt,
 import utils.proactive_messaging as proactive_messaging
 from utils.message_splitter import process_structured_messages, get_structured_message_prompt
 from utils.memory_commands import list_new_memories, add_new_memory, delete_new_memory
+from utils.memory_system import consolidate_memories_job, MEMORY_CONSOLIDATION_INTERVAL
 
-from md2tgmd.src.md2tgmd import escape, split_code, replace_all
+from md2tgmd.src.md2tgmd import escape
 from aient.src.aient.utils.prompt import translator_prompt
 from aient.src.aient.utils.scripts import Document_extract, claude_replace
 from aient.src.aient.core.utils import get_engine, get_image_message, get_text_message
@@ -21,15 +22,12 @@ from config import (
     PORT,
     BOT_TOKEN,
     GET_MODELS,
-    GOOGLE_AI_API_KEY,
-    VERTEX_PROJECT_ID,
-    VERTEX_PRIVATE_KEY,
-    VERTEX_CLIENT_EMAIL,
     Users,
     PREFERENCES,
     LANGUAGES,
     PLUGINS,
     RESET_TIME,
+    LONG_TEXT_SPLIT_LEN,
     get_robot,
     reset_ENGINE,
     get_current_lang,
@@ -47,7 +45,12 @@ from config import (
 )
 
 from utils.i18n import strings
-from utils.scripts import GetMesageInfo, safe_get, is_emoji
+from utils.scripts import GetMesageInfo, safe_get, is_emoji, is_own_message, set_bot_identity, refresh_bot_identity_job, BOT_IDENTITY_REFRESH
+from utils.edit_scheduler import StreamEditScheduler
+from utils.markdown_stream import IncrementalMarkdownRenderer
+from utils.stream_splitter import StreamSplitter
+from utils.message_coalescer import message_coalescer, log_coalescer_stats_job, LONG_TEXT_STATS_INTERVAL
+from utils.storage import add_turn, restore_conversation, clear_conversation
 
 from telegram.constants import ChatAction
 from telegram import BotCommand, InlineKeyboardMarkup, InlineQueryResultArticle, InputTextMessageContent, Update, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, InputMediaPhoto, InlineKeyboardButton
@@ -59,8 +62,6 @@ import pytz
 CHINA_TZ = pytz.timezone('Asia/Shanghai')
 
 import asyncio
-lock = asyncio.Lock()
-event = asyncio.Event()
 stop_event = asyncio.Event()
 time_out = 600
 
@@ -87,28 +88,26 @@ update_logger.addFilter(my_filter)
 update_logger = logging.getLogger("root")
 update_logger.addFilter(my_filter)
 
-# 定义一个缓存来存储消息
-from collections import defaultdict
-message_cache = defaultdict(lambda: [])
-time_stamps = defaultdict(lambda: [])
-
 @decorators.PrintMessage
 @decorators.GroupAuthorization
 @decorators.Authorization
 @decorators.APICheck
 async def command_bot(update, context, language=None, prompt=translator_prompt, title="", has_command=True):
     stop_event.clear()
-    message, rawtext, image_url, chatid, messageid, reply_to_message_text, update_message, message_thread_id, convo_id, file_url, reply_to_message_file_content, voice_text = await GetMesageInfo(update, context)
+    info = await GetMesageInfo(update, context)
+    message, rawtext, chatid, messageid = info.message, info.rawtext, info.chatid, info.messageid
+    update_message, message_thread_id, convo_id = info.update_message, info.message_thread_id, info.convo_id
+    reply_to_message_text = info.reply_to_message_text
 
     # 异步处理记忆，但不阻塞主对话流程
     if not has_command and config.ChatGPTbot is not None and message is not None:
         # 跟踪对话，它会在达到一定轮数后自动总结
         asyncio.create_task(track_conversation(str(convo_id), "user", message, config.ChatGPTbot))
         
-        # 分析用户消息并调整主动对话欲望
+        # 记录用户最后说话的时间，主动消息调度据此推迟下一次检查
         if proactive_messaging.PROACTIVE_AGENT_ENABLED:
             # asyncio.create_task(proactive_messaging.analyze_message_for_desire(chatid, message))  # 已废弃，无需再调用
-            pass
+            proactive_messaging.update_last_chat_time(chatid)
         
         # asyncio.create_task(proactive_messaging.analyze_message_for_desire(chatid, message))  # 已废弃，无需再调用
     if has_command == False or len(context.args) > 0:
@@ -124,7 +123,7 @@ async def command_bot(update, context, language=None, prompt=translator_prompt,
                 pass_history = 0
             message = prompt + message
         if message == None:
-            message = voice_text
+            message = await info.get_voice_text()
         # print("message", message)
         if message and len(message) == 1 and is_emoji(message):
             return
@@ -149,59 +148,30 @@ async def command_bot(update, context, language=None, prompt=translator_prompt,
                     name=convo_id
                 )
 
-            bot_info_username = None
-            try:
-                bot_info = await context.bot.get_me(read_timeout=time_out, write_timeout=time_out, connect_timeout=time_out, pool_timeout=time_out)
-                bot_info_username = bot_info.username
-            except Exception as e:
-                bot_info_username = update_message.reply_to_message.from_user.username
-                print("error:", e)
-
+            reply_to_self = is_own_message(update_message.reply_to_message)
             if update_message.reply_to_message \
             and update_message.from_user.is_bot == False \
-            and (update_message.reply_to_message.from_user.username == bot_info_username or message_has_nick):
+            and (reply_to_self or message_has_nick):
                 if update_message.reply_to_message.from_user.is_bot and Users.get_config(convo_id, "TITLE") == True:
                     message = message + "\n" + '\n'.join(reply_to_message_text.split('\n')[1:])
                 else:
                     if reply_to_message_text:
                         message = message + "\n" + reply_to_message_text
+                    reply_to_message_file_content = await info.get_reply_file_content()
                     if reply_to_message_file_content:
                         message = message + "\n" + reply_to_message_file_content
             elif update_message.reply_to_message and update_message.reply_to_message.from_user.is_bot \
-            and update_message.reply_to_message.from_user.username != bot_info_username:
+            and not reply_to_self:
                 return
 
             robot, role, api_key, api_url = get_robot(convo_id)
             engine = Users.get_config(convo_id, "engine")
 
             if Users.get_config(convo_id, "LONG_TEXT"):
-                async with lock:
-                    message_cache[convo_id].append(message)
-                    import time
-                    time_stamps[convo_id].append(time.time())
-                    if len(message_cache[convo_id]) == 1:
-                        print("first message len:", len(message_cache[convo_id][0]))
-                        if len(message_cache[convo_id][0]) > 800:
-                            event.clear()
-                        else:
-                            event.set()
-                    else:
-                        return
-                try:
-                    await asyncio.wait_for(event.wait(), timeout=2)
-                except asyncio.TimeoutError:
-                    print("asyncio.wait timeout!")
-
-                intervals = [
-                    time_stamps[convo_id][i] - time_stamps[convo_id][i - 1]
-                    for i in range(1, len(time_stamps[convo_id]))
-                ]
-                if intervals:
-                    print(f"Chat ID {convo_id} 时间间隔: {intervals}，总时间：{sum(intervals)}")
-
-                message = "\n".join(message_cache[convo_id])
-                message_cache[convo_id] = []
-                time_stamps[convo_id] = []
+                # 每个对话单独合并被拆开的长消息，后续分片并入第一条消息的批次后直接返回
+                message = await message_coalescer.submit(convo_id, message)
+                if message is None:
+                    return
             # if Users.get_config(convo_id, "TYPING"):
             #     await context.bot.send_chat_action(chat_id=chatid, message_thread_id=message_thread_id, action=ChatAction.TYPING)
             if Users.get_config(convo_id, "TITLE"):
@@ -212,6 +182,8 @@ async def command_bot(update, context, language=None, prompt=translator_prompt,
             engine_type, _ = get_engine({"base_url": api_url}, endpoint=None, original_model=engine)
             if robot.__class__.__name__ == "chatgpt":
                 engine_type = "gpt"
+            image_url = await info.get_image_url()
+            file_url = await info.get_file_url()
             if image_url:
                 message_list = []
                 image_message = await get_image_message(image_url, engine_type)
@@ -263,7 +235,6 @@ async def getChatGPT(update_message, context, title, robot, message, chatid, mes
     text = message
     result = ""
     tmpresult = ""
-    modifytime = 0
     time_out = 600
     image_has_send = 0
     model_name = engine
@@ -284,19 +255,11 @@ async def getChatGPT(update_message, context, title, robot, message, chatid, mes
     system_prompt = f"{system_prompt}\n\n{structured_message_prompt}"
         
     # 使用增强了记忆的系统提示词
-    memory_enhanced_prompt = get_memory_enhanced_prompt(str(convo_id), system_prompt)
+    memory_enhanced_prompt = await get_memory_enhanced_prompt(str(convo_id), system_prompt, text)
     system_prompt = memory_enhanced_prompt
 
     plugins = Users.extract_plugins_config(convo_id)
 
-    Frequency_Modification = 20
-    if "gpt-4o" in model_name:
-        Frequency_Modification = 25
-    if message_thread_id or convo_id.startswith("-"):
-        Frequency_Modification = 35
-    if "gemini" in model_name and (GOOGLE_AI_API_KEY or (VERTEX_CLIENT_EMAIL and VERTEX_PRIVATE_KEY and VERTEX_PROJECT_ID)):
-        Frequency_Modification = 1
-
     # 添加当前时间戳到用户消息
     current_datetime = datetime.now(CHINA_TZ)
     message_timestamp = current_datetime.timestamp()
@@ -306,8 +269,10 @@ async def getChatGPT(update_message, context, title, robot, message, chatid, mes
     if not pass_history:
         # 在消息内容前添加时间信息
         text_with_time = f"[{formatted_time}] {text}"
-        
-        robot.add_to_conversation({
+
+        # 重启后第一次用到这个对话时，先恢复之前保存的历史
+        await restore_conversation(robot, convo_id)
+        await add_turn(robot, {
             "role": "user", 
             "content": text_with_time,
             "timestamp": str(message_timestamp),
@@ -325,6 +290,29 @@ async def getChatGPT(update_message, context, title, robot, message, chatid, mes
     else:
         return
 
+    async def edit_answer(message_id, text):
+        await context.bot.edit_message_text(chat_id=chatid, message_id=message_id, text=text, parse_mode='MarkdownV2', disable_web_page_preview=True, read_timeout=time_out, write_timeout=time_out, pool_timeout=time_out, connect_timeout=time_out)
+
+    # 增量转义：已经完整的段落只转义一次
+    markdown_renderer = IncrementalMarkdownRenderer(
+        lambda text: escape(text, italic=False),
+        transform=claude_replace if "claude" in model_name else None,
+    )
+    # 按时间预算合并流式编辑，而不是按收到的数据块数量
+    editor = StreamEditScheduler(
+        chatid,
+        answer_messageid,
+        edit_answer,
+        render=markdown_renderer.render,
+        group=bool(message_thread_id or convo_id.startswith("-")),
+    )
+
+    # 长回复按页拆分：在流式输出过程中增量维护代码块和段落状态，每满一页就发出
+    splitter = None
+    if Users.get_config(convo_id, "LONG_TEXT_SPLIT"):
+        splitter = StreamSplitter(LONG_TEXT_SPLIT_LEN)
+        splitter.feed(title)
+
     try:
         # 用于检测是否可能是JSON格式的消息
         might_be_json = False
@@ -337,6 +325,7 @@ async def getChatGPT(update_message, context, title, robot, message, chatid, mes
         async for data in robot.ask_stream_async(text, convo_id=convo_id, model=model_name, language=language, system_prompt=system_prompt, pass_history=pass_history, api_key=api_key, api_url=api_url, user_id=user_id, plugins=plugins):
         # for data in robot.ask_stream(text, convo_id=convo_id, pass_history=pass_history, model=model_name):
             if stop_event.is_set() and convo_id == target_convo_id and answer_messageid < reset_mess_id:
+                await editor.close()
                 return
             if "message_search_stage_" not in data:
                 result = result + data
@@ -361,119 +350,41 @@ async def getChatGPT(update_message, context, title, robot, message, chatid, mes
                 # 只在接收完所有数据后更新一次
                 continue
                 
-            tmpresult = result
-            if re.sub(r"```", '', result.split("\n")[-1]).count("`") % 2 != 0:
-                tmpresult = result + "`"
-            if sum([line.strip().startswith("```") for line in result.split('\n')]) % 2 != 0:
-                tmpresult = tmpresult + "\n```"
-            tmpresult = title + tmpresult
-            if "claude" in model_name:
-                tmpresult = claude_replace(tmpresult)
-            if "message_search_stage_" in data:
-                tmpresult = strings[data][get_current_lang(convo_id)]
+            tmpresult = title + result
             history = robot.conversation[convo_id]
             if safe_get(history, -2, "tool_calls", 0, 'function', 'name') == "generate_image" and not image_has_send and safe_get(history, -1, 'content'):
                 image_result = history[-1]['content'].split('\n\n')[1]
                 await context.bot.send_photo(chat_id=chatid, photo=image_result, reply_to_message_id=messageid)
                 image_has_send = 1
-            modifytime = modifytime + 1
-
-            split_len = 3500
-            if len(tmpresult) > split_len and Users.get_config(convo_id, "LONG_TEXT_SPLIT"):
-                Frequency_Modification = 40
-
-                # print("tmpresult", tmpresult)
-                replace_text = replace_all(tmpresult, r"(```[\D\d\s]+?```)", split_code)
-                if "@|@|@|@" in replace_text:
-                    print("@|@|@|@", replace_text)
-                    split_messages = replace_text.split("@|@|@|@")
-                    send_split_message = split_messages[0]
-                    result = split_messages[1][:-4]
-                else:
-                    print("replace_text", replace_text)
-                    if replace_text.strip().endswith("```"):
-                        replace_text = replace_text.strip()[:-4]
-                    split_messages_new = []
-                    split_messages = replace_text.split("```")
-                    for index, item in enumerate(split_messages):
-                        if index % 2 == 1:
-                            item = "```" + item
-                            if index != len(split_messages) - 1:
-                                item = item + "```"
-                            split_messages_new.append(item)
-                        if index % 2 == 0:
-                            item_split_new = []
-                            item_split = item.split("\n\n")
-                            for sub_index, sub_item in enumerate(item_split):
-                                if sub_index % 2 == 1:
-                                    sub_item = "\n\n" + sub_item
-                                    if sub_index != len(item_split) - 1:
-                                        sub_item = sub_item + "\n\n"
-                                    item_split_new.append(sub_item)
-                                if sub_index % 2 == 0:
-                                    item_split_new.append(sub_item)
-                            split_messages_new.extend(item_split_new)
-
-                    split_index = 0
-                    for index, _ in enumerate(split_messages_new):
-                        if len("".join(split_messages_new[:index])) < split_len:
-                            split_index += 1
-                            continue
-                        else:
-                            break
-                    # print("split_messages_new", split_messages_new)
-                    send_split_message = ''.join(split_messages_new[:split_index])
-                    matches = re.findall(r"(```.*?\n)", send_split_message)
-                    if len(matches) % 2 != 0:
-                        send_split_message = send_split_message + "```\n"
-                    # print("send_split_message", send_split_message)
-                    tmp = ''.join(split_messages_new[split_index:])
-                    if tmp.strip().endswith("```"):
-                        result = tmp[:-4]
-                    else:
-                        result = tmp
-                    # print("result", result)
-                    matches = re.findall(r"(```.*?\n)", send_split_message)
-                    result_matches = re.findall(r"(```.*?\n)", result)
-                    # print("matches", matches)
-                    # print("result_matches", result_matches)
-                    if len(result_matches) > 0 and result_matches[0].startswith("```\n") and len(result_matches) >= 2:
-                        result = matches[-2] + result
-                    # print("result", result)
-
-                title = ""
-                if lastresult != escape(send_split_message, italic=False):
-                    try:
-                        await context.bot.edit_message_text(
-                            chat_id=chatid,
-                            message_id=answer_messageid,
-                            text=escape(send_split_message, italic=False),
-                            parse_mode='MarkdownV2',
-                            disable_web_page_preview=True,
-                            read_timeout=time_out,
-                            write_timeout=time_out,
-                            pool_timeout=time_out,
-                            connect_timeout=time_out
-                        )
-                        lastresult = escape(send_split_message, italic=False)
-                    except Exception as e:
-                        if "parse entities" in str(e):
-                            await context.bot.edit_message_text(chat_id=chatid, message_id=answer_messageid, text=send_split_message, disable_web_page_preview=True, read_timeout=time_out, write_timeout=time_out, pool_timeout=time_out, connect_timeout=time_out)
-
-            # 如果不是可能的JSON格式，则进行正常的流式更新
+
+            if splitter and "message_search_stage_" not in data:
+                for page in splitter.feed(data):
+                    # 已经完整的一页立即定稿（整页重新转义），后续内容发到新的消息里继续流式更新
+                    await editor.flush(markdown_renderer.render_full(page), rendered=True)
+                    answer_messageid = (await context.bot.send_message(
+                        chat_id=chatid,
+                        message_thread_id=message_thread_id,
+                        text=escape(strings['message_think'][get_current_lang(convo_id)]),
+                        parse_mode='MarkdownV2',
+                        reply_to_message_id=messageid,
+                    )).message_id
+                    await editor.reset(answer_messageid)
+                    markdown_renderer.reset()
+
+            # 如果不是可能的JSON格式，则进行正常的流式更新，由调度器决定何时真正编辑
             if not might_be_json:
-                now_result = escape(tmpresult, italic=False)
-                if now_result and (modifytime % Frequency_Modification == 0 and lastresult != now_result) or "message_search_stage_" in data:
-                    try:
-                        await context.bot.edit_message_text(chat_id=chatid, message_id=answer_messageid, text=now_result, parse_mode='MarkdownV2', disable_web_page_preview=True, read_timeout=time_out, write_timeout=time_out, pool_timeout=time_out, connect_timeout=time_out)
-                        lastresult = now_result
-                    except Exception as e:
-                        # print('\033[31m')
-                        print("1: Unexpected error4:", type(e), str(e))
-                        # print('\033[0m')
-            
-            modifytime += 1
-            
+                if "message_search_stage_" in data:
+                    editor.submit(escape(strings[data][get_current_lang(convo_id)], italic=False), rendered=True)
+                elif splitter:
+                    editor.submit(splitter.pending)
+                else:
+                    editor.submit(title + result)
+
+        # 最终结果由下面统一编辑，丢弃还没发出的中间结果
+        await editor.close()
+        if editor.last_sent:
+            lastresult = editor.last_sent
+
         # 当完成对话生成后，跟踪机器人的回复
         try:
             # 添加当前时间戳到机器人回复
@@ -486,7 +397,7 @@ async def getChatGPT(update_message, context, title, robot, message, chatid, mes
                 # 在回复内容前添加时间信息
                 result_with_time = f"[{formatted_time}] {result}"
                 
-                robot.add_to_conversation({
+                await add_turn(robot, {
                     "role": "assistant", 
                     "content": result_with_time,
                     "timestamp": str(response_timestamp),
@@ -498,9 +409,14 @@ async def getChatGPT(update_message, context, title, robot, message, chatid, mes
             # 即使记忆跟踪失败，也不影响主对话
             logging.error(f"跟踪机器人回复时出错: {str(e)}")
         
-        tmpresult = result.replace("```", "")
+        if splitter and splitter.pages:
+            # 前面的页已经定稿，最终只需要编辑最后一页
+            tmpresult = splitter.finish().replace("```", "")
+        else:
+            tmpresult = result.replace("```", "")
 
     except Exception as e:
+        await editor.close()
         print('\033[31m')
         traceback.print_exc()
         print(tmpresult)
@@ -509,6 +425,8 @@ async def getChatGPT(update_message, context, title, robot, message, chatid, mes
         systemprompt = Users.get_config(convo_id, "systemprompt")
         if api_key:
             robot.reset(convo_id=convo_id, system_prompt=systemprompt)
+            # 和 reset_ENGINE 一样清除保存的历史，重启后不会再恢复
+            await clear_conversation(convo_id)
         if "parse entities" in str(e):
             await context.bot.edit_message_text(chat_id=chatid, message_id=answer_messageid, text=tmpresult, disable_web_page_preview=True, read_timeout=time_out, write_timeout=time_out, pool_timeout=time_out, connect_timeout=time_out)
         else:
@@ -630,7 +548,7 @@ async def getChatGPT(update_message, context, title, robot, message, chatid, mes
 @decorators.Authorization
 async def button_press(update, context):
     """Function to handle the button press"""
-    _, _, _, _, _, _, _, _, convo_id, _, _, _ = await GetMesageInfo(update, context)
+    convo_id = (await GetMesageInfo(update, context)).convo_id
     callback_query = update.callback_query
     info_message = update_info_message(convo_id)
 
@@ -765,10 +683,13 @@ async def button_press(update, context):
 @decorators.Authorization
 @decorators.APICheck
 async def handle_file(update, context):
-    _, _, image_url, chatid, _, _, _, message_thread_id, convo_id, file_url, _, voice_text = await GetMesageInfo(update, context)
+    info = await GetMesageInfo(update, context)
+    chatid, message_thread_id, convo_id = info.chatid, info.message_thread_id, info.convo_id
     robot, role, api_key, api_url = get_robot(convo_id)
     engine = Users.get_config(convo_id, "engine")
 
+    image_url = await info.get_image_url()
+    file_url = await info.get_file_url()
     if file_url == None and image_url:
         file_url = image_url
         if Users.get_config(convo_id, "IMAGEQA") == False:
@@ -780,7 +701,8 @@ async def handle_file(update, context):
         engine_type = "gpt"
     message = await Document_extract(file_url, image_url, engine_type)
 
-    robot.add_to_conversation(message, role, convo_id)
+    # 文件内容也要持久化，重启恢复对话后仍然在历史里
+    await add_turn(robot, {"role": role, "content": message}, convo_id)
 
     if Users.get_config(convo_id, "FILE_UPLOAD_MESS"):
         message = await context.bot.send_message(chat_id=chatid, message_thread_id=message_thread_id, text=escape(strings['message_doc'][get_current_lang(convo_id)]), parse_mode='MarkdownV2', disable_web_page_preview=True)
@@ -797,7 +719,8 @@ async def inlinequery(update: Update, context) -> None:
     query = update.inline_query.query
     if (query.endswith('.') or query.endswith('。')) and query.strip():
         prompt = "Answer the following questions as concisely as possible:\n\n"
-        _, _, _, chatid, _, _, _, _, convo_id, _, _, _ = await GetMesageInfo(update, context)
+        info = await GetMesageInfo(update, context)
+        chatid, convo_id = info.chatid, info.convo_id
         robot, role, api_key, api_url = get_robot(convo_id)
         result = config.ChatGPTbot.ask(prompt + query, convo_id=convo_id, model=engine, api_url=api_url, api_key=api_key, pass_history=0)
 
@@ -816,7 +739,8 @@ async def inlinequery(update: Update, context) -> None:
 @decorators.Authorization
 async def change_model(update, context):
     """Quick model change using the command"""
-    _, _, _, chatid, user_message_id, _, _, message_thread_id, convo_id, _, _, _ = await GetMesageInfo(update, context)
+    info = await GetMesageInfo(update, context)
+    chatid, user_message_id, message_thread_id, convo_id = info.chatid, info.messageid, info.message_thread_id, info.convo_id
     lang = get_current_lang(convo_id)
 
     if not context.args:
@@ -883,7 +807,7 @@ async def scheduled_function(context: ContextTypes.DEFAULT_TYPE) -> None:
     if config.ADMIN_LIST and chat_id in config.ADMIN_LIST:
         return
 
-    reset_ENGINE(chat_id)
+    await reset_ENGINE(chat_id)
 
     # 任务执行完毕后自动移除
     remove_job_if_exists(str(chat_id), context)
@@ -905,14 +829,15 @@ reset_mess_id = 9999
 @decorators.Authorization
 async def reset_chat(update, context):
     global target_convo_id, reset_mess_id
-    _, _, _, chatid, user_message_id, _, _, message_thread_id, convo_id, _, _, _ = await GetMesageInfo(update, context)
+    info = await GetMesageInfo(update, context)
+    chatid, user_message_id, message_thread_id, convo_id = info.chatid, info.messageid, info.message_thread_id, info.convo_id
     reset_mess_id = user_message_id
     target_convo_id = convo_id
     stop_event.set()
     message = None
     if (len(context.args) > 0):
         message = ' '.join(context.args)
-    reset_ENGINE(target_convo_id, message)
+    await reset_ENGINE(target_convo_id, message)
 
     remove_keyboard = ReplyKeyboardRemove()
     message = await context.bot.send_message(
@@ -940,7 +865,8 @@ async def reset_chat(update, context):
 @decorators.GroupAuthorization
 @decorators.Authorization
 async def info(update, context):
-    _, _, _, chatid, user_message_id, _, _, message_thread_id, convo_id, _, _, voice_text = await GetMesageInfo(update, context)
+    info = await GetMesageInfo(update, context)
+    chatid, user_message_id, message_thread_id, convo_id = info.chatid, info.messageid, info.message_thread_id, info.convo_id
     info_message = update_info_message(convo_id)
     message = await context.bot.send_message(
         chat_id=chatid,
@@ -957,7 +883,7 @@ async def info(update, context):
 @decorators.GroupAuthorization
 @decorators.Authorization
 async def start(update, context): # 当用户输入/start时，返回文本
-    _, _, _, _, _, _, _, _, convo_id, _, _, _ = await GetMesageInfo(update, context)
+    convo_id = (await GetMesageInfo(update, context)).convo_id
     user = update.effective_user
     if user.language_code == "zh-hans":
         update_language_status("Simplified Chinese", chat_id=convo_id)
@@ -1019,6 +945,38 @@ async def unknown(update, context): # 当用户输入未知命令时，返回文
     # await context.bot.send_message(chat_id=update.effective_chat.id, text="Sorry, I didn't understand that command.")
 
 async def post_init(application: Application) -> None:
+    # initialize 时已经调用过 get_me，直接缓存结果，之后在后台定期刷新
+    set_bot_identity(application.bot.bot)
+    application.job_queue.run_repeating(
+        refresh_bot_identity_job,
+        interval=BOT_IDENTITY_REFRESH,
+        first=BOT_IDENTITY_REFRESH,
+        name="refresh_bot_identity",
+    )
+    # 用户配置先改内存，由后台任务批量写回磁盘
+    application.job_queue.run_repeating(
+        config.flush_user_configs,
+        interval=config.CONFIG_FLUSH_INTERVAL,
+        first=config.CONFIG_FLUSH_INTERVAL,
+        name="flush_user_configs",
+    )
+    # 定期整理记忆：衰减重要性、合并相似记忆、按上限淘汰并归档
+    if MEMORY_CONSOLIDATION_INTERVAL > 0:
+        application.job_queue.run_repeating(
+            consolidate_memories_job,
+            interval=MEMORY_CONSOLIDATION_INTERVAL,
+            first=MEMORY_CONSOLIDATION_INTERVAL,
+            name="consolidate_memories",
+        )
+    # 定期记录长消息合并的统计
+    if LONG_TEXT_STATS_INTERVAL > 0:
+        application.job_queue.run_repeating(
+            log_coalescer_stats_job,
+            interval=LONG_TEXT_STATS_INTERVAL,
+            first=LONG_TEXT_STATS_INTERVAL,
+            name="log_coalescer_stats",
+        )
+
     await application.bot.set_my_commands([
         BotCommand('info', '基本信息'),
         BotCommand('reset', '重置机器人'),
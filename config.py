@@ -20,6 +20,8 @@ NICK = os.environ.get('NICK', None)
 PORT = int(os.environ.get('PORT', '8080'))
 BOT_TOKEN = os.environ.get('BOT_TOKEN', None)
 RESET_TIME = int(os.environ.get('RESET_TIME', '3600'))
+# 开启 LONG_TEXT_SPLIT 时每条消息最多的字符数，Telegram 单条消息上限为 4096
+LONG_TEXT_SPLIT_LEN = int(os.environ.get('LONG_TEXT_SPLIT_LEN', '3500'))
 if RESET_TIME < 60:
     RESET_TIME = 60
 
@@ -87,9 +89,18 @@ systemprompt = SYSTEM_PROMPT
 claude_systemprompt = os.environ.get('SYSTEMPROMPT', prompt.claude_system_prompt.format(LANGUAGE))
 
 import json
+import atexit
+import asyncio
+import logging
+import threading
+from collections import OrderedDict, Counter
 from contextlib import contextmanager
 
-CONFIG_DIR = os.environ.get('CONFIG_DIR', 'user_configs')
+from utils.storage import get_storage, clear_conversation
+# 内存中修改过的配置每隔多少秒写回磁盘，退出时也会写回
+CONFIG_FLUSH_INTERVAL = int(os.environ.get('CONFIG_FLUSH_INTERVAL', '5'))
+# 内存中最多保留多少个用户的配置，其余的在用到时再从磁盘读取
+CONFIG_CACHE_SIZE = int(os.environ.get('CONFIG_CACHE_SIZE', '1000'))
 
 import os
 from contextlib import contextmanager
@@ -126,51 +137,25 @@ def file_lock(filename):
 #     print("无法获取文件锁，文件可能正被其他进程使用")
 
 def save_user_config(user_id, config):
-    if not os.path.exists(CONFIG_DIR):
-        os.makedirs(CONFIG_DIR)
-
-    filename = os.path.join(CONFIG_DIR, f'{user_id}.json')
-
-    with file_lock(filename):
-        with open(filename, 'w') as f:
-            json.dump(config, f, indent=2, ensure_ascii=False)
+    get_storage().save_user_config(user_id, config)
 
 def load_user_config(user_id):
-    filename = os.path.join(CONFIG_DIR, f'{user_id}.json')
-
-    if not os.path.exists(filename):
-        return {}
-
-    with file_lock(filename):
-        with open(filename, 'r') as f:
-            content = f.read()
-            if not content.strip():
-                return {}
-            else:
-                return json.loads(content)
+    return get_storage().load_user_config(user_id)
 
 def update_user_config(user_id, key, value):
     config = load_user_config(user_id)
     config[key] = value
     save_user_config(user_id, config)
 
-class NestedDict:
-    def __init__(self):
-        self.data = {}
-
-    def __getitem__(self, key):
-        if key not in self.data:
-            self.data[key] = NestedDict()
-        return self.data[key]
-
-    def __setitem__(self, key, value):
-        self.data[key] = value
-
-    def __str__(self):
-        return str(self.data)
-
-    def keys(self):
-        return self.data.keys()
+# 定义旧键名到新键名的映射关系 old_key -> new_key
+CONFIG_KEY_MAPPING = {
+    "SEARCH": "get_search_results",
+    "URL": "get_url_content",
+    "ARXIV": "download_read_arxiv_pdf",
+    "CODE": "run_python_script",
+    "IMAGE": "generate_image",
+    "get_date_time_weekday": "get_time"
+}
 
 class UserConfig:
     def __init__(self,
@@ -197,64 +182,121 @@ class UserConfig:
         self.plugins = plugins
         self.systemprompt = systemprompt
         self.claude_systemprompt = claude_systemprompt
-        self.users = NestedDict()
-        self.users["global"] = self.get_init_preferences()
-        # self.users = {
-        #     "global": self.get_init_preferences()
-        # }
-        self.users["global"].update(self.preferences)
-        self.users["global"].update(self.plugins)
-        self.users["global"].update(self.languages)
         self.mode = mode
-        self.load_all_configs()
+        # 用户配置按需从磁盘加载，内存中按最近使用顺序最多保留 CONFIG_CACHE_SIZE 个
+        self.users = OrderedDict()
+        # 内存中的配置是唯一的数据源，修改只记录脏用户，由 flush() 批量写回磁盘
+        self._dirty = set()
+        # 正在写盘的用户（可能有多次写入同时进行，所以计数），写完之前不从内存中淘汰
+        self._in_flight = Counter()
+        self._flush_lock = threading.Lock()
+        self.load_user("global")
         self.parameter_name_list = list(self.users["global"].keys())
-        for key in self.parameter_name_list:
-            update_user_config("global", key, self.users["global"][key])
-
-
-    def load_all_configs(self):
-        if not os.path.exists(CONFIG_DIR):
+        self.mark_dirty("global")
+
+    def mark_dirty(self, user_id):
+        self._dirty.add(user_id)
+
+    def _take_dirty(self):
+        # 在事件循环线程里复制一份修改过的配置，写盘可以放到其他线程
+        dirty, self._dirty = self._dirty, set()
+        snapshot = {user_id: dict(self.users[user_id]) for user_id in dirty if user_id in self.users}
+        self._in_flight.update(snapshot.keys())
+        return snapshot
+
+    def _write(self, snapshot):
+        """把快照写回磁盘，可以在其他线程中调用，返回写入失败的用户ID列表
+
+        不修改 _dirty 和 _in_flight，由调用方回到事件循环线程后调用 _finish_write()。
+        """
+        with self._flush_lock:
+            failed = []
+            for user_id, config in snapshot.items():
+                try:
+                    save_user_config(user_id, config)
+                except Exception as e:
+                    failed.append(user_id)
+                    logging.error(f"保存用户配置失败 {user_id}: {str(e)}")
+            return failed
+
+    def _finish_write(self, snapshot, failed):
+        # 在事件循环线程里调用：写入失败的用户留到下一次再写，写完的用户可以被淘汰
+        for user_id in snapshot:
+            self._in_flight[user_id] -= 1
+            if self._in_flight[user_id] <= 0:
+                del self._in_flight[user_id]
+        self._dirty.update(failed)
+        self.evict()
+
+    def flush(self):
+        """把修改过的用户配置写回磁盘，每个用户一个文件，返回写入的文件数"""
+        snapshot = self._take_dirty()
+        failed = self._write(snapshot)
+        self._finish_write(snapshot, failed)
+        return len(snapshot) - len(failed)
+
+    def get_default_config(self):
+        config = self.get_init_preferences()
+        config.update(self.preferences)
+        config.update(self.plugins)
+        config.update(self.languages)
+        return config
+
+    def migrate_config(self, user_id, user_config):
+        """加载时对旧配置做迁移，返回配置是否有修改"""
+        updated_config = False
+
+        # 检查并进行键名映射转换
+        for old_key, new_key in CONFIG_KEY_MAPPING.items():
+            if old_key in user_config:
+                user_config[new_key] = user_config.pop(old_key)
+                updated_config = True
+
+        # api_url、api_key 以及全局的系统提示词以环境变量为准
+        if "api_url" in user_config and user_config["api_url"] != self.api_url:
+            user_config["api_url"] = self.api_url
+            updated_config = True
+        if "api_key" in user_config and user_config["api_key"] != self.api_key:
+            user_config["api_key"] = self.api_key
+            updated_config = True
+        if user_id == "global" and "systemprompt" in user_config and user_config["systemprompt"] != self.systemprompt:
+            user_config["systemprompt"] = self.systemprompt
+            updated_config = True
+
+        # 补上新版本增加的配置项
+        for key, value in self.get_default_config().items():
+            if key not in user_config:
+                user_config[key] = value
+                updated_config = True
+        return updated_config
+
+    def load_user(self, user_id):
+        """返回用户的配置，不在内存中时从磁盘加载，磁盘上也没有时使用默认配置"""
+        if user_id in self.users:
+            self.users.move_to_end(user_id)
+            return self.users[user_id]
+
+        user_config = load_user_config(user_id)
+        if user_config:
+            if self.migrate_config(user_id, user_config):
+                self.mark_dirty(user_id)
+        else:
+            user_config = self.get_default_config()
+            self.mark_dirty(user_id)
+        self.users[user_id] = user_config
+        self.evict()
+        return user_config
+
+    def evict(self):
+        # 淘汰最久没有使用的用户，全局配置、还没写回磁盘和正在写盘的配置保留在内存中
+        if len(self.users) <= CONFIG_CACHE_SIZE:
             return
-
-        # 定义旧键名到新键名的映射关系 old_key -> new_key
-        key_mapping = {
-            "SEARCH": "get_search_results",
-            "URL": "get_url_content",
-            "ARXIV": "download_read_arxiv_pdf",
-            "CODE": "run_python_script",
-            "IMAGE": "generate_image",
-            "get_date_time_weekday": "get_time"
-        }
-
-        for filename in os.listdir(CONFIG_DIR):
-            if filename.endswith('.json'):
-                user_id = filename[:-5]  # 移除 '.json' 后缀
-                user_config = load_user_config(user_id)
-                self.users[user_id] = NestedDict()
-
-                # 检查并进行键名映射转换
-                updated_config = False
-                for old_key, new_key in key_mapping.items():
-                    if old_key in user_config:
-                        user_config[new_key] = user_config.pop(old_key)
-                        updated_config = True
-
-                # 如果配置有更新，保存回文件
-                if updated_config:
-                    save_user_config(user_id, user_config)
-
-                # 正常处理配置项
-                for key, value in user_config.items():
-                    self.users[user_id][key] = value
-                    if key == "api_url" and value != self.api_url:
-                        self.users[user_id]["api_url"] = self.api_url
-                        update_user_config(user_id, "api_url", self.api_url)
-                    if key == "api_key" and value != self.api_key:
-                        self.users[user_id]["api_key"] = self.api_key
-                        update_user_config(user_id, "api_key", self.api_key)
-                    if user_id == "global" and key == "systemprompt" and value != self.systemprompt:
-                        self.users[user_id]["systemprompt"] = self.systemprompt
-                        update_user_config(user_id, "systemprompt", self.systemprompt)
+        for user_id in list(self.users.keys()):
+            if len(self.users) <= CONFIG_CACHE_SIZE:
+                break
+            if user_id == "global" or user_id in self._dirty or user_id in self._in_flight:
+                continue
+            del self.users[user_id]
 
     def get_init_preferences(self):
         return {
@@ -270,13 +312,7 @@ class UserConfig:
         if user_id == None or self.mode == "global":
             user_id = "global"
         self.user_id = user_id
-        if self.user_id not in self.users.keys():
-            self.users[self.user_id] = self.get_init_preferences()
-            self.users[self.user_id].update(self.preferences)
-            self.users[self.user_id].update(self.plugins)
-            self.users[self.user_id].update(self.languages)
-            for key in self.users[self.user_id].keys():
-                update_user_config(user_id, key, self.users[self.user_id][key])
+        self.load_user(self.user_id)
 
     def get_config(self, user_id = None, parameter_name = None):
         if parameter_name not in self.parameter_name_list:
@@ -291,32 +327,24 @@ class UserConfig:
         if parameter_name not in self.parameter_name_list:
             raise ValueError("parameter_name is not in the parameter_name_list")
         if self.mode == "global":
-            self.users["global"][parameter_name] = value
-            update_user_config("global", parameter_name, value)
+            self.load_user("global")[parameter_name] = value
+            self.mark_dirty("global")
         if self.mode == "multiusers":
             self.user_init(user_id)
             self.users[self.user_id][parameter_name] = value
-            update_user_config(self.user_id, parameter_name, value)
+            self.mark_dirty(self.user_id)
 
     def extract_plugins_config(self, user_id = None):
         self.user_init(user_id)
-        if isinstance(self.users[self.user_id], dict):
-            user_data = self.users[self.user_id]
-        else:
-            user_data = self.users[self.user_id].data
+        user_data = self.users[self.user_id]
         plugins_config = {key: value for key, value in user_data.items() if key in self.plugins}
         return plugins_config
 
     def to_json(self, user_id=None):
-        def nested_dict_to_dict(nd):
-            if isinstance(nd, NestedDict):
-                return {k: nested_dict_to_dict(v) for k, v in nd.data.items()}
-            return nd
-
         if user_id:
-            serializable_config = nested_dict_to_dict(self.users[user_id])
+            serializable_config = self.load_user(user_id)
         else:
-            serializable_config = nested_dict_to_dict(self.users)
+            serializable_config = dict(self.users)
 
         return json.dumps(serializable_config, ensure_ascii=False, indent=2)
 
@@ -324,6 +352,21 @@ class UserConfig:
         return str(self.users)
 
 Users = UserConfig(mode=CHAT_MODE, api_key=API, api_url=API_URL, engine=GPT_ENGINE, preferences=PREFERENCES, plugins=PLUGINS, language=LANGUAGE, languages=LANGUAGES, systemprompt=systemprompt, claude_systemprompt=claude_systemprompt)
+# 退出时把还没写回的配置保存到磁盘
+atexit.register(Users.flush)
+
+async def flush_user_configs(context):
+    """JobQueue 任务：定期把修改过的用户配置写回磁盘"""
+    snapshot = Users._take_dirty()
+    if not snapshot:
+        return
+    try:
+        failed = await asyncio.to_thread(Users._write, snapshot)
+    except Exception as e:
+        logging.error(f"保存用户配置失败: {str(e)}")
+        failed = list(snapshot)
+    # 回到事件循环线程再修改 _dirty，不和 _take_dirty 竞争
+    Users._finish_write(snapshot, failed)
 
 temperature = float(os.environ.get('temperature', '0.5'))
 CLAUDE_API = os.environ.get('claude_api_key', None)
@@ -407,7 +450,7 @@ def update_info_message(user_id = None):
         f"**📖 Version:** `{check_for_updates()}`\n\n",
     ])
 
-def reset_ENGINE(chat_id, message=None):
+async def reset_ENGINE(chat_id, message=None):
     global ChatGPTbot, groqBot, vertexBot
     api_key = Users.get_config(chat_id, "api_key")
     api_url = Users.get_config(chat_id, "api_url")
@@ -428,6 +471,8 @@ def reset_ENGINE(chat_id, message=None):
         groqBot.reset(convo_id=str(chat_id), system_prompt=systemprompt)
     if VERTEX_PRIVATE_KEY and VERTEX_CLIENT_EMAIL and VERTEX_PROJECT_ID and vertexBot:
         vertexBot.reset(convo_id=str(chat_id), system_prompt=systemprompt)
+    # 重置后不再从存储后端恢复之前的对话
+    await clear_conversation(str(chat_id))
 
 def get_robot(chat_id = None):
     global ChatGPTbot, groqBot, duckBot
@@ -0,0 +1,56 @@
+"""记忆去重查找的微基准
+
+在 10k 条中文记忆中查找与新记忆相似的已有记忆：
+- scan: 逐条分词并计算相似度（倒排索引之前 add_memory 的做法）
+- index: 通过倒排索引找候选，只给少数候选打分
+
+运行：python test/bench_memory_dedup.py
+"""
+import os
+import sys
+import random
+import timeit
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.memory_index import MemoryIndex, tokenize, jaccard
+
+SIZE = 10000
+QUERIES = 50
+
+SUBJECTS = ["用户", "用户的朋友", "用户的同事", "用户的家人"]
+VERBS = ["喜欢", "讨厌", "经常去", "最近在学", "想要买", "正在读"]
+OBJECTS = ["猫", "咖啡", "跑步", "日本料理", "Python", "吉他", "科幻小说", "登山", "摄影", "围棋",
+           "上海", "北京", "机械键盘", "红茶", "爵士乐", "游泳", "油画", "Rust", "滑雪", "烘焙"]
+
+def make_content(rng):
+    return (f"{rng.choice(SUBJECTS)}{rng.choice(VERBS)}{rng.choice(OBJECTS)}"
+            f"和{rng.choice(OBJECTS)}，第{rng.randint(1, 100000)}次提到")
+
+def scan(memories, content):
+    terms = set(tokenize(content))
+    for memory in memories:
+        if jaccard(terms, set(tokenize(memory["content"]))) > 0.8:
+            return memory
+    return None
+
+def main():
+    rng = random.Random(0)
+    memories = [{"id": i + 1, "content": make_content(rng)} for i in range(SIZE)]
+    queries = [make_content(rng) for _ in range(QUERIES // 2)]
+    # 一半查询是已有记忆的近似重复
+    queries += [memory["content"] + "了" for memory in rng.sample(memories, QUERIES // 2)]
+
+    build = timeit.timeit(lambda: MemoryIndex(memories), number=1)
+    index = MemoryIndex(memories)
+    for query in queries:
+        assert (scan(memories, query) is None) == (index.find_similar(query) is None)
+
+    scan_time = min(timeit.repeat(lambda: [scan(memories, q) for q in queries], number=1, repeat=3))
+    index_time = min(timeit.repeat(lambda: [index.find_similar(q) for q in queries], number=1, repeat=3))
+    print(f"memories: {SIZE}, index build: {build * 1000:.1f} ms")
+    print(f"scan:  {scan_time / QUERIES * 1000:.3f} ms/lookup")
+    print(f"index: {index_time / QUERIES * 1000:.3f} ms/lookup")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""记忆写入的微基准
+
+分别在已有 100、1k、10k 条记忆时测量更新一条记忆的耗时和写入的字节数：
+- snapshot: 整体重写记忆文件（日志之前每次修改的做法）
+- journal: 在日志末尾追加一条记录
+
+运行：python test/bench_memory_journal.py
+"""
+import os
+import sys
+import tempfile
+import timeit
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils.storage
+from utils.storage import JsonFileStorage, encode_memories
+
+SIZES = (100, 1000, 10000)
+ROUNDS = 50
+
+def main():
+    # 只测追加本身，不触发后台合并
+    utils.storage.MEMORY_JOURNAL_MAX_BYTES = 1 << 40
+    print(f"{'memories':>10} {'snapshot ms':>12} {'snapshot B':>12} {'journal ms':>12} {'journal B':>12}")
+    for size in SIZES:
+        with tempfile.TemporaryDirectory() as directory:
+            storage = JsonFileStorage(config_dir=directory, memory_dir=directory)
+            data = {"memories": [{
+                "id": i + 1,
+                "content": f"用户的第 {i} 条信息",
+                "created_at": "2024-01-01 00:00:00",
+                "updated_at": "2024-01-01 00:00:00",
+                "importance": 3,
+                "access_count": 1,
+                "source": "conversation",
+            } for i in range(size)], "last_updated": None, "next_id": size + 1}
+            storage.save_memories("bench", data)
+            memory = data["memories"][0]
+
+            def snapshot():
+                memory["access_count"] += 1
+                storage.save_memories("bench", data)
+
+            def journal():
+                memory["access_count"] += 1
+                storage.upsert_memory("bench", memory, "2024-01-01 00:00:00")
+
+            snapshot_time = timeit.timeit(snapshot, number=ROUNDS) / ROUNDS
+            journal_time = timeit.timeit(journal, number=ROUNDS) / ROUNDS
+            journal_bytes = os.path.getsize(storage.journal_file("bench")) / ROUNDS
+            print(f"{size:>10} {snapshot_time * 1000:>12.2f} {len(encode_memories(data)):>12} "
+                  f"{journal_time * 1000:>12.2f} {journal_bytes:>12.0f}")
+
+if __name__ == "__main__":
+    main()
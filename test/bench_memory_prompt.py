@@ -0,0 +1,77 @@
+"""记忆提示词拼装的微基准
+
+分别在 10、1k、10k 条记忆下测量每轮对话拼装系统提示词的耗时：
+- uncached: 每轮都重新筛选、排序并渲染记忆（缓存之前的做法）
+- cached: 记忆没有变化时直接复用渲染好的记忆段落，不再筛选记忆，应该明显快于 uncached
+- invalidated: 每轮都先修改一条记忆，再拼装提示词
+- relevant: 每轮按不同的当前消息挑选语义相关的记忆（每轮都要检索，不能复用缓存）
+
+运行：python test/bench_memory_prompt.py
+"""
+import os
+import sys
+import random
+import tempfile
+import timeit
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.storage import JsonFileStorage, empty_memories
+from utils.memory_system import MemorySystem
+
+SIZES = (10, 1000, 10000)
+ROUNDS = 200
+
+def make_memory_system(size, directory):
+    storage = JsonFileStorage(config_dir=directory, memory_dir=directory)
+    memory_system = MemorySystem("bench", storage=storage)
+    memories = empty_memories()
+    for i in range(size):
+        memories["memories"].append({
+            "id": i + 1,
+            "content": f"用户的第 {i} 条信息：喜欢 {random.choice(['猫', '狗', '咖啡', '跑步', '电影'])}",
+            "created_at": "2024-01-01 00:00:00",
+            "updated_at": f"2024-01-01 00:{i // 60 % 60:02d}:{i % 60:02d}",
+            "importance": random.randint(1, 5),
+            "access_count": 1,
+            "source": "conversation",
+        })
+    memory_system.memories = memories
+    memory_system.revision += 1
+    memory_system._rebuild_index()
+    return memory_system
+
+def uncached(memory_system):
+    # 每轮都清空缓存，相当于没有缓存时的耗时
+    memory_system._prompt_cache.clear()
+    return memory_system.generate_memory_prompt(system_prompt="system")
+
+def cached(memory_system):
+    return memory_system.generate_memory_prompt(system_prompt="system")
+
+def invalidated(memory_system):
+    # 模拟每轮都有 update 的情况，只改内存不落盘，只测渲染本身
+    memory_system.memories["memories"][0]["access_count"] += 1
+    memory_system.revision += 1
+    return memory_system.generate_memory_prompt(system_prompt="system")
+
+def relevant(memory_system):
+    query = f"我最近又开始{random.choice(['撸猫', '遛狗', '喝咖啡', '跑步', '看电影'])}了"
+    return memory_system.generate_memory_prompt(system_prompt="system", query=query)
+
+def main():
+    random.seed(0)
+    print(f"{'memories':>10} {'uncached':>12} {'cached':>12} {'invalidated':>12} {'relevant':>12}  (µs/turn)")
+    with tempfile.TemporaryDirectory() as directory:
+        for size in SIZES:
+            memory_system = make_memory_system(size, directory)
+            results = []
+            for func in (uncached, cached, invalidated, relevant):
+                seconds = min(timeit.repeat(lambda: func(memory_system), number=ROUNDS, repeat=3))
+                results.append(seconds / ROUNDS * 1e6)
+            print(f"{size:>10}" + "".join(f" {result:>12.1f}" for result in results))
+            # 缓存命中时不再筛选记忆，必须比每轮重新筛选快
+            assert results[1] < results[0] / 2, f"{size} 条记忆时缓存没有生效：{results[1]:.1f} µs >= {results[0]:.1f} µs / 2"
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+"""记忆检索的微基准
+
+在 1k、5k、10k 条中文记忆中按 BM25 检索，并按重要性和更新时间加权。
+
+运行：python test/bench_memory_search.py
+"""
+import os
+import sys
+import random
+import timeit
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.memory_index import MemoryIndex
+from bench_memory_dedup import make_content, OBJECTS, VERBS
+
+SIZES = (1000, 5000, 10000)
+QUERIES = 100
+
+def main():
+    rng = random.Random(0)
+    queries = [rng.choice(OBJECTS) for _ in range(QUERIES // 2)]
+    queries += [f"{rng.choice(VERBS)}{rng.choice(OBJECTS)}" for _ in range(QUERIES // 2)]
+    print(f"{'memories':>10} {'ms/query':>10}")
+    for size in SIZES:
+        memories = [{
+            "id": i + 1,
+            "content": make_content(rng),
+            "tags": [rng.choice(OBJECTS)],
+            "importance": rng.randint(1, 5),
+            "updated_at": f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d} 12:00:00",
+        } for i in range(size)]
+        index = MemoryIndex(memories)
+        seconds = min(timeit.repeat(
+            lambda: [index.search(q, limit=5, importance_boost=0.3, recency_boost=0.2) for q in queries],
+            number=1, repeat=3))
+        print(f"{size:>10} {seconds / QUERIES * 1000:>10.3f}")
+
+if __name__ == "__main__":
+    main()
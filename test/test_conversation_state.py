@@ -0,0 +1,45 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.conversation_state import ConversationTracker
+
+def test_state_tracks_trailing_bot_messages_and_replies():
+    tracker = ConversationTracker()
+    tracker.record("1", {"role": "system", "content": "# 你的角色基本信息"})
+    tracker.record("1", {"role": "user", "content": "[2024-01-01 10:00] 你好", "timestamp": "100"})
+    state = tracker.get("1")
+    assert state.awaiting_reply and state.last_user_time == 100.0
+
+    tracker.record("1", {"role": "assistant", "content": "你好呀", "timestamp": "110"})
+    tracker.record("1", {"role": "user", "content": "我想和你聊聊天"})
+    tracker.record("1", {"role": "assistant", "content": "在忙吗？", "timestamp": "200"})
+    assert not state.awaiting_reply
+    assert state.trailing_assistant == 2
+    assert (state.last_bot_message, state.last_bot_time) == ("在忙吗？", 200.0)
+    # 虚拟消息和系统消息不算在最近的真实消息里
+    assert [m["content"] for m in state.recent] == ["[2024-01-01 10:00] 你好", "你好呀", "在忙吗？"]
+    assert state.reply_ratio == 1 / 3
+
+    tracker.record("1", {"role": "user", "content": "刚才在开会"})
+    assert state.trailing_assistant == 0 and state.awaiting_reply
+
+def test_reply_ratio_uses_a_bounded_window():
+    tracker = ConversationTracker()
+    for i in range(30):
+        tracker.record("1", {"role": "user", "content": f"u{i}"})
+    for i in range(10):
+        tracker.record("1", {"role": "assistant", "content": f"a{i}"})
+    state = tracker.get("1")
+    assert len(state.recent) == 20
+    assert state.reply_ratio == 0.5
+
+def test_state_is_built_once_from_existing_history():
+    tracker = ConversationTracker()
+    assert tracker.get("1") is None
+    assert tracker.get("1", []) is None
+    state = tracker.get("1", [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "hello"}])
+    assert state.trailing_assistant == 1
+    assert tracker.get("1") is state
+    tracker.reset("1")
+    assert tracker.get("1") is None
@@ -0,0 +1,88 @@
+import os
+import sys
+import asyncio
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils.edit_scheduler
+from utils.edit_scheduler import StreamEditScheduler, GlobalEditLimiter, chat_next_edit_time
+
+class FakeClock:
+    """代替 time.monotonic 和 asyncio.sleep：时间只在测试调用 advance() 时前进"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    async def sleep(self, delay):
+        target = self.now + delay
+        await real_sleep(0)
+        while self.now < target:
+            await real_sleep(0)
+
+    async def advance(self, seconds):
+        self.now += seconds
+        await settle()
+
+real_sleep = asyncio.sleep
+
+def use_fake_clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(utils.edit_scheduler, "time", clock)
+    monkeypatch.setattr(asyncio, "sleep", clock.sleep)
+    monkeypatch.setattr(utils.edit_scheduler, "global_edit_limiter", GlobalEditLimiter(1000))
+    chat_next_edit_time.clear()
+    return clock
+
+async def settle():
+    for _ in range(10):
+        await real_sleep(0)
+
+def test_edits_follow_the_chat_budget_and_merge_pending_text(monkeypatch):
+    clock = use_fake_clock(monkeypatch)
+    edits = []
+
+    async def edit(message_id, text):
+        edits.append((clock.now, text))
+
+    async def main():
+        scheduler = StreamEditScheduler("chat", 1, edit, interval=1.0)
+        scheduler.submit("a")
+        await settle()
+        # 时间槽还没到，这三次提交会被合并成一次编辑，只显示最新的文本
+        for text in ("ab", "abc", "abcd"):
+            scheduler.submit(text)
+        for _ in range(4):
+            await clock.advance(0.25)
+        # 10 秒内每 0.25 秒提交一次
+        for i in range(40):
+            scheduler.submit("abcd" + "e" * (i + 1))
+            await clock.advance(0.25)
+        await scheduler.flush()
+        return scheduler
+
+    scheduler = asyncio.run(main())
+    assert edits[:2] == [(0.0, "a"), (1.0, "abcd")]
+    assert edits[-1][1] == "abcd" + "e" * 40
+    # 每秒最多编辑一次：11 秒内 44 次提交只编辑了 12 次，最终输出和最后一次编辑相同，不再重复编辑
+    assert clock.now == 11.0
+    assert [at for at, _ in edits] == [float(second) for second in range(12)]
+    assert scheduler.edit_count == len(edits)
+    chat_next_edit_time.clear()
+
+def test_past_edit_slots_are_pruned(monkeypatch):
+    monkeypatch.setattr(utils.edit_scheduler, "CHAT_EDIT_TIME_PRUNE_SIZE", 4)
+    chat_next_edit_time.clear()
+
+    async def edit(message_id, text):
+        pass
+
+    async def main():
+        for chat_id in range(10):
+            await StreamEditScheduler(chat_id, chat_id, edit, interval=0)._wait_for_slot()
+
+    asyncio.run(main())
+    # 已经过去的时间槽被清理掉，字典不会随聊天数量一直增长
+    assert len(chat_next_edit_time) <= 5
+    chat_next_edit_time.clear()
@@ -0,0 +1,48 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    from md2tgmd.src.md2tgmd import escape
+except ImportError:
+    from md2tgmd import escape
+
+from utils.markdown_stream import IncrementalMarkdownRenderer
+
+def full_escape(text):
+    return escape(text, italic=False)
+
+def assert_matches_full_escape(text, step):
+    renderer = IncrementalMarkdownRenderer(full_escape)
+    for end in range(step, len(text) + step, step):
+        part = text[:end]
+        assert renderer.render(part) == full_escape(renderer.close_markup(part)), repr(part)
+    assert renderer.render(text) == full_escape(text)
+
+def test_headings_and_lists():
+    text = "# Heading\n\nSome text\n\n## Sub\n\n- a\n- b\n"
+    renderer = IncrementalMarkdownRenderer(full_escape)
+    assert renderer.render(text) == full_escape(text)
+    assert "\\#" not in renderer.render(text)
+    for step in (1, 5):
+        assert_matches_full_escape(text, step)
+
+def test_numbered_and_star_lists():
+    text = "Intro\n\n1. one\n2. two\n\n* star\n* item\n\n**bold** and `code-x` here!\n\n> quote\n"
+    for step in (1, 7):
+        assert_matches_full_escape(text, step)
+
+def test_code_fences():
+    text = "Intro text.\n\n```python\nx = 1\n\ny = 2 - 1\n```\n\nAfter code.\n\n\n```\nprint('#')\n```\n\nEnd.\n"
+    for step in (1, 6):
+        assert_matches_full_escape(text, step)
+
+def test_tables():
+    text = "| a | b |\n|---|---|\n| 1 | 2 |\n\nDone.\n\n| x |\n|---|\n| y |\n"
+    for step in (1, 4):
+        assert_matches_full_escape(text, step)
+
+def test_render_full_closes_markup_and_transforms():
+    renderer = IncrementalMarkdownRenderer(full_escape, transform=lambda text: text.replace("foo", "bar"))
+    text = "foo\n\n```python\nx = 1"
+    assert renderer.render_full(text) == full_escape("bar\n\n```python\nx = 1\n```")
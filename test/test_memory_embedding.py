@@ -0,0 +1,47 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils.memory_embedding as memory_embedding
+from utils.memory_embedding import SemanticIndex, hashing_embedding, encode_vector, decode_vector
+
+def test_hashing_embedding_is_normalized_and_deterministic():
+    vector = hashing_embedding("用户喜欢喝咖啡", dim=64)
+    assert len(vector) == 64
+    assert abs(sum(value * value for value in vector) - 1) < 1e-9
+    assert vector == hashing_embedding("用户喜欢喝咖啡", dim=64)
+
+def test_semantic_index_search_after_updates_and_removals():
+    coffee = {"id": 1, "content": "用户每天早上喝咖啡", "importance": 3}
+    cat = {"id": 2, "content": "用户养了一只橘猫", "importance": 3}
+    run = {"id": 3, "content": "用户周末去跑步", "importance": 1}
+    index = SemanticIndex([coffee, cat, run])
+    assert index.search("咖啡喝多了睡不着", limit=1)[0][1] is coffee
+    assert index.search("跑步", min_importance=2) == []
+
+    index.remove(coffee)
+    assert all(memory is not coffee for _, memory in index.search("咖啡"))
+    cat["content"] = "用户养了一只柯基犬"
+    index.update(cat)
+    assert index.search("柯基", limit=1)[0][1] is cat
+    assert len(index) == 2
+
+def test_vector_records_round_trip():
+    sparse = hashing_embedding("用户喜欢喝咖啡")
+    record = encode_vector(sparse, "用户喜欢喝咖啡")
+    assert "index" in record
+    assert all(abs(a - b) < 1e-6 for a, b in zip(decode_vector(record, "用户喜欢喝咖啡"), sparse))
+    dense = [0.5, -0.5, 0.5, 0.5]
+    assert decode_vector(encode_vector(dense, "x"), "x") == dense
+    # 内容变化后保存的向量失效
+    assert decode_vector(record, "用户喜欢喝茶") is None
+
+def test_stored_vectors_are_reused(monkeypatch):
+    memories = [{"id": 1, "content": "用户每天早上喝咖啡"}, {"id": 2, "content": "用户养了一只橘猫"}]
+    stored = SemanticIndex(memories).export()
+    calls = []
+    monkeypatch.setattr(memory_embedding, "_embedding_function", lambda text: calls.append(text) or hashing_embedding(text))
+    memories[1]["content"] = "用户养了一只柯基犬"
+    index = SemanticIndex(memories, stored=stored)
+    assert calls == ["用户养了一只柯基犬"]
+    assert index.search("咖啡", limit=1)[0][1] is memories[0]
@@ -0,0 +1,48 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.memory_index import MemoryIndex, tokenize
+
+def test_tokenize_splits_cjk_into_bigrams():
+    assert tokenize("我喜欢Python和猫 狗") == ["我喜", "喜欢", "python", "和猫", "狗"]
+    assert tokenize("Hello, World_2") == ["hello", "world", "2"]
+
+def test_find_similar_tracks_updates_and_removals():
+    cat = {"id": 1, "content": "用户最喜欢的动物是猫咪"}
+    tea = {"id": 2, "content": "用户每天早上喝红茶"}
+    index = MemoryIndex([cat, tea])
+    assert index.find_similar("用户最喜欢的动物是猫咪啊") is cat
+    assert index.find_similar("用户最喜欢的动物是狗") is None
+
+    cat["content"] = "用户最喜欢的动物是狗狗"
+    index.update(cat)
+    assert index.find_similar("用户最喜欢的动物是猫咪啊") is None
+    assert index.find_similar("用户最喜欢的动物是狗狗呀") is cat
+
+    index.remove(tea)
+    assert len(index) == 1
+    assert index.find_similar("用户每天早上喝红茶") is None
+
+def test_search_ranks_by_relevance_and_matches_tags():
+    memories = [
+        {"id": 1, "content": "用户养了一只猫", "importance": 1},
+        {"id": 2, "content": "用户喜欢喝咖啡", "importance": 5, "tags": ["饮料"]},
+        {"id": 3, "content": "用户的猫叫小白，用户很喜欢猫", "importance": 1},
+    ]
+    index = MemoryIndex(memories)
+    assert [m["id"] for _, m in index.search("猫")] == [3, 1]
+    assert [m["id"] for _, m in index.search("饮料")] == [2]
+    assert [m["id"] for _, m in index.search("猫", min_importance=2)] == []
+    assert index.search("") == []
+
+def test_search_boosts_important_and_recent_memories():
+    memories = [
+        {"id": 1, "content": "用户喜欢跑步", "importance": 1, "updated_at": "2020-01-01 00:00:00"},
+        {"id": 2, "content": "用户喜欢跑步", "importance": 1, "updated_at": "2024-01-01 00:00:00"},
+        {"id": 3, "content": "用户喜欢跑步", "importance": 5, "updated_at": "2020-01-01 00:00:00"},
+    ]
+    index = MemoryIndex(memories)
+    assert [m["id"] for _, m in index.search("跑步", importance_boost=1.0)][0] == 3
+    now = MemoryIndex._parse_time(memories[1])
+    assert [m["id"] for _, m in index.search("跑步", recency_boost=1.0, now=now)][0] == 2
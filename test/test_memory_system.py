@@ -0,0 +1,236 @@
+import os
+import sys
+import json
+import asyncio
+import threading
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.storage import JsonFileStorage
+from utils.memory_system import MemorySystem, run_memory_io
+
+def make_memory_system(tmp_path):
+    storage = JsonFileStorage(config_dir=str(tmp_path), memory_dir=str(tmp_path))
+    return MemorySystem("1", storage=storage)
+
+def test_memory_prompt_is_cached_until_memories_change(tmp_path):
+    memory_system = make_memory_system(tmp_path)
+    assert memory_system.generate_memory_prompt(system_prompt="system") == "system"
+
+    memory_system.add_memory("用户喜欢猫", importance=3)
+    first = memory_system.render_memory_block()
+    assert "1. 用户喜欢猫" in first
+    assert memory_system.render_memory_block() is first
+
+    memory_system.add_memory("用户住在上海", importance=4)
+    second = memory_system.render_memory_block()
+    assert second.index("用户住在上海") < second.index("用户喜欢猫")
+
+    assert memory_system.forget_memory(2)
+    assert "用户住在上海" not in memory_system.render_memory_block()
+
+def test_low_importance_memories_are_not_rendered(tmp_path):
+    memory_system = make_memory_system(tmp_path)
+    memory_system.add_memory("不重要的信息", importance=1)
+    assert memory_system.render_memory_block() == ""
+
+def test_memory_prompt_prefers_memories_relevant_to_the_message(tmp_path):
+    memory_system = make_memory_system(tmp_path)
+    memory_system.add_memory("用户的名字叫小明", importance=5)
+    memory_system.add_memory("用户住在上海", importance=4)
+    memory_system.add_memory("用户养了一只叫咪咪的猫", importance=2)
+
+    block = memory_system.render_memory_block(max_memories=2, query="我家的猫今天不吃饭")
+    assert block.index("咪咪") < block.index("小明")
+    assert "上海" not in block
+    # 没有相关记忆时退回到最重要的记忆
+    assert "咪咪" not in memory_system.render_memory_block(max_memories=2, query="hello")
+
+def test_memory_prompt_cache_is_shared_by_queries_selecting_the_same_memories(tmp_path):
+    memory_system = make_memory_system(tmp_path)
+    memory_system.add_memory("用户养了一只叫咪咪的猫", importance=3)
+    memory_system.add_memory("用户住在上海", importance=3)
+    first = memory_system.render_memory_block(max_memories=2, query="我家的猫今天不吃饭")
+    assert memory_system.render_memory_block(max_memories=2, query="猫咪一直在叫") is first
+
+def test_cached_memory_prompt_skips_selecting_memories(tmp_path, monkeypatch):
+    memory_system = make_memory_system(tmp_path)
+    memory_system.add_memory("用户喜欢猫", importance=3)
+    first = memory_system.render_memory_block()
+    calls = []
+    get_memories = memory_system.get_memories
+    monkeypatch.setattr(memory_system, "get_memories", lambda *args, **kwargs: calls.append(1) or get_memories(*args, **kwargs))
+    assert memory_system.render_memory_block() is first
+    assert calls == []
+    memory_system.add_memory("用户住在上海", importance=4)
+    assert "用户住在上海" in memory_system.render_memory_block()
+    assert calls == [1]
+
+def test_memory_ids_are_never_reused(tmp_path):
+    memory_system = make_memory_system(tmp_path)
+    first = memory_system.add_memory("用户喜欢猫", importance=3)
+    second = memory_system.add_memory("用户住在上海", importance=3)
+    assert memory_system.forget_memories([second["id"], 99]) == [second["id"]]
+    assert [m["id"] for m in memory_system.memories["memories"]] == [first["id"]]
+    third = memory_system.add_memory("用户每天跑步", importance=3)
+    assert third["id"] not in (first["id"], second["id"])
+
+    reloaded = make_memory_system(tmp_path)
+    assert reloaded.get_memory(third["id"])["content"] == "用户每天跑步"
+    assert reloaded.add_memory("用户会弹吉他", importance=3)["id"] == third["id"] + 1
+
+def test_memory_vectors_are_stored_with_memories(tmp_path, monkeypatch):
+    import utils.memory_embedding as memory_embedding
+    memory_system = make_memory_system(tmp_path)
+    memory_system.add_memory("用户养了一只叫咪咪的猫", importance=3)
+    memory_system.add_memory("用户住在上海", importance=3)
+
+    calls = []
+    monkeypatch.setattr(memory_embedding, "_embedding_function", lambda text: calls.append(text) or memory_embedding.hashing_embedding(text))
+    reloaded = make_memory_system(tmp_path)
+    assert calls == []
+    assert "咪咪" in reloaded.render_memory_block(max_memories=1, query="猫")
+
+def test_duplicate_memory_ids_are_renumbered_on_load(tmp_path):
+    storage = JsonFileStorage(config_dir=str(tmp_path), memory_dir=str(tmp_path))
+    storage.save_memories("1", {"memories": [
+        {"id": 1, "content": "a", "importance": 2, "updated_at": "t"},
+        {"id": 2, "content": "b", "importance": 2, "updated_at": "t"},
+        {"id": 2, "content": "c", "importance": 2, "updated_at": "t"},
+    ], "last_updated": "t"})
+
+    memory_system = MemorySystem("1", storage=storage)
+    assert [m["id"] for m in memory_system.memories["memories"]] == [1, 2, 3]
+    assert memory_system.get_memory(3)["content"] == "c"
+    assert storage.load_memories("1")["next_id"] == 4
+
+def test_memory_io_runs_off_the_event_loop(tmp_path):
+    memory_system = make_memory_system(tmp_path)
+
+    async def main():
+        loop_thread = threading.current_thread()
+        memory = await run_memory_io(memory_system.add_memory, "用户喜欢猫", importance=3)
+        worker = await run_memory_io(threading.current_thread)
+        return memory, loop_thread, worker
+
+    memory, loop_thread, worker = asyncio.run(main())
+    assert memory["content"] == "用户喜欢猫"
+    assert worker is not loop_thread and worker.name.startswith("memory-io")
+
+def test_consolidate_decays_merges_and_caps_memories(tmp_path, monkeypatch):
+    from datetime import datetime
+    import utils.memory_system
+    monkeypatch.setattr(utils.memory_system, "MEMORY_DECAY_DAYS", 30)
+    monkeypatch.setattr(utils.memory_system, "MEMORY_MAX_PER_USER", 2)
+    storage = JsonFileStorage(config_dir=str(tmp_path), memory_dir=str(tmp_path))
+    storage.save_memories("1", {"memories": [
+        {"id": 1, "content": "用户最喜欢的动物是猫咪", "importance": 4, "access_count": 2,
+         "created_at": "2024-01-01 00:00:00", "updated_at": "2024-03-01 00:00:00", "tags": ["猫"]},
+        {"id": 2, "content": "用户最喜欢的动物是猫", "importance": 2, "access_count": 1,
+         "created_at": "2023-12-01 00:00:00", "updated_at": "2024-02-01 00:00:00"},
+        {"id": 3, "content": "用户住在上海", "importance": 5, "access_count": 1, "source": "user_explicit",
+         "created_at": "2023-01-01 00:00:00", "updated_at": "2023-01-01 00:00:00"},
+        {"id": 4, "content": "用户每天早上喝红茶", "importance": 3, "access_count": 1,
+         "created_at": "2024-03-01 00:00:00", "updated_at": "2024-03-01 00:00:00"},
+    ], "last_updated": "2024-03-01 00:00:00", "next_id": 5})
+    memory_system = MemorySystem("1", storage=storage)
+
+    report = memory_system.consolidate(now=datetime(2024, 4, 15))
+    assert report["decayed"] == 3
+    assert (report["merged"], report["evicted"], report["remaining"]) == (1, 1, 2)
+    assert report["reclaimed_bytes"] > 0
+
+    cat = memory_system.get_memory(1)
+    assert cat["importance"] == 3 and cat["access_count"] == 3
+    assert cat["created_at"] == "2023-12-01 00:00:00"
+    # 用户明确要求记住的记忆不衰减，也就不会因为重要性降低被淘汰
+    assert memory_system.get_memory(3)["importance"] == 5
+    assert memory_system.get_memory(4) is None
+
+    # 同一段时间不会重复衰减
+    assert memory_system.consolidate(now=datetime(2024, 4, 16))["decayed"] == 0
+    reloaded = MemorySystem("1", storage=storage)
+    assert sorted(m["id"] for m in reloaded.memories["memories"]) == [1, 3]
+    with open(storage.archive_file("1"), encoding="utf-8") as f:
+        archived = [json.loads(line) for line in f]
+    assert [(r["reason"], r["memory"]["id"]) for r in archived] == [("merged", 2), ("capacity", 4)]
+
+def test_compaction_does_not_reload_the_shared_memory_system(tmp_path):
+    memory_system = make_memory_system(tmp_path)
+    memory_system.add_memory("用户喜欢猫", importance=3)
+    memory_system.add_memory("用户住在上海", importance=3)
+    index = memory_system.index
+    memory_system.storage.compact("1")
+    memory_system.reload_if_changed()
+    assert memory_system.index is index
+
+def test_consolidate_keeps_memories_unmerged_when_archiving_fails(tmp_path, monkeypatch):
+    from datetime import datetime
+    memory_system = make_memory_system(tmp_path)
+    memory_system.storage.save_memories("1", {"memories": [
+        {"id": 1, "content": "用户最喜欢的动物是猫咪", "importance": 4, "access_count": 2,
+         "created_at": "2024-01-01 00:00:00", "updated_at": "2024-03-01 00:00:00", "tags": ["猫"]},
+        {"id": 2, "content": "用户最喜欢的动物是猫", "importance": 2, "access_count": 1,
+         "created_at": "2023-12-01 00:00:00", "updated_at": "2024-02-01 00:00:00", "tags": ["宠物"]},
+    ], "last_updated": "2024-03-01 00:00:00", "next_id": 3})
+    memory_system = MemorySystem("1", storage=memory_system.storage)
+
+    def fail(*args, **kwargs):
+        raise OSError("disk full")
+    monkeypatch.setattr(memory_system.storage, "archive_memories", fail)
+
+    report = memory_system.consolidate(now=datetime(2024, 3, 2))
+    assert (report["merged"], report["remaining"]) == (0, 2)
+    # 两条记忆都保留，保留的那条不应该已经加上了另一条的访问次数和标签
+    cat = memory_system.get_memory(1)
+    assert cat["access_count"] == 2 and cat["tags"] == ["猫"]
+    assert cat["created_at"] == "2024-01-01 00:00:00"
+    assert memory_system.get_memory(2)["access_count"] == 1
+    # 索引重建后两条记忆仍然可以被查到
+    assert memory_system.index.find_similar("用户最喜欢的动物是猫", threshold=0.5, exclude=cat) is memory_system.get_memory(2)
+
+def test_registry_loads_users_outside_the_lock(monkeypatch):
+    import utils.memory_system
+    from utils.memory_system import MemoryRegistry
+    release = threading.Event()
+    loading = threading.Event()
+
+    class SlowMemorySystem:
+        def __init__(self, user_id):
+            self.user_id = user_id
+            if user_id == "slow":
+                loading.set()
+                assert release.wait(5)
+
+        def reload_if_changed(self):
+            pass
+
+    monkeypatch.setattr(utils.memory_system, "MemorySystem", SlowMemorySystem)
+    registry = MemoryRegistry(capacity=4)
+    fast = registry.get("fast")
+    results = []
+    slow_threads = [threading.Thread(target=lambda: results.append(registry.get("slow"))) for _ in range(2)]
+    for thread in slow_threads:
+        thread.start()
+    assert loading.wait(5)
+    # 另一个用户冷加载期间，已经缓存的用户不需要等待
+    assert registry.get("fast") is fast
+    release.set()
+    for thread in slow_threads:
+        thread.join(5)
+    # 同时加载同一个用户时只保留一个实例
+    assert len(results) == 2 and results[0] is results[1] is registry.get("slow")
+
+def test_consolidating_all_users_does_not_fill_the_registry(tmp_path, monkeypatch):
+    import utils.memory_system
+    from utils.memory_system import MemoryRegistry, consolidate_all_memories
+    storage = JsonFileStorage(config_dir=str(tmp_path), memory_dir=str(tmp_path))
+    for user_id in ("1", "2", "3"):
+        storage.upsert_memory(user_id, {"id": 1, "content": f"用户 {user_id} 喜欢猫", "importance": 3}, "t")
+    monkeypatch.setattr(utils.memory_system, "get_storage", lambda: storage)
+    registry = MemoryRegistry(capacity=2)
+    monkeypatch.setattr(utils.memory_system, "memory_registry", registry)
+    active = registry.get("1")
+
+    assert consolidate_all_memories()["users"] == 3
+    # 只整理不缓存，活跃用户仍然留在缓存中
+    assert list(registry._systems) == ["1"] and registry.get("1") is active
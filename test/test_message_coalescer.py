@@ -0,0 +1,42 @@
+import os
+import sys
+import asyncio
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.message_coalescer import MessageCoalescer
+
+def test_short_message_is_returned_immediately():
+    coalescer = MessageCoalescer(threshold=10, idle=1000)
+    assert asyncio.run(coalescer.submit("a", "hi")) == "hi"
+    assert coalescer.stats()["batch_sizes"] == {1: 1}
+
+def test_long_message_waits_for_following_parts():
+    async def main():
+        coalescer = MessageCoalescer(threshold=10, idle=50)
+        first = asyncio.create_task(coalescer.submit("a", "x" * 20))
+        await asyncio.sleep(0.01)
+        assert await coalescer.submit("a", "y") is None
+        assert await first == "x" * 20 + "\ny"
+        return coalescer.stats()
+    stats = asyncio.run(main())
+    assert stats["coalesced"] == 1
+    assert stats["batch_sizes"] == {2: 1}
+
+def test_other_conversations_are_not_blocked():
+    async def main():
+        coalescer = MessageCoalescer(threshold=10, idle=200)
+        first = asyncio.create_task(coalescer.submit("a", "x" * 20))
+        await asyncio.sleep(0.01)
+        # 另一个对话的短消息不需要等待 a 的批次
+        assert await asyncio.wait_for(coalescer.submit("b", "hi"), timeout=0.05) == "hi"
+        assert await first == "x" * 20
+    asyncio.run(main())
+
+def test_batch_is_flushed_when_full():
+    async def main():
+        coalescer = MessageCoalescer(threshold=10, idle=5000, max_messages=2)
+        first = asyncio.create_task(coalescer.submit("a", "x" * 20))
+        await asyncio.sleep(0.01)
+        await coalescer.submit("a", "y")
+        return await asyncio.wait_for(first, timeout=0.1)
+    assert asyncio.run(main()) == "x" * 20 + "\ny"
@@ -0,0 +1,32 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.proactive_gate import ProactiveGate, score_features
+
+def test_clear_cases_are_decided_locally():
+    gate = ProactiveGate(low=0.35, high=0.85)
+    # 刚聊过、深夜、用户很少回复、主动消息也不回
+    assert gate.evaluate(0.5, 23, 0.05, 0.0)[0] == "decline"
+    # 很久没聊、晚上、用户经常回复、主动消息都有回复
+    assert gate.evaluate(24, 20, 0.5, 1.0)[0] == "send"
+    assert gate.evaluate(6, 15, 0.4, 0.5)[0] == "escalate"
+    assert gate.stats["model_calls_saved"] == 2
+    assert (gate.stats["declined"], gate.stats["sent"], gate.stats["escalated"]) == (1, 1, 1)
+
+def test_disabled_gate_escalates_everything():
+    gate = ProactiveGate(enabled=False)
+    assert gate.evaluate(0.5, 23, 0.0, 0.0) == ("escalate", None)
+    assert gate.stats["model_calls_saved"] == 0
+
+def test_score_increases_with_idle_time():
+    assert score_features(1, 10, 0.5, 0.5)[0] < score_features(10, 10, 0.5, 0.5)[0]
+
+def test_user_without_history_is_not_sent_directly():
+    gate = ProactiveGate(low=0.35, high=0.85)
+    for hour in range(24):
+        verdict, score = gate.evaluate(None, hour, None, None)
+        assert verdict == "escalate", hour
+        assert score < 0.85
+    # 没有数据的特征都记为 0.5
+    assert score_features(None, 10, None, None)[1] == {"idle": 0.5, "time_of_day": 1.0, "reply": 0.5, "acceptance": 0.5}
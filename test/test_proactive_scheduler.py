@@ -0,0 +1,87 @@
+import os
+import sys
+import random
+from datetime import datetime
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.proactive_scheduler import ProactiveScheduler, CHINA_TZ
+
+def at(hour, minute=0, day=1):
+    return CHINA_TZ.localize(datetime(2024, 1, day, hour, minute))
+
+def make_scheduler(tmp_path):
+    return ProactiveScheduler(path=str(tmp_path / "proactive_state.json"), active_hours="7-24")
+
+def test_pop_due_returns_only_users_whose_plan_has_come(tmp_path):
+    scheduler = make_scheduler(tmp_path)
+    scheduler.set_plans("1", [{"time": at(9), "reason": "早上"}, {"time": at(20), "reason": "晚上"}])
+    scheduler.set_plans("2", [{"time": at(12), "reason": "中午"}])
+    assert scheduler.next_wake() == at(9)
+    assert scheduler.pop_due(at(8)) == []
+    assert scheduler.pop_due(at(9, 30)) == ["1"]
+    assert scheduler.next_due("1") == at(20)
+    assert scheduler.pop_due(at(13)) == ["2"]
+    assert scheduler.next_due("2") is None
+    assert [plan["reason"] for plan in scheduler.plans("1", at(13))] == ["晚上"]
+
+def test_recent_activity_postpones_the_next_check(tmp_path):
+    scheduler = make_scheduler(tmp_path)
+    scheduler.set_plans("1", [{"time": at(9), "reason": ""}, {"time": at(15), "reason": ""}])
+    # 8:30 刚聊过天，9 点的规划不到最小空闲时间，顺延到下一个规划时间
+    scheduler.record_chat("1", at(8, 30))
+    assert scheduler.next_due("1") == at(15)
+    assert scheduler.pop_due(at(10)) == []
+    # 14 点刚发过主动消息，15 点的规划不到最小间隔，今天不再检查
+    scheduler.record_proactive("1", at(14))
+    assert scheduler.next_due("1") is None
+    assert scheduler.next_wake() is None
+
+def test_state_survives_restart(tmp_path):
+    scheduler = make_scheduler(tmp_path)
+    scheduler.set_plans("1", [{"time": at(18), "reason": "晚上"}])
+    scheduler.record_chat("1", at(10))
+    scheduler.record_proactive("1", at(11))
+
+    restored = make_scheduler(tmp_path)
+    restored.load()
+    assert restored.last_chat("1") == at(10)
+    assert restored.last_proactive("1") == at(11)
+    assert restored.next_due("1") == at(18)
+
+def test_daily_plans_avoid_quiet_hours(tmp_path):
+    scheduler = make_scheduler(tmp_path)
+    rng = random.Random(0)
+    plans = scheduler.generate_daily_plans(at(3), count=5, rng=rng)
+    assert len(plans) == 5
+    assert all(at(7) <= plan["time"] < at(0, day=2) for plan in plans)
+    late = scheduler.generate_daily_plans(at(23, 55), count=2, rng=rng)
+    assert all(at(7, day=2) <= plan["time"] for plan in late)
+    assert scheduler.next_active_time(at(2).timestamp()) == at(7).timestamp()
+
+def test_acceptance_rate_tracks_replies_to_proactive_messages(tmp_path):
+    scheduler = make_scheduler(tmp_path)
+    assert scheduler.acceptance_rate("1", at(8)) == 0.5
+    scheduler.record_proactive("1", at(8))
+    scheduler.record_chat("1", at(9))
+    assert scheduler.acceptance_rate("1", at(9)) == 1.0
+    # 第二条没有回复，下一条发出时记为未回复
+    scheduler.record_proactive("1", at(12))
+    scheduler.record_proactive("1", at(15))
+    assert scheduler.acceptance_rate("1", at(16)) == 0.5
+    # 超过回复窗口仍未回复也算作未回复
+    assert scheduler.acceptance_rate("1", at(23)) == 1 / 3
+
+def test_frequent_chats_do_not_grow_the_heap(tmp_path):
+    scheduler = make_scheduler(tmp_path)
+    scheduler.set_plans("1", [{"time": at(9), "reason": ""}, {"time": at(15), "reason": ""}])
+    for minute in range(30):
+        scheduler.record_chat("1", at(8, 30 + minute))
+    # 下一次检查时间没有变化，不再压入新的条目
+    assert len(scheduler._heap) == 2
+    for i in range(1000):
+        scheduler.record_chat("1", at(7) if i % 2 else at(8, 30))
+    # 时间反复变化时过期的条目会被清理掉
+    assert len(scheduler._heap) <= 2 * len(scheduler._due) + 65
+    assert scheduler.next_due("1") == at(9)
+    assert scheduler.pop_due(at(10)) == ["1"]
+    assert scheduler.next_due("1") == at(15)
@@ -0,0 +1,62 @@
+import os
+import sys
+from collections import defaultdict
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.side_conversation import SideConversationPool
+
+class FakeRobot:
+    def __init__(self):
+        self.conversation = defaultdict(list)
+        self.tokens_usage = defaultdict(int)
+        self.current_tokens = defaultdict(int)
+
+    def add_to_conversation(self, message, role, convo_id):
+        self.conversation[convo_id].append({"role": role, "content": message})
+        self.tokens_usage[convo_id] += len(message)
+        self.current_tokens[convo_id] += len(message)
+
+def test_side_conversations_are_cleaned_up_and_reused():
+    robot = FakeRobot()
+    robot.add_to_conversation("hi", "user", "1")
+    pool = SideConversationPool(pool_size=2)
+
+    for _ in range(100):
+        with pool.acquire(robot) as convo_id:
+            assert robot.conversation[convo_id] == []
+            robot.add_to_conversation("prompt", "user", convo_id)
+            assert pool.live == 1
+    assert pool.live == 0
+    assert pool.created == 1
+    assert set(robot.conversation) == {"1"}
+    assert set(robot.tokens_usage) == {"1"}
+
+def test_side_conversation_is_released_on_error():
+    robot = FakeRobot()
+    pool = SideConversationPool()
+    try:
+        with pool.acquire(robot) as convo_id:
+            robot.add_to_conversation("prompt", "user", convo_id)
+            raise RuntimeError("model failed")
+    except RuntimeError:
+        pass
+    assert pool.stats() == {"live": 0, "idle": 1, "created": 1}
+    assert dict(robot.conversation) == {}
+
+def test_concurrent_side_conversations_get_distinct_ids():
+    robot = FakeRobot()
+    pool = SideConversationPool(pool_size=1)
+    with pool.acquire(robot) as first, pool.acquire(robot) as second:
+        assert first != second
+        assert pool.live == 2
+    assert pool.stats() == {"live": 0, "idle": 1, "created": 2}
+
+def test_idle_ids_are_shared_by_robots_of_the_same_engine():
+    pool = SideConversationPool()
+    for _ in range(10):
+        robot = FakeRobot()
+        with pool.acquire(robot) as convo_id:
+            robot.add_to_conversation("prompt", "user", convo_id)
+        assert dict(robot.conversation) == {}
+    # 回收的机器人不会在池中留下各自的条目
+    assert pool.stats() == {"live": 0, "idle": 1, "created": 1}
@@ -0,0 +1,187 @@
+import os
+import sys
+import json
+import threading
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.storage import JsonFileStorage, SQLiteStorage, migrate
+
+def test_sqlite_memories_are_updated_row_by_row(tmp_path):
+    storage = SQLiteStorage(str(tmp_path / "storage.db"))
+    storage.upsert_memory("1", {"id": 1, "content": "a", "importance": 3}, "t1")
+    storage.upsert_memory("1", {"id": 2, "content": "b", "importance": 1}, "t2")
+    storage.upsert_memory("1", {"id": 1, "content": "c", "importance": 4}, "t3")
+    assert storage.delete_memory("1", 2, "t4")
+    assert not storage.delete_memory("1", 2, "t5")
+    data = storage.load_memories("1")
+    assert data["memories"] == [{"id": 1, "content": "c", "importance": 4}]
+    assert data["last_updated"] == "t5"
+
+def test_sqlite_user_config_drops_removed_keys(tmp_path):
+    storage = SQLiteStorage(str(tmp_path / "storage.db"))
+    storage.save_user_config("1", {"language": "English", "engine": "gpt-4o"})
+    storage.save_user_config("1", {"language": "Chinese"})
+    assert storage.load_user_config("1") == {"language": "Chinese"}
+    storage.save_user_config("1", {})
+    assert storage.load_user_config("1") == {}
+
+def test_sqlite_conversation_turns(tmp_path):
+    storage = SQLiteStorage(str(tmp_path / "storage.db"))
+    for i in range(5):
+        storage.append_turn("chat", {"role": "user", "content": str(i)})
+    assert [turn["content"] for turn in storage.load_turns("chat", limit=2)] == ["3", "4"]
+    storage.clear_turns("chat")
+    assert storage.load_turns("chat") == []
+
+def test_migrate_json_files_to_sqlite(tmp_path):
+    source = JsonFileStorage(config_dir=str(tmp_path / "configs"), memory_dir=str(tmp_path / "memories"))
+    os.makedirs(source.memory_dir)
+    source.save_user_config("42", {"language": "English", "engine": "gpt-4o"})
+    # 旧版本直接放在配置目录下的文件
+    with open(os.path.join(source.config_dir, "7.json"), "w") as f:
+        json.dump({"language": "Chinese"}, f)
+    memories = {"memories": [{"id": 1, "content": "hi", "importance": 2}], "last_updated": "t"}
+    source.save_memories("42", memories)
+
+    target = SQLiteStorage(str(tmp_path / "storage.db"))
+    assert migrate(source, target) == (2, 1)
+    assert target.load_user_config("42") == {"language": "English", "engine": "gpt-4o"}
+    assert target.load_user_config("7") == {"language": "Chinese"}
+    assert target.load_memories("42") == dict(memories, next_id=2)
+
+def test_sqlite_next_memory_id_survives_deletes(tmp_path):
+    storage = SQLiteStorage(str(tmp_path / "storage.db"))
+    storage.upsert_memory("1", {"id": 1, "content": "a", "importance": 3}, "t1")
+    storage.upsert_memory("1", {"id": 2, "content": "b", "importance": 3}, "t2")
+    assert storage.delete_memories("1", [2, 3], "t3") == [2]
+    assert storage.load_memories("1")["next_id"] == 3
+
+def test_sqlite_archived_memories_are_not_loaded(tmp_path):
+    storage = SQLiteStorage(str(tmp_path / "storage.db"))
+    storage.upsert_memory("1", {"id": 1, "content": "a", "importance": 1}, "t1")
+    storage.archive_memories("1", [{"id": 1, "content": "a", "importance": 1}], "capacity", "t2")
+    storage.delete_memories("1", [1], "t2")
+    assert storage.load_memories("1")["memories"] == []
+    rows = storage._execute("SELECT memory_id, reason, archived_at, data FROM memory_archive")
+    assert [(r[0], r[1], r[2], json.loads(r[3])["content"]) for r in rows] == [(1, "capacity", "t2", "a")]
+
+def test_concurrent_json_memory_writes_are_not_lost(tmp_path):
+    storage = JsonFileStorage(config_dir=str(tmp_path), memory_dir=str(tmp_path))
+    threads = [
+        threading.Thread(target=storage.upsert_memory, args=("1", {"id": i, "content": f"m{i}"}, "t"))
+        for i in range(1, 21)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    data = storage.load_memories("1")
+    assert sorted(memory["id"] for memory in data["memories"]) == list(range(1, 21))
+    assert data["next_id"] == 21
+    assert os.listdir(tmp_path) == ["memory_1.journal"]
+
+    storage.compact("1")
+    assert storage.load_memories("1") == data
+    # 紧凑编码，不留下临时文件和日志
+    assert b"\n" not in open(storage.memory_file("1"), "rb").read()
+    assert os.listdir(tmp_path) == ["memory_1.json"]
+
+def test_json_memory_journal_replay_and_compaction(tmp_path, monkeypatch):
+    import utils.storage
+    storage = JsonFileStorage(config_dir=str(tmp_path), memory_dir=str(tmp_path))
+    storage.save_memories("1", {"memories": [{"id": 1, "content": "a"}], "last_updated": "t0", "next_id": 2})
+    storage.upsert_memory("1", {"id": 2, "content": "b"}, "t1")
+    storage.upsert_memory("1", {"id": 1, "content": "a2"}, "t2")
+    assert storage.delete_memories("1", [2, 5], "t3") == [2]
+    # 崩溃时写了一半的记录
+    with open(storage.journal_file("1"), "ab") as f:
+        f.write(b'{"op": "put", "memo')
+    data = storage.load_memories("1")
+    assert data == {"memories": [{"id": 1, "content": "a2"}], "last_updated": "t3", "next_id": 3}
+
+    # 日志超过阈值后在后台合并成快照
+    monkeypatch.setattr(utils.storage, "MEMORY_JOURNAL_MAX_BYTES", 0)
+    storage.upsert_memory("1", {"id": 3, "content": "c"}, "t4")
+    storage._compactor.shutdown(wait=True)
+    assert not os.path.exists(storage.journal_file("1"))
+    assert [m["id"] for m in storage.load_memories("1")["memories"]] == [1, 3]
+
+def test_json_memory_deletes_do_not_replay_the_journal(tmp_path, monkeypatch):
+    storage = JsonFileStorage(config_dir=str(tmp_path), memory_dir=str(tmp_path))
+    for i in range(1, 6):
+        storage.upsert_memory("1", {"id": i, "content": f"m{i}"}, "t")
+    assert storage.delete_memories("1", [1, 9], "t") == [1]
+
+    def replay(user_id):
+        raise AssertionError("delete should use the cached ids")
+    monkeypatch.setattr(storage, "_replay", replay)
+    storage.upsert_memory("1", {"id": 6, "content": "m6"}, "t")
+    assert storage.delete_memories("1", [1, 2, 6], "t") == [2, 6]
+    # 没有匹配的记忆时不追加日志，版本不变
+    version, size = storage.memory_version("1"), os.path.getsize(storage.journal_file("1"))
+    assert not storage.delete_memory("1", 2, "t")
+    assert storage.delete_memories("1", [2, 9], "t") == []
+    assert (storage.memory_version("1"), os.path.getsize(storage.journal_file("1"))) == (version, size)
+    monkeypatch.undo()
+    assert sorted(memory["id"] for memory in storage.load_memories("1")["memories"]) == [3, 4, 5]
+
+    # 文件被其他进程修改后缓存失效
+    storage.save_memories("1", {"memories": [{"id": 7, "content": "m7"}], "last_updated": "t", "next_id": 8})
+    other = JsonFileStorage(config_dir=str(tmp_path), memory_dir=str(tmp_path))
+    other.upsert_memory("1", {"id": 8, "content": "m8"}, "t")
+    assert storage.delete_memories("1", [8], "t") == [8]
+
+def test_json_memory_version_survives_compaction(tmp_path):
+    storage = JsonFileStorage(config_dir=str(tmp_path), memory_dir=str(tmp_path))
+    storage.upsert_memory("1", {"id": 1, "content": "a"}, "t1")
+    storage.upsert_memory("1", {"id": 2, "content": "b"}, "t2")
+    version = storage.memory_version("1")
+    data = storage.load_memories("1")
+    journal = open(storage.journal_file("1"), "rb").read()
+
+    storage.compact("1")
+    assert storage.memory_version("1") == version
+    assert storage.load_memories("1") == data
+    storage.upsert_memory("1", {"id": 3, "content": "c"}, "t3")
+    assert storage.memory_version("1") != version
+
+    # 合并写完快照后崩溃，旧的日志还在：快照已经包含的记录不会再被重放
+    storage.delete_memories("1", [3], "t4")
+    storage.compact("1")
+    with open(storage.journal_file("1"), "wb") as f:
+        f.write(journal)
+    assert storage.load_memories("1")["memories"] == [{"id": 1, "content": "a"}, {"id": 2, "content": "b"}]
+
+def test_add_turn_persists_off_the_event_loop(tmp_path, monkeypatch):
+    import asyncio
+    import utils.storage
+    from utils.storage import add_turn, restore_conversation, clear_conversation
+
+    storage = SQLiteStorage(str(tmp_path / "storage.db"))
+    threads = []
+    append_turn, clear_turns = storage.append_turn, storage.clear_turns
+    monkeypatch.setattr(storage, "append_turn", lambda *args: threads.append(threading.current_thread().name) or append_turn(*args))
+    monkeypatch.setattr(storage, "clear_turns", lambda *args: threads.append(threading.current_thread().name) or clear_turns(*args))
+    monkeypatch.setattr(utils.storage, "_storage", storage)
+
+    class Robot:
+        def __init__(self):
+            self.conversation = {}
+
+        # 和 aient 的签名一致：add_to_conversation(message, role, convo_id="default", ...)
+        def add_to_conversation(self, message, role, convo_id="default"):
+            self.conversation.setdefault(convo_id, []).append({"role": role, "content": message})
+
+    async def main():
+        await add_turn(Robot(), {"role": "user", "content": "hi"}, "chat")
+        await add_turn(Robot(), {"role": "assistant", "content": "hello"}, "chat")
+        robot = Robot()
+        assert await restore_conversation(robot, "chat") == 2
+        await clear_conversation("chat")
+        assert await restore_conversation(Robot(), "chat") == 0
+        return robot
+
+    robot = asyncio.run(main())
+    assert robot.conversation["chat"] == [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "hello"}]
+    assert "default" not in robot.conversation
+    assert len(threads) == 3 and all(name.startswith("memory-io") for name in threads)
@@ -0,0 +1,62 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.stream_splitter import StreamSplitter
+
+def split(text, limit, step=None):
+    splitter = StreamSplitter(limit)
+    pages = []
+    step = step or len(text)
+    for i in range(0, len(text), step):
+        pages.extend(splitter.feed(text[i:i + step]))
+    pages.append(splitter.finish())
+    return pages
+
+def test_short_text_is_not_split():
+    assert split("hello\n\nworld", 100) == ["hello\n\nworld"]
+
+def test_split_at_paragraph_boundary():
+    text = "a" * 60 + "\n\n" + "b" * 60
+    pages = split(text, 100)
+    assert pages == ["a" * 60, "b" * 60]
+
+def test_chunk_size_does_not_change_pages():
+    text = "".join(f"第{i}段，这里是一些内容。\n\n```python\nprint({i})\n```\n\n" for i in range(50))
+    expected = split(text, 200)
+    assert split(text, 200, step=1) == expected
+    assert split(text, 200, step=13) == expected
+    assert all(len(page) <= 200 for page in expected)
+
+def test_code_block_is_closed_and_reopened():
+    text = "```python\n" + "x = 1\n" * 40 + "```\n"
+    pages = split(text, 100, step=5)
+    assert len(pages) > 1
+    for page in pages[:-1]:
+        assert page.startswith("```python\n")
+        assert page.endswith("\n```")
+    assert pages[-1].startswith("```python\n")
+    body = "".join(page[len("```python\n"):].replace("\n```", "") for page in pages)
+    assert body.count("x = 1") == 40
+
+def test_nested_fence_does_not_close_outer_block():
+    inner = "```python\nprint(1)\n```\n"
+    text = "````markdown\n" + inner * 10 + "````\n\nafter"
+    pages = split(text, 80, step=3)
+    for page in pages[:-1]:
+        if page.startswith("````markdown"):
+            assert page.endswith("\n````")
+    assert pages[-1].endswith("after")
+
+def test_cjk_text_without_newlines_splits_at_sentence_end():
+    text = "今天天气很好，我们一起去公园散步吧。" * 20
+    pages = split(text, 100, step=7)
+    assert "".join(pages) == text
+    for page in pages[:-1]:
+        assert len(page) <= 100
+        assert page.endswith("。")
+
+def test_text_without_any_boundary_is_hard_cut():
+    text = "字" * 250
+    pages = split(text, 100)
+    assert [len(page) for page in pages] == [100, 100, 50]
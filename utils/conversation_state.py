@@ -0,0 +1,140 @@
+import logging
+import threading
+from collections import deque
+
+# 主动消息时系统代替用户加入对话的虚拟消息
+SYNTHETIC_USER_PROMPTS = ("我想和你聊聊天", "我想继续和你聊天", "我希望你主动和我聊天")
+# 混进对话里的系统提示词片段，不算真实的对话内容
+PROMPT_MARKERS = (
+    "# 你的角色基本信息",
+    "当前日期和时间",
+    "# 知识与能力设定",
+    "# 语气与风格",
+    "# 作为女朋友的部分",
+    "# 用户的信息",
+)
+# 每个对话保留多少条最近的真实消息，供主动消息生成上下文和计算回复比例
+RECENT_MESSAGES = 20
+
+def message_text(message):
+    """消息的文本内容，多模态消息只取其中的文本部分"""
+    content = message.get("content", "")
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return ""
+
+def is_synthetic(message):
+    """是否是系统代替用户加入的虚拟消息或者命令"""
+    text = message_text(message)
+    return message.get("role") == "user" and (
+        text.startswith("/") or any(prompt in text for prompt in SYNTHETIC_USER_PROMPTS)
+    )
+
+def is_real_turn(message):
+    """是否是用户或机器人真实说过的话：不是系统消息、虚拟消息、提示词，也不是空消息"""
+    if message.get("role") not in ("user", "assistant") or is_synthetic(message):
+        return False
+    text = message_text(message)
+    if isinstance(message.get("content"), str) and not text.strip():
+        return False
+    return not any(marker in text for marker in PROMPT_MARKERS)
+
+def _timestamp(message):
+    try:
+        return float(message.get("timestamp"))
+    except (TypeError, ValueError):
+        return None
+
+class ConversationState:
+    """一个对话的摘要，每加入一条消息更新一次，不需要重新扫描历史
+
+    属性：
+        last_role: 最后一条消息的角色
+        last_synthetic: 最后一条消息是否是虚拟消息
+        last_user_time: 最后一条真实用户消息的时间戳
+        trailing_assistant: 最后一条真实用户消息之后机器人说了几条
+        last_bot_message / last_bot_time: 最后一条机器人消息的内容和时间戳
+        recent: 最近的真实消息（不含虚拟消息、系统消息和提示词）
+    """
+
+    __slots__ = ("last_role", "last_synthetic", "last_user_time", "trailing_assistant",
+                 "last_bot_message", "last_bot_time", "recent", "recent_user_count")
+
+    def __init__(self):
+        self.last_role = None
+        self.last_synthetic = False
+        self.last_user_time = None
+        self.trailing_assistant = 0
+        self.last_bot_message = None
+        self.last_bot_time = None
+        self.recent = deque(maxlen=RECENT_MESSAGES)
+        self.recent_user_count = 0
+
+    def add(self, message):
+        role = message.get("role")
+        if role == "system":
+            return
+        synthetic = is_synthetic(message)
+        self.last_role = role
+        self.last_synthetic = synthetic
+        if role == "user" and not synthetic:
+            self.last_user_time = _timestamp(message)
+            self.trailing_assistant = 0
+        elif role == "assistant":
+            self.trailing_assistant += 1
+            self.last_bot_message = message_text(message)
+            self.last_bot_time = _timestamp(message)
+        if is_real_turn(message):
+            if len(self.recent) == self.recent.maxlen and self.recent[0].get("role") == "user":
+                self.recent_user_count -= 1
+            self.recent.append(message)
+            if role == "user":
+                self.recent_user_count += 1
+
+    @property
+    def awaiting_reply(self):
+        """最后一条是真实的用户消息，用户正在等机器人回复"""
+        return self.last_role == "user" and not self.last_synthetic
+
+    @property
+    def reply_ratio(self):
+        """最近的真实消息中用户消息所占的比例，没有消息时返回 None"""
+        if not self.recent:
+            return None
+        return self.recent_user_count / len(self.recent)
+
+class ConversationTracker:
+    """按对话ID维护 ConversationState，由 add_turn() 等加入消息的地方调用 record()"""
+
+    def __init__(self):
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def record(self, convo_id, message):
+        convo_id = str(convo_id)
+        with self._lock:
+            state = self._states.get(convo_id)
+            if state is None:
+                state = self._states[convo_id] = ConversationState()
+            state.add(message)
+
+    def reset(self, convo_id):
+        with self._lock:
+            self._states.pop(str(convo_id), None)
+
+    def get(self, convo_id, messages=None):
+        """返回对话的摘要；还没有记录过这个对话但提供了 messages 时用它建立一次"""
+        convo_id = str(convo_id)
+        with self._lock:
+            state = self._states.get(convo_id)
+            if state is None and messages:
+                state = ConversationState()
+                for message in messages:
+                    state.add(message)
+                self._states[convo_id] = state
+                logging.debug(f"从 {len(messages)} 条历史消息建立对话 {convo_id} 的状态")
+            return state
+
+conversation_tracker = ConversationTracker()
@@ -20,7 +20,8 @@ def ban_message(update, convo_id):
 def Authorization(func):
     async def wrapper(*args, **kwargs):
         update, context = args[:2]
-        _, _, _, chatid, _, _, _, message_thread_id, convo_id, _, _, _ = await GetMesageInfo(update, context, voice=False)
+        info = await GetMesageInfo(update, context)
+        chatid, message_thread_id, convo_id = info.chatid, info.message_thread_id, info.convo_id
         if config.BLACK_LIST and chatid in config.BLACK_LIST:
             message = ban_message(update, convo_id)
             await context.bot.send_message(chat_id=chatid, message_thread_id=message_thread_id, text=message, parse_mode='MarkdownV2')
@@ -38,7 +39,8 @@ def Authorization(func):
 def GroupAuthorization(func):
     async def wrapper(*args, **kwargs):
         update, context = args[:2]
-        _, _, _, chatid, _, _, _, message_thread_id, convo_id, _, _, _ = await GetMesageInfo(update, context, voice=False)
+        info = await GetMesageInfo(update, context)
+        chatid, message_thread_id, convo_id = info.chatid, info.message_thread_id, info.convo_id
         if config.GROUP_LIST == None:
             return await func(*args, **kwargs)
         if update.effective_chat == None or chatid[0] != "-":
@@ -56,7 +58,8 @@ def GroupAuthorization(func):
 def AdminAuthorization(func):
     async def wrapper(*args, **kwargs):
         update, context = args[:2]
-        _, _, _, chatid, _, _, _, message_thread_id, convo_id, _, _, _ = await GetMesageInfo(update, context, voice=False)
+        info = await GetMesageInfo(update, context)
+        chatid, message_thread_id, convo_id = info.chatid, info.message_thread_id, info.convo_id
         if config.ADMIN_LIST == None:
             return await func(*args, **kwargs)
         if (str(update.effective_user.id) not in config.ADMIN_LIST):
@@ -69,7 +72,8 @@ def AdminAuthorization(func):
 def APICheck(func):
     async def wrapper(*args, **kwargs):
         update, context = args[:2]
-        _, _, _, chatid, _, _, _, message_thread_id, convo_id, _, _, _ = await GetMesageInfo(update, context, voice=False)
+        info = await GetMesageInfo(update, context)
+        chatid, message_thread_id, convo_id = info.chatid, info.message_thread_id, info.convo_id
         from config import (
             Users,
             get_robot,
@@ -0,0 +1,143 @@
+import os
+import time
+import asyncio
+import logging
+
+# 同一个聊天两次编辑消息之间的最小间隔（毫秒），群聊的限制更严格
+STREAM_EDIT_INTERVAL = int(os.environ.get('STREAM_EDIT_INTERVAL', '1000'))
+STREAM_EDIT_GROUP_INTERVAL = int(os.environ.get('STREAM_EDIT_GROUP_INTERVAL', '3000'))
+# 所有聊天合计每秒最多编辑的次数
+STREAM_EDIT_GLOBAL_RATE = float(os.environ.get('STREAM_EDIT_GLOBAL_RATE', '20'))
+
+class GlobalEditLimiter:
+    """所有聊天共享的令牌桶，限制全局编辑频率"""
+
+    def __init__(self, rate):
+        self.rate = max(rate, 0.1)
+        self.capacity = max(self.rate, 1.0)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+global_edit_limiter = GlobalEditLimiter(STREAM_EDIT_GLOBAL_RATE)
+
+# 聊天ID -> 该聊天下一次允许编辑的时间，同一聊天内的多条回复共享这个预算
+chat_next_edit_time = {}
+# chat_next_edit_time 超过这么多条时清理已经过去的时间，过去的时间和没有记录等价
+CHAT_EDIT_TIME_PRUNE_SIZE = 1024
+
+def _prune_chat_edit_times(now):
+    """删除下一次允许编辑的时间已经过去的聊天"""
+    for chat_id in [chat_id for chat_id, next_time in chat_next_edit_time.items() if next_time <= now]:
+        del chat_next_edit_time[chat_id]
+
+class StreamEditScheduler:
+    """流式回复的消息编辑调度器
+
+    submit() 只记录最新的文本，由后台任务按时间预算编辑消息：
+    每个聊天最多每 interval 秒编辑一次，并受全局令牌桶限制。
+    等待期间到达的文本会被合并，每次编辑总是显示最新内容。
+    render 在真正发送前才调用，被合并掉的中间文本不会被渲染。
+    """
+
+    def __init__(self, chat_id, message_id, edit, render=None, interval=None, group=False):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.edit = edit
+        self.render = render
+        if interval is None:
+            interval = (STREAM_EDIT_GROUP_INTERVAL if group else STREAM_EDIT_INTERVAL) / 1000
+        self.interval = interval
+        self.last_sent = None
+        self.edit_count = 0
+        self._pending = None
+        self._task = None
+        self._sending = False
+
+    def submit(self, text, rendered=False):
+        """提交最新的待显示文本，不等待编辑完成
+
+        参数：
+            text: 待显示的文本
+            rendered: 文本是否已经渲染好，为 True 时不再调用 render
+        """
+        self._pending = (text, rendered)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _wait_for_slot(self):
+        # 先预订时间槽再等待，同一聊天里并发的多条回复会依次排开
+        now = time.monotonic()
+        slot = max(chat_next_edit_time.get(self.chat_id, 0), now)
+        if self.chat_id not in chat_next_edit_time and len(chat_next_edit_time) >= CHAT_EDIT_TIME_PRUNE_SIZE:
+            _prune_chat_edit_times(now)
+        chat_next_edit_time[self.chat_id] = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+        await global_edit_limiter.acquire()
+
+    async def _send(self, text, wait=True, rendered=False):
+        if self.render and not rendered:
+            text = self.render(text)
+        if not text or text == self.last_sent:
+            return
+        if wait:
+            await self._wait_for_slot()
+        self._sending = True
+        try:
+            await self.edit(self.message_id, text)
+            self.last_sent = text
+            self.edit_count += 1
+        except Exception as e:
+            logging.warning(f"流式编辑消息失败: {type(e)} {str(e)}")
+        finally:
+            self._sending = False
+
+    async def _run(self):
+        while self._pending is not None:
+            # 先等到可以编辑的时间点，再取最新的文本，等待期间的中间结果直接被覆盖
+            await self._wait_for_slot()
+            if self._pending is None:
+                break
+            (text, rendered), self._pending = self._pending, None
+            await self._send(text, wait=False, rendered=rendered)
+
+    async def close(self):
+        """丢弃尚未发送的文本并等待正在进行的编辑结束，之后由调用方做最终的编辑"""
+        self._pending = None
+        if self._task is not None and not self._task.done():
+            if not self._sending:
+                # 还在等待时间槽，没有必要再等下去
+                self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+        self._task = None
+
+    async def reset(self, message_id):
+        """切换到新的消息继续编辑，例如长回复拆分后发送了新的一页"""
+        await self.close()
+        self.message_id = message_id
+        self.last_sent = None
+
+    async def flush(self, text=None, rendered=False):
+        """立即把最新文本（或指定文本）编辑到消息上，用于最终输出"""
+        if text is None and self._pending is not None:
+            text, rendered = self._pending
+        await self.close()
+        if text is not None:
+            # 最终输出只受全局限速，不再排队等待本聊天的下一个时间槽
+            await global_edit_limiter.acquire()
+            await self._send(text, wait=False, rendered=rendered)
@@ -0,0 +1,129 @@
+FENCE = "```"
+# 段落之间的分隔
+BLOCK_SEPARATOR = "\n\n"
+
+def close_inline_code(line):
+    """行内反引号数量为奇数时补一个反引号"""
+    if line.replace(FENCE, "").count("`") % 2 != 0:
+        return "`"
+    return ""
+
+class IncrementalMarkdownRenderer:
+    """流式回复的增量 Markdown -> MarkdownV2 渲染器
+
+    流式输出时文本只会在末尾追加。渲染器按代码块之外的空行把文本切成段落，
+    段落连同它后面的空行一起固定，已经完整的段落只转义一次并缓存，
+    之后每次渲染只重新转义最后一个段落之后的尾部。
+    转义一个段落时在前面补上段落分隔的空行，标题、列表、代码块等依赖前后换行的规则
+    和转义全文时一样生效，拼接起来的结果与转义全文一致。
+    代码块围栏的奇偶状态也是增量维护的，不需要每次扫描全文。
+
+    参数：
+        escape: 转义函数，例如 lambda text: md2tgmd.escape(text, italic=False)
+        transform: 可选，转义前对每一段文本做的替换（例如 claude_replace）
+    """
+
+    def __init__(self, escape, transform=None):
+        self.escape = escape
+        self.transform = transform
+        self.reset()
+
+    def reset(self):
+        # 已经固定的源文本前缀及其转义结果
+        self._stable_source = ""
+        self._stable_escaped = ""
+        # 下一段的起始位置、下一行待扫描的位置，以及扫描到的位置是否在代码块内
+        self._block_start = 0
+        self._scan_pos = 0
+        self._in_fence = False
+        # 当前段落之后是否已经出现了代码块外的空行
+        self._after_blank = False
+        # 等待闭合的代码块的起始位置，它前面的段落暂不固定
+        self._fence_start = None
+        self._text = ""
+
+    def _escape_block(self, block, first):
+        if not block:
+            return ""
+        if self.transform:
+            block = self.transform(block)
+        if first:
+            return self.escape(block)
+        # 前一段以空行结尾，补上同样的分隔再转义，然后去掉补上的部分
+        escaped = self.escape(BLOCK_SEPARATOR + block)
+        if escaped.startswith(BLOCK_SEPARATOR):
+            return escaped[len(BLOCK_SEPARATOR):]
+        return escaped.lstrip("\n")
+
+    def _fix_block(self, end, block=None):
+        if block is None:
+            block = self._text[self._block_start:end]
+        self._stable_escaped += self._escape_block(block, first=self._block_start == 0)
+        self._block_start = end
+
+    def feed(self, text):
+        """更新源文本，扫描新增的完整行并固定已经完整的段落"""
+        if len(text) < len(self._stable_source) or not text.startswith(self._stable_source):
+            # 文本不是在末尾追加（例如长回复被拆分后重新开始），从头开始
+            self.reset()
+        self._text = text
+
+        while True:
+            line_end = text.find("\n", self._scan_pos)
+            if line_end == -1:
+                break
+            line = text[self._scan_pos:line_end]
+            if not line.strip() and not self._in_fence:
+                # 代码块外的空行：之前的内容已经是完整的段落
+                self._after_blank = text[self._block_start:self._scan_pos].strip() != ""
+            else:
+                is_fence = line.strip().startswith(FENCE)
+                if self._after_blank:
+                    self._after_blank = False
+                    if line.lstrip(" ").startswith(FENCE):
+                        # 转义全文时，闭合的代码块前面连续的换行会被合并成一个空行，
+                        # 要等代码块闭合之后才能确定上一段的转义结果
+                        self._fence_start = self._scan_pos
+                    else:
+                        # 空行之后出现了新内容，上一段连同它后面的空行一起固定
+                        self._fix_block(self._scan_pos)
+                if is_fence:
+                    self._in_fence = not self._in_fence
+                    if not self._in_fence and self._fence_start is not None:
+                        block = text[self._block_start:self._fence_start].rstrip("\n") + BLOCK_SEPARATOR
+                        self._fix_block(self._fence_start, block)
+                        self._fence_start = None
+            self._scan_pos = line_end + 1
+        self._stable_source = text[:self._block_start]
+
+    def _in_fence_at_end(self):
+        last_line = self._text[self._scan_pos:]
+        if last_line.strip().startswith(FENCE):
+            return not self._in_fence
+        return self._in_fence
+
+    def close_markup(self, text):
+        """给未闭合的行内代码和代码块补上结束标记"""
+        self.feed(text)
+        last_line = text[text.rfind("\n") + 1:]
+        text = text + close_inline_code(last_line)
+        if self._in_fence_at_end():
+            text = text + "\n" + FENCE
+        return text
+
+    def render(self, text):
+        """返回整段文本的转义结果，只有尾部会被重新转义"""
+        self.feed(text)
+        tail = text[self._block_start:]
+        last_line = text[text.rfind("\n") + 1:]
+        tail = tail + close_inline_code(last_line)
+        if self._in_fence_at_end():
+            tail = tail + "\n" + FENCE
+        return self._stable_escaped + self._escape_block(tail, first=self._block_start == 0)
+
+    def render_full(self, text):
+        """不使用缓存，转义整段文本，用于定稿的最后一次编辑"""
+        text = self.close_markup(text)
+        if self.transform:
+            text = self.transform(text)
+        return self.escape(text)
@@ -3,7 +3,7 @@ import traceback
 import json
 from telegram import Update
 from telegram.ext import ContextTypes
-from utils.memory_system_functions import FunctionCallingMemorySystem
+from utils.memory_system_functions import call_memory_function
 
 async def list_new_memories(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """列出用户的所有记忆（使用新的基于函数调用的记忆系统）"""
@@ -18,9 +18,8 @@ async def list_new_memories(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_to_message_id=update.message.message_id
         )
         
-        # 创建记忆系统实例
-        memory_system = FunctionCallingMemorySystem(user_id)
-        result = memory_system.process_function_call("list_memories", {"max_results": 20, "min_importance": 1})
+        # 在记忆线程池中读取记忆列表
+        result = await call_memory_function(user_id, "list_memories", {"max_results": 20, "min_importance": 1})
         
         if result["status"] == "success" and result["memories"]:
             # 格式化记忆列表
@@ -107,9 +106,8 @@ async def add_new_memory(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_to_message_id=update.message.message_id
         )
         
-        # 创建记忆系统实例并添加记忆
-        memory_system = FunctionCallingMemorySystem(user_id)
-        result = memory_system.process_function_call("create_memory", {
+        # 在记忆线程池中添加记忆
+        result = await call_memory_function(user_id, "create_memory", {
             "content": content,
             "importance": importance,
             "tags": []  # 暂不支持通过命令添加标签
@@ -164,9 +162,8 @@ async def delete_new_memory(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_to_message_id=update.message.message_id
         )
         
-        # 创建记忆系统实例并删除记忆
-        memory_system = FunctionCallingMemorySystem(user_id)
-        result = memory_system.process_function_call("delete_memory", {"memory_id": memory_id})
+        # 在记忆线程池中删除记忆
+        result = await call_memory_function(user_id, "delete_memory", {"memory_id": memory_id})
         
         if result["status"] == "success":
             await context.bot.edit_message_text(
@@ -0,0 +1,267 @@
+import os
+import math
+import zlib
+import base64
+import logging
+from array import array
+from collections import Counter
+
+from utils.memory_index import tokenize
+
+try:
+    import numpy as np
+except ImportError:
+    # 没有安装 numpy 时用稀疏向量和纯 Python 计算相似度，结果相同，只是更慢
+    np = None
+
+# 默认的哈希向量维度
+MEMORY_EMBEDDING_DIM = int(os.environ.get('MEMORY_EMBEDDING_DIM', '512'))
+# 余弦相似度低于这个值的记忆不认为和当前消息相关
+MEMORY_SEMANTIC_MIN_SCORE = float(os.environ.get('MEMORY_SEMANTIC_MIN_SCORE', '0.1'))
+
+def hashing_embedding(text, dim=MEMORY_EMBEDDING_DIM):
+    """不依赖网络和模型的本地向量：对词项做带符号的特征哈希
+
+    词项与检索索引相同（英文单词、中文二元组和单字），词频取对数，
+    结果做 L2 归一化，两个向量的点积就是余弦相似度。
+    """
+    vector = [0.0] * dim
+    for term, count in Counter(tokenize(text, unigrams=True)).items():
+        digest = zlib.crc32(term.encode("utf-8"))
+        sign = 1.0 if digest & 0x80000000 else -1.0
+        vector[digest % dim] += sign * (1 + math.log(count))
+    norm = math.sqrt(sum(value * value for value in vector))
+    if norm:
+        vector = [value / norm for value in vector]
+    return vector
+
+# 当前使用的向量函数：输入文本，返回固定维度的向量
+_embedding_function = hashing_embedding
+# 向量函数的名称，随向量一起保存，换了向量函数之后保存的向量不再使用
+_embedding_model = f"hashing-{MEMORY_EMBEDDING_DIM}"
+
+def set_embedding_function(function, model=None):
+    """替换向量函数，例如换成本地的句向量模型；已经建立的语义索引需要重新建立
+
+    参数：
+        function: 向量函数，为 None 时恢复默认的哈希向量
+        model: 向量函数的名称，默认取函数名；保存的向量只有名称相同时才会被复用
+    """
+    global _embedding_function, _embedding_model
+    if function is None:
+        _embedding_function = hashing_embedding
+        _embedding_model = f"hashing-{MEMORY_EMBEDDING_DIM}"
+        return
+    _embedding_function = function
+    _embedding_model = model or f"{function.__module__}.{function.__qualname__}"
+
+def embed(text):
+    return _embedding_function(text)
+
+def content_checksum(content):
+    return zlib.crc32(content.encode("utf-8"))
+
+def _b64(values):
+    return base64.b64encode(values.tobytes()).decode("ascii")
+
+def _unb64(typecode, text):
+    values = array(typecode)
+    values.frombytes(base64.b64decode(text))
+    return values
+
+def encode_vector(vector, content):
+    """把记忆的向量编码成随记忆一起保存的记录
+
+    非零项不到一半时（例如默认的哈希向量）只保存非零项的下标和数值，否则保存整个向量，
+    数值都是 float32。记录中带有向量函数的名称和记忆内容的校验和，用来判断向量是否还有效。
+    """
+    values = vector.tolist() if hasattr(vector, "tolist") else list(vector)
+    record = {"model": _embedding_model, "crc": content_checksum(content), "dim": len(values)}
+    nonzero = [i for i, value in enumerate(values) if value]
+    if len(nonzero) * 2 < len(values):
+        record["index"] = _b64(array("I", nonzero))
+        record["value"] = _b64(array("f", (values[i] for i in nonzero)))
+    else:
+        record["value"] = _b64(array("f", values))
+    return record
+
+def decode_vector(record, content):
+    """还原保存的向量，向量函数或者记忆内容已经变化时返回 None"""
+    if not isinstance(record, dict) or record.get("model") != _embedding_model:
+        return None
+    if record.get("crc") != content_checksum(content):
+        return None
+    try:
+        values = _unb64("f", record["value"])
+        if "index" not in record:
+            return list(values)
+        vector = [0.0] * record["dim"]
+        for i, value in zip(_unb64("I", record["index"]), values):
+            vector[i] = value
+        return vector
+    except Exception as e:
+        logging.warning(f"保存的记忆向量损坏，重新计算: {str(e)}")
+        return None
+
+class SemanticIndex:
+    """单个用户记忆的向量索引
+
+    记忆在写入时计算一次向量，编码后随记忆一起保存（见 record()），
+    重新加载时直接使用保存的向量，只有缺少向量或者内容变化了的记忆才重新计算。
+    安装了 numpy 时向量按行存放在一个连续的矩阵里，
+    检索时一次矩阵乘法得到所有记忆与查询的余弦相似度；删除时把最后一行挪到空出的位置。
+    没有 numpy 时每条记忆保存稀疏向量，逐条计算点积。
+
+    参数：
+        memories: 初始的记忆列表
+        stored: 可选，保存的向量记录 {str(记忆ID): 记录}
+    """
+
+    def __init__(self, memories=(), stored=None):
+        self._rows = {}
+        self._memories = []
+        self._contents = []
+        self._records = []
+        self._matrix = None
+        self._vectors = []
+        stored = stored or {}
+        for memory in memories:
+            self.add(memory, stored.get(str(memory.get("id"))))
+
+    def __len__(self):
+        return len(self._memories)
+
+    @staticmethod
+    def _normalize(vector):
+        if np is not None:
+            vector = np.asarray(vector, dtype=np.float32)
+            norm = np.linalg.norm(vector)
+            return vector / norm if norm else vector
+        norm = math.sqrt(sum(value * value for value in vector))
+        if not norm:
+            return {}
+        return {i: value / norm for i, value in enumerate(vector) if value}
+
+    def _set_row(self, row, vector):
+        if np is None:
+            if row == len(self._vectors):
+                self._vectors.append(vector)
+            else:
+                self._vectors[row] = vector
+            return
+        if self._matrix is None:
+            self._matrix = np.zeros((16, len(vector)), dtype=np.float32)
+        elif row >= self._matrix.shape[0]:
+            # 容量不够时翻倍，避免每次新增都复制整个矩阵
+            grown = np.zeros((self._matrix.shape[0] * 2, self._matrix.shape[1]), dtype=np.float32)
+            grown[:row] = self._matrix[:row]
+            self._matrix = grown
+        self._matrix[row] = vector
+
+    def add(self, memory, stored=None):
+        """加入或更新一条记忆，stored 是保存的向量记录，仍然有效时不重新计算向量"""
+        key = id(memory)
+        content = memory.get("content", "")
+        row = self._rows.get(key)
+        if row is not None and self._contents[row] == content:
+            return
+        raw = decode_vector(stored, content) if stored is not None else None
+        record = stored if raw is not None else None
+        try:
+            if raw is None:
+                raw = embed(content)
+            vector = self._normalize(raw)
+            if record is None:
+                record = encode_vector(raw, content)
+        except Exception as e:
+            logging.error(f"计算记忆向量失败: {str(e)}")
+            return
+        if row is None:
+            row = len(self._memories)
+            self._rows[key] = row
+            self._memories.append(memory)
+            self._contents.append(content)
+            self._records.append(record)
+        else:
+            self._contents[row] = content
+            self._records[row] = record
+        self._set_row(row, vector)
+
+    # 内容没有变化时 add() 不会重新计算向量
+    update = add
+
+    def record(self, memory):
+        """返回记忆的向量记录，用于和记忆一起保存；记忆不在索引中时返回 None"""
+        row = self._rows.get(id(memory))
+        return self._records[row] if row is not None else None
+
+    def export(self):
+        """返回所有记忆的向量记录 {str(记忆ID): 记录}"""
+        return {str(memory["id"]): record for memory, record in zip(self._memories, self._records)}
+
+    def remove(self, memory):
+        row = self._rows.pop(id(memory), None)
+        if row is None:
+            return
+        last = len(self._memories) - 1
+        if row != last:
+            moved = self._memories[last]
+            self._memories[row] = moved
+            self._contents[row] = self._contents[last]
+            self._records[row] = self._records[last]
+            self._rows[id(moved)] = row
+            if np is None:
+                self._vectors[row] = self._vectors[last]
+            else:
+                self._matrix[row] = self._matrix[last]
+        self._memories.pop()
+        self._contents.pop()
+        self._records.pop()
+        if np is None:
+            self._vectors.pop()
+
+    def search(self, text, limit=5, min_importance=1, min_score=MEMORY_SEMANTIC_MIN_SCORE):
+        """返回与 text 余弦相似度最高的记忆：[(相似度, 记忆)]，按相似度从高到低排列"""
+        count = len(self._memories)
+        if not count or limit <= 0 or not text:
+            return []
+        try:
+            query = self._normalize(embed(text))
+        except Exception as e:
+            logging.error(f"计算查询向量失败: {str(e)}")
+            return []
+
+        if np is None:
+            ranked = []
+            for row, vector in enumerate(self._vectors):
+                if len(vector) > len(query):
+                    score = sum(value * vector.get(i, 0.0) for i, value in query.items())
+                else:
+                    score = sum(value * query.get(i, 0.0) for i, value in vector.items())
+                ranked.append((score, row))
+            ranked.sort(reverse=True)
+            return self._collect(ranked, limit, min_importance, min_score)
+
+        scores = self._matrix[:count] @ query
+        # 先只对得分最高的一部分排序，过滤掉重要性不够的记忆后不足 limit 条时再对全部排序
+        candidates = min(count, limit * 4)
+        while True:
+            top = np.argpartition(-scores, candidates - 1)[:candidates]
+            ranked = [(float(scores[row]), int(row)) for row in top[np.argsort(-scores[top])]]
+            results = self._collect(ranked, limit, min_importance, min_score)
+            if len(results) >= limit or candidates == count or ranked[-1][0] < min_score:
+                return results
+            candidates = count
+
+    def _collect(self, ranked, limit, min_importance, min_score):
+        results = []
+        for score, row in ranked:
+            if score < min_score:
+                break
+            memory = self._memories[row]
+            if memory.get("importance", 1) < min_importance:
+                continue
+            results.append((score, memory))
+            if len(results) >= limit:
+                break
+        return results
@@ -0,0 +1,218 @@
+import re
+import math
+import time
+import heapq
+from collections import Counter
+from operator import itemgetter
+from datetime import datetime
+
+# 中日韩文字没有空格分词，按连续字符的二元组切分
+CJK_RANGES = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"
+TOKEN_PATTERN = re.compile(f"[{CJK_RANGES}]+|[^\\W_{CJK_RANGES}]+")
+CJK_PATTERN = re.compile(f"[{CJK_RANGES}]")
+
+# BM25 参数
+BM25_K1 = 1.5
+BM25_B = 0.75
+# 按更新时间加权时，记忆的新鲜度每过多少天减半
+RECENCY_HALF_LIFE_DAYS = 30
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+def tokenize(text, unigrams=False):
+    """把文本切成词项列表
+
+    英文和数字按单词切分并转成小写；中日韩文字按相邻两个字切分，
+    单独出现的一个字作为一个词项。unigrams 为 True 时每个字也作为词项，
+    建立检索索引时使用，这样只有一个字的查询（例如“猫”）也能命中。
+    """
+    tokens = []
+    for run in TOKEN_PATTERN.findall(text.lower()):
+        if CJK_PATTERN.match(run):
+            if len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+                if unigrams:
+                    tokens.extend(run)
+        else:
+            tokens.append(run)
+    return tokens
+
+def jaccard(tokens1, tokens2):
+    """两个词项集合的 Jaccard 相似度"""
+    if not tokens1 or not tokens2:
+        return 0.0
+    return len(tokens1 & tokens2) / len(tokens1 | tokens2)
+
+class MemoryIndex:
+    """单个用户记忆的倒排索引
+
+    每条记忆以对象本身登记，索引保存它内容的词项集合（用于去重），
+    以及内容和标签的词频、长度和词项 -> {记忆: 词频} 的倒排表（用于 BM25 检索）。
+    记忆被修改后调用 update() 重新登记，删除时调用 remove()。
+    """
+
+    def __init__(self, memories=()):
+        self._memories = {}
+        # 记忆 -> (内容和标签, 内容的词项集合, 内容和标签的词频)
+        self._entries = {}
+        self._lengths = {}
+        self._updated_at = {}
+        self._postings = {}
+        self._total_length = 0
+        # 每条记忆 BM25 的长度归一化项，依赖平均长度，记忆变化后在下一次检索时重新计算
+        self._norms = None
+        for memory in memories:
+            self.add(memory)
+
+    def __len__(self):
+        return len(self._memories)
+
+    @staticmethod
+    def _signature(memory):
+        return memory.get("content", ""), tuple(memory.get("tags") or ())
+
+    @staticmethod
+    def _parse_time(memory):
+        try:
+            return datetime.strptime(memory.get("updated_at", ""), TIMESTAMP_FORMAT).timestamp()
+        except (TypeError, ValueError):
+            return None
+
+    def add(self, memory):
+        key = id(memory)
+        if key in self._memories:
+            self.remove(memory)
+        signature = self._signature(memory)
+        content_terms = frozenset(tokenize(signature[0]))
+        frequencies = Counter(tokenize(signature[0], unigrams=True))
+        for tag in signature[1]:
+            frequencies.update(tokenize(str(tag), unigrams=True))
+        length = sum(frequencies.values())
+
+        self._memories[key] = memory
+        self._entries[key] = (signature, content_terms, frequencies)
+        self._lengths[key] = length
+        self._updated_at[key] = self._parse_time(memory)
+        self._total_length += length
+        self._norms = None
+        for term, count in frequencies.items():
+            self._postings.setdefault(term, {})[key] = count
+
+    def remove(self, memory):
+        key = id(memory)
+        if self._memories.pop(key, None) is None:
+            return
+        _, _, frequencies = self._entries.pop(key)
+        self._total_length -= self._lengths.pop(key)
+        self._norms = None
+        self._updated_at.pop(key, None)
+        for term in frequencies:
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(key, None)
+                if not postings:
+                    del self._postings[term]
+
+    def update(self, memory):
+        """记忆被修改后重新登记，内容和标签没变时只刷新更新时间"""
+        key = id(memory)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == self._signature(memory):
+            self._updated_at[key] = self._parse_time(memory)
+            return
+        self.add(memory)
+
+    def find_similar(self, content, threshold=0.8, exclude=None):
+        """返回与 content 的 Jaccard 相似度大于 threshold 的最相似的一条记忆，没有时返回 None
+
+        exclude 是不参与比较的记忆，例如查找与某条已有记忆重复的其他记忆时排除它自己。
+
+        相似度大于 threshold 的记忆至少要包含 content 中 floor(threshold * n) + 1 个词项，
+        所以只需要在文档频率最低的 n - floor(threshold * n) 个词项的倒排表里找候选，
+        再对这些候选计算准确的相似度。
+        """
+        terms = frozenset(tokenize(content))
+        if not terms:
+            return None
+        size = len(terms)
+        prefix = size - math.floor(threshold * size)
+        rare_terms = sorted(terms, key=lambda term: len(self._postings.get(term, ())))[:prefix]
+
+        candidates = set()
+        for term in rare_terms:
+            candidates.update(self._postings.get(term, ()))
+
+        candidates.discard(id(exclude))
+        best, best_score = None, threshold
+        for key in candidates:
+            other = self._entries[key][1]
+            # 词项数相差太多的记忆不可能足够相似
+            if len(other) <= threshold * size or size <= threshold * len(other):
+                continue
+            score = jaccard(terms, other)
+            if score > best_score:
+                best, best_score = self._memories[key], score
+        return best
+
+    def search(self, query, limit=5, min_importance=1, importance_boost=0.0, recency_boost=0.0, now=None):
+        """按 BM25 相关度检索记忆内容和标签
+
+        参数：
+            query: 检索文本
+            limit: 最多返回的记忆数量
+            min_importance: 只返回重要性不低于该值的记忆
+            importance_boost: 重要性加权，重要性为 5 的记忆得分乘以 (1 + importance_boost)
+            recency_boost: 新鲜度加权，刚更新的记忆得分乘以 (1 + recency_boost)，随时间按半衰期衰减
+            now: 计算新鲜度的当前时间戳，默认为当前时间
+
+        返回：
+            [(得分, 记忆)]，按得分从高到低排列
+        """
+        count = len(self._memories)
+        # 查询只按二元组切分，索引中的单字只用来匹配只有一个字的查询
+        terms = set(tokenize(query))
+        if not count or not terms or limit <= 0:
+            return []
+        if self._norms is None:
+            average_length = self._total_length / count or 1
+            self._norms = {
+                key: BM25_K1 * (1 - BM25_B + BM25_B * length / average_length)
+                for key, length in self._lengths.items()
+            }
+        norms = self._norms
+
+        scores = {}
+        for term in terms:
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            weight = idf * (BM25_K1 + 1)
+            for key, frequency in postings.items():
+                scores[key] = scores.get(key, 0.0) + weight * frequency / (frequency + norms[key])
+
+        if now is None:
+            now = time.time()
+        # 加权最多把得分放大 max_boost 倍，按原始得分从高到低处理，
+        # 原始得分乘以 max_boost 都进不了前 limit 名时后面的记忆不用再算
+        max_boost = (1 + importance_boost) * (1 + recency_boost)
+        top = []
+        for key, score in sorted(scores.items(), key=itemgetter(1), reverse=True):
+            if len(top) >= limit and score * max_boost <= top[0][0]:
+                break
+            memory = self._memories[key]
+            importance = memory.get("importance", 1)
+            if importance < min_importance:
+                continue
+            if importance_boost:
+                score *= 1 + importance_boost * (min(max(importance, 1), 5) - 1) / 4
+            if recency_boost and self._updated_at.get(key) is not None:
+                age_days = max(now - self._updated_at[key], 0) / 86400
+                score *= 1 + recency_boost * 0.5 ** (age_days / RECENCY_HALF_LIFE_DAYS)
+            item = (score, key, memory)
+            if len(top) < limit:
+                heapq.heappush(top, item)
+            elif score > top[0][0]:
+                heapq.heapreplace(top, item)
+        return [(score, memory) for score, _, memory in sorted(top, key=itemgetter(0, 1), reverse=True)]
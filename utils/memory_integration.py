@@ -1,8 +1,8 @@
 import logging
 import asyncio
 import os
-from utils.memory_system import MemorySystem, MemoryAnalyzer, analyze_with_ai
-from datetime import datetime
+from utils.memory_system import get_memory_system_async, run_memory_io, MemoryAnalyzer, analyze_with_ai
+from utils.side_conversation import side_conversations
 
 # 最大尝试次数
 MAX_RETRY = 3
@@ -25,7 +25,7 @@ async def process_memory(user_id, message, robot):
     """
     try:
         # 首先使用简单规则分析
-        simple_analysis_result = MemoryAnalyzer.analyze_message(message, user_id)
+        simple_analysis_result = await run_memory_io(MemoryAnalyzer.analyze_message, message, user_id)
         
         # 如果简单规则没有找到记忆，尝试使用AI分析
         if not simple_analysis_result:
@@ -37,19 +37,24 @@ async def process_memory(user_id, message, robot):
         logging.error(f"处理记忆时出错: {str(e)}")
         return False
 
-def get_memory_enhanced_prompt(user_id, system_prompt=None):
+async def get_memory_enhanced_prompt(user_id, system_prompt=None, message=None):
     """获取增强了记忆的系统提示词
     
     参数：
         user_id: 用户ID
         system_prompt: 原始系统提示词，如果为None则使用默认系统提示词
+        message: 当前用户消息，是文本时注入与它最相关的记忆
         
     返回：
         str: 增强了记忆的系统提示词
     """
     try:
-        memory_system = MemorySystem(user_id)
-        return memory_system.generate_memory_prompt(max_memories=5, system_prompt=system_prompt)
+        memory_system = await get_memory_system_async(user_id)
+        # 图片消息是多模态的列表，不能用来检索，退回到按重要性挑选
+        query = message if isinstance(message, str) else None
+        return await run_memory_io(
+            memory_system.generate_memory_prompt, max_memories=5, system_prompt=system_prompt, query=query
+        )
     except Exception as e:
         logging.error(f"获取增强记忆提示词时出错: {str(e)}")
         # 如果出错，返回原始系统提示词，或者默认提示词
@@ -67,13 +72,14 @@ async def add_explicit_memory(user_id, content, importance=3):
         bool: 是否成功添加
     """
     try:
-        memory_system = MemorySystem(user_id)
-        result = memory_system.add_memory(
+        memory_system = await get_memory_system_async(user_id)
+        result = await run_memory_io(
+            memory_system.add_memory,
             content=content, 
             importance=importance, 
             source="user_explicit"
         )
-        return result
+        return bool(result)
     except Exception as e:
         logging.error(f"添加明确记忆时出错: {str(e)}")
         return False
@@ -89,8 +95,8 @@ async def list_memories(user_id, max_count=10):
         str: 格式化的记忆列表
     """
     try:
-        memory_system = MemorySystem(user_id)
-        memories = memory_system.get_memories(max_count=max_count)
+        memory_system = await get_memory_system_async(user_id)
+        memories = await run_memory_io(memory_system.get_memories, max_count=max_count)
         
         if not memories:
             return "您目前没有保存的记忆。"
@@ -99,7 +105,7 @@ async def list_memories(user_id, max_count=10):
         for idx, memory in enumerate(memories, 1):
             created_at = memory.get("created_at", "未知时间")
             importance = "⭐" * memory.get("importance", 1)
-            result += f"{idx}. {memory['content']} {importance}\n   添加于: {created_at}\n\n"
+            result += f"{idx}. {memory['content']} {importance}\n   ID: {memory['id']}，添加于: {created_at}\n\n"
             
         return result
     except Exception as e:
@@ -117,9 +123,8 @@ async def forget_memory(user_id, memory_id):
         bool: 是否成功删除
     """
     try:
-        memory_system = MemorySystem(user_id)
-        memory_system.forget_memory(memory_id)
-        return True
+        memory_system = await get_memory_system_async(user_id)
+        return await run_memory_io(memory_system.forget_memory, memory_id)
     except Exception as e:
         logging.error(f"删除记忆时出错: {str(e)}")
         return False
@@ -140,13 +145,12 @@ async def forget_memories(user_id, memory_ids):
     }
     
     try:
-        memory_system = MemorySystem(user_id)
+        memory_system = await get_memory_system_async(user_id)
+        deleted = set(await run_memory_io(memory_system.forget_memories, memory_ids))
         for memory_id in memory_ids:
-            try:
-                memory_system.forget_memory(memory_id)
+            if memory_id in deleted:
                 results["success"].append(memory_id)
-            except Exception as e:
-                logging.error(f"删除记忆 {memory_id} 时出错: {str(e)}")
+            else:
                 results["failed"].append(memory_id)
         
         return results
@@ -173,8 +177,8 @@ async def summarize_with_flash(user_id, history, robot):
             conversation_text += f"{prefix}{msg['content']}\n\n"
         
         # 获取当前记忆库内容
-        memory_system = MemorySystem(user_id)
-        current_memories = memory_system.get_memories(max_count=30)  # 获取较多现有记忆以供对比
+        memory_system = await get_memory_system_async(user_id)
+        current_memories = await run_memory_io(memory_system.get_memories, max_count=30)  # 获取较多现有记忆以供对比
         
         # 将当前记忆格式化为文本
         existing_memories_text = ""
@@ -183,9 +187,6 @@ async def summarize_with_flash(user_id, history, robot):
             for idx, memory in enumerate(current_memories, 1):
                 existing_memories_text += f"{idx}. {memory['content']} (重要性: {memory['importance']})\n"
         
-        # 创建临时会话ID
-        temp_convo_id = f"memory_summary_{user_id}_{datetime.now().strftime('%Y%m%d%H%M%S')}"
-        
         # 获取系统提示词
         system_prompt = os.environ.get('SYSTEMPROMPT', '')
         
@@ -244,20 +245,22 @@ async def summarize_with_flash(user_id, history, robot):
         api_url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_name}:streamGenerateContent?key={api_key}"
         
         # 使用现有的robot实例，而不是创建新的Chatbot实例
-        # 添加提示词到临时会话
-        robot.add_to_conversation(summary_prompt, "user", temp_convo_id)
-        
-        # 使用Gemini Flash分析
+        # 借用临时会话，总结结束后自动清理
         response = ""
-        async for data in robot.ask_stream_async(
-            summary_prompt, 
-            convo_id=temp_convo_id,
-            model=model_name,
-            api_key=api_key,
-            api_url=api_url
-        ):
-            if isinstance(data, str):
-                response += data
+        with side_conversations.acquire(robot, "memory_summary") as temp_convo_id:
+            # 添加提示词到临时会话
+            robot.add_to_conversation(summary_prompt, "user", temp_convo_id)
+            
+            # 使用Gemini Flash分析
+            async for data in robot.ask_stream_async(
+                summary_prompt, 
+                convo_id=temp_convo_id,
+                model=model_name,
+                api_key=api_key,
+                api_url=api_url
+            ):
+                if isinstance(data, str):
+                    response += data
         
         # 尝试解析JSON响应
         try:
@@ -274,7 +277,7 @@ async def summarize_with_flash(user_id, history, robot):
             
             # 解析JSON
             result = json.loads(clean_response)
-            memory_system = MemorySystem(user_id)
+            memory_system = await get_memory_system_async(user_id)
             
             # 添加AI识别的记忆
             memories_added = 0
@@ -282,7 +285,8 @@ async def summarize_with_flash(user_id, history, robot):
                 for memory in result["memories"]:
                     if "content" in memory and memory["content"].strip():
                         importance = int(memory.get("importance", 3))
-                        memory_system.add_memory(
+                        await run_memory_io(
+                            memory_system.add_memory,
                             memory["content"], 
                             importance=min(max(importance, 1), 5),
                             source="conversation_summary"
@@ -386,8 +390,8 @@ async def force_summarize_memory(user_id, robot):
         
         if success:
             # 获取新添加的记忆
-            memory_system = MemorySystem(user_id)
-            recent_memories = memory_system.get_memories(max_count=5)
+            memory_system = await get_memory_system_async(user_id)
+            recent_memories = await run_memory_io(memory_system.get_memories, max_count=5)
             
             # 格式化最近的记忆
             result = "对话总结完成，已提取以下记忆：\n\n"
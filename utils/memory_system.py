@@ -18,41 +18,158 @@ def get_china_time():
     """获取中国时区（东八区）的当前时间"""
     return datetime.now(pytz.UTC).astimezone(CHINA_TZ)
 
-# 记忆存储路径 - 修改为使用Docker容器内的路径
-# 在Docker容器中，/home/user_configs是挂载的持久化目录
-if os.path.exists('/home/user_configs'):
-    # Docker容器内路径
-    USER_CONFIGS_DIR = '/home/user_configs'
-else:
-    # 本地开发环境路径
-    USER_CONFIGS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "user_configs")
-
-MEMORY_DIR = os.path.join(USER_CONFIGS_DIR, "memories")
-os.makedirs(MEMORY_DIR, exist_ok=True)
+import heapq
+import threading
+from collections import OrderedDict
+# 记忆的加载和写入在存储层的线程池中执行，磁盘再慢也不会阻塞事件循环
+from utils.storage import MEMORY_DIR, get_storage, empty_memories, run_memory_io
+from utils.memory_index import MemoryIndex
+from utils.memory_embedding import SemanticIndex
+from utils.side_conversation import side_conversations
+
+# 内存中最多保留多少个用户的记忆系统
+MEMORY_CACHE_SIZE = int(os.environ.get('MEMORY_CACHE_SIZE', '256'))
+# 检索记忆时按重要性和更新时间给相关度得分加权的幅度，设为 0 则只按相关度排序
+MEMORY_SEARCH_IMPORTANCE_BOOST = float(os.environ.get('MEMORY_SEARCH_IMPORTANCE_BOOST', '0.3'))
+MEMORY_SEARCH_RECENCY_BOOST = float(os.environ.get('MEMORY_SEARCH_RECENCY_BOOST', '0.2'))
+# 是否按当前消息的语义相关度挑选注入系统提示词的记忆，关闭时只按重要性挑选
+MEMORY_SEMANTIC_SEARCH = os.environ.get('MEMORY_SEMANTIC_SEARCH', 'True').lower() not in ('false', '0', 'no')
+# 后台整理记忆（衰减、合并、限量）的间隔秒数，设为 0 则不整理
+MEMORY_CONSOLIDATION_INTERVAL = int(os.environ.get('MEMORY_CONSOLIDATION_INTERVAL', '21600'))
+# 记忆每隔多少天没有更新，重要性降低 1（最低为 1），用户明确要求记住的记忆不衰减，设为 0 则不衰减
+MEMORY_DECAY_DAYS = float(os.environ.get('MEMORY_DECAY_DAYS', '0'))
+# 整理时内容相似度达到这个值的记忆合并为一条（新增记忆时的去重阈值是 0.8）
+MEMORY_MERGE_THRESHOLD = float(os.environ.get('MEMORY_MERGE_THRESHOLD', '0.6'))
+# 每个用户最多保留多少条记忆，超出时把最不重要的记忆移到归档，设为 0 则不限制
+MEMORY_MAX_PER_USER = int(os.environ.get('MEMORY_MAX_PER_USER', '0'))
+# 不参与衰减的记忆来源
+DECAY_EXEMPT_SOURCES = ("user_explicit",)
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+def _parse_timestamp(value):
+    try:
+        return datetime.strptime(value, TIMESTAMP_FORMAT)
+    except (TypeError, ValueError):
+        return None
+
+def _retention_key(memory):
+    """整理时保留记忆的优先级：重要性、更新时间、访问次数依次比较，越大越应该保留"""
+    return (memory.get("importance", 1), memory.get("updated_at") or "", memory.get("access_count", 0))
 
 class MemorySystem:
-    def __init__(self, user_id):
+    """单个用户的记忆
+
+    同一用户的实例由 get_memory_system() 在进程内共享，修改记忆前需要持有 self.lock。
+    """
+
+    def __init__(self, user_id, storage=None):
         self.user_id = user_id
         self.memory_file = os.path.join(MEMORY_DIR, f"memory_{user_id}.json")
+        self.storage = storage or get_storage()
+        self.lock = threading.RLock()
+        self._version = None
+        # 记忆每次变化（加载、新增、修改、删除）都会增加 revision，渲染好的记忆提示词按它失效
+        self.revision = 0
+        self._prompt_cache = {}
+        # 加载时随记忆保存的向量，只在建立语义索引时使用
+        self._stored_embeddings = {}
         self.memories = self._load_memories()
+        self._rebuild_index(self._stored_embeddings)
+        self._stored_embeddings = {}
         
     def _load_memories(self):
         """加载用户的记忆"""
-        if os.path.exists(self.memory_file):
+        self.revision += 1
+        try:
+            # 先取版本再读取，读取期间发生的修改会在下一次检查时被发现
+            self._version = self.storage.memory_version(self.user_id)
+            data = self.storage.load_memories(self.user_id)
+        except Exception as e:
+            logging.error(f"加载记忆文件失败: {str(e)}")
+            return empty_memories()
+        self._stored_embeddings = data.pop("embeddings", None) or {}
+        if self._renumber_duplicate_ids(data):
+            # 重新编号后向量和ID的对应关系不再可靠，全部重新计算
+            self._stored_embeddings = {}
             try:
-                with open(self.memory_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
+                self.storage.save_memories(self.user_id, data)
+                self._version = self.storage.memory_version(self.user_id)
             except Exception as e:
-                logging.error(f"加载记忆文件失败: {str(e)}")
-                return {"memories": [], "last_updated": None}
-        else:
-            return {"memories": [], "last_updated": None}
+                logging.error(f"保存重新编号的记忆失败: {str(e)}")
+        return data
+
+    def _renumber_duplicate_ids(self, data):
+        """修复旧版本按记忆条数分配ID造成的重复ID，返回是否有记忆被重新编号
+
+        每个ID第一次出现的记忆保留原ID，之后重复的或者缺少ID的记忆依次分配新的ID，
+        并确保 next_id 大于所有已经用过的ID。
+        """
+        memories = data.setdefault("memories", [])
+        next_id = max([data.get("next_id") or 1] + [
+            memory["id"] + 1 for memory in memories if isinstance(memory.get("id"), int)
+        ])
+        seen = set()
+        renumbered = []
+        for memory in memories:
+            memory_id = memory.get("id")
+            if not isinstance(memory_id, int) or memory_id in seen:
+                memory["id"] = next_id
+                renumbered.append((memory_id, next_id))
+                next_id += 1
+            seen.add(memory["id"])
+        data["next_id"] = next_id
+        if renumbered:
+            logging.warning(f"用户 {self.user_id} 有 {len(renumbered)} 条记忆的ID重复，已重新编号: {renumbered}")
+        return bool(renumbered)
+
+    def reload_if_changed(self):
+        """存储中的记忆被其他进程或手动修改过时重新加载"""
+        with self.lock:
+            if self.storage.memory_version(self.user_id) != self._version:
+                self.memories = self._load_memories()
+                self._rebuild_index(self._stored_embeddings)
+                self._stored_embeddings = {}
+
+    def _rebuild_index(self, stored_embeddings=None):
+        """重新建立ID -> 记忆的字典、ID -> 列表位置的字典、倒排索引（去重和关键词检索）和向量索引（语义检索）
+
+        stored_embeddings 是保存的向量记录，仍然有效的向量直接使用，不重新计算。
+        """
+        self._by_id = {memory["id"]: memory for memory in self.memories["memories"]}
+        self._positions = {memory["id"]: position for position, memory in enumerate(self.memories["memories"])}
+        self.index = MemoryIndex(self.memories["memories"])
+        self.semantic_index = (
+            SemanticIndex(self.memories["memories"], stored=stored_embeddings) if MEMORY_SEMANTIC_SEARCH else None
+        )
+
+    def _export_embeddings(self):
+        return self.semantic_index.export() if getattr(self, "semantic_index", None) is not None else {}
     
     def _save_memories(self):
-        """保存用户的记忆"""
+        """保存用户的全部记忆，连同记忆的向量"""
+        self.revision += 1
+        self._rebuild_index(self._export_embeddings())
+        data = self.memories
+        if self.semantic_index is not None:
+            data = dict(self.memories, embeddings=self.semantic_index.export())
+        try:
+            self.storage.save_memories(self.user_id, data)
+            self._version = self.storage.memory_version(self.user_id)
+        except Exception as e:
+            logging.error(f"保存记忆文件失败: {str(e)}")
+
+    def _save_memory(self, memory):
+        """只保存一条新增或修改的记忆"""
+        self.revision += 1
+        self._by_id[memory["id"]] = memory
+        self.index.update(memory)
+        embedding = None
+        if self.semantic_index is not None:
+            self.semantic_index.update(memory)
+            embedding = self.semantic_index.record(memory)
         try:
-            with open(self.memory_file, 'w', encoding='utf-8') as f:
-                json.dump(self.memories, f, ensure_ascii=False, indent=2)
+            self.storage.upsert_memory(self.user_id, memory, self.memories["last_updated"], embedding=embedding)
+            self._version = self.storage.memory_version(self.user_id)
         except Exception as e:
             logging.error(f"保存记忆文件失败: {str(e)}")
     
@@ -63,35 +180,46 @@ class MemorySystem:
             content: 记忆内容
             importance: 重要性 (1-5)，数字越大越重要
             source: 记忆来源 (conversation, user_input, system)
+
+        返回：
+            新增的记忆；和已有记忆重复时返回被更新的已有记忆
         """
-        timestamp = get_china_time().strftime("%Y-%m-%d %H:%M:%S")
+        with self.lock:
+            timestamp = get_china_time().strftime("%Y-%m-%d %H:%M:%S")
         
-        # 检查是否已存在类似记忆，避免重复
-        for memory in self.memories["memories"]:
-            if self._calculate_similarity(content, memory["content"]) > 0.8:
+            # 通过倒排索引查找是否已存在类似记忆，避免重复
+            memory = self.index.find_similar(content, threshold=0.8)
+            if memory is not None:
                 # 更新已有记忆
                 memory["updated_at"] = timestamp
                 memory["importance"] = max(memory["importance"], importance)
                 memory["access_count"] += 1
                 self.memories["last_updated"] = timestamp
-                self._save_memories()
-                return True
-        
-        # 添加新记忆
-        new_memory = {
-            "id": len(self.memories["memories"]) + 1,
-            "content": content,
-            "created_at": timestamp,
-            "updated_at": timestamp,
-            "importance": importance,
-            "access_count": 1,
-            "source": source
-        }
-        
-        self.memories["memories"].append(new_memory)
-        self.memories["last_updated"] = timestamp
-        self._save_memories()
-        return True
+                self._save_memory(memory)
+                return memory
+        
+            # 添加新记忆，ID 取自只增不减的序列
+            memory_id = self.memories.get("next_id") or 1
+            self.memories["next_id"] = memory_id + 1
+            new_memory = {
+                "id": memory_id,
+                "content": content,
+                "created_at": timestamp,
+                "updated_at": timestamp,
+                "importance": importance,
+                "access_count": 1,
+                "source": source
+            }
+        
+            self._positions[memory_id] = len(self.memories["memories"])
+            self.memories["memories"].append(new_memory)
+            self.memories["last_updated"] = timestamp
+            self._save_memory(new_memory)
+            return new_memory
+
+    def get_memory(self, memory_id):
+        """按ID获取一条记忆，不存在时返回 None"""
+        return self._by_id.get(memory_id)
     
     def get_memories(self, max_count=10, min_importance=1):
         """获取记忆
@@ -103,62 +231,365 @@ class MemorySystem:
         返回：
             记忆列表
         """
-        # 按重要性和更新时间排序
-        sorted_memories = sorted(
-            [m for m in self.memories["memories"] if m["importance"] >= min_importance],
-            key=lambda x: (x["importance"], x["updated_at"]),
-            reverse=True
-        )
-        
-        return sorted_memories[:max_count]
+        with self.lock:
+            # 按重要性和更新时间取前 max_count 条，不需要对全部记忆排序
+            return heapq.nlargest(
+                max_count,
+                (m for m in self.memories["memories"] if m["importance"] >= min_importance),
+                key=lambda x: (x["importance"], x["updated_at"]),
+            )
     
+    def search_memories(self, query, max_count=5, min_importance=1):
+        """按相关度检索记忆
+
+        参数：
+            query: 检索文本，中文按二元组匹配
+            max_count: 最大返回数量
+            min_importance: 最小重要性
+
+        返回：
+            按相关度从高到低排列的记忆列表
+        """
+        with self.lock:
+            results = self.index.search(
+                query,
+                limit=max_count,
+                min_importance=min_importance,
+                importance_boost=MEMORY_SEARCH_IMPORTANCE_BOOST,
+                recency_boost=MEMORY_SEARCH_RECENCY_BOOST,
+            )
+            memories = [memory for _, memory in results]
+            # 关键词命中不够时用语义相近的记忆补足
+            if len(memories) < max_count and self.semantic_index is not None:
+                for _, memory in self.semantic_index.search(query, limit=max_count, min_importance=min_importance):
+                    if len(memories) >= max_count:
+                        break
+                    if all(memory is not found for found in memories):
+                        memories.append(memory)
+            return memories
+
+    def relevant_memories(self, text, max_count=5, min_importance=2):
+        """挑选与当前消息最相关的记忆
+
+        先按语义相似度挑选，相关的记忆不足 max_count 条时用最重要的记忆补足。
+
+        参数：
+            text: 当前消息
+            max_count: 最大返回数量
+            min_importance: 最小重要性
+
+        返回：
+            记忆列表，相关的在前
+        """
+        with self.lock:
+            memories = []
+            if text and self.semantic_index is not None:
+                memories = [memory for _, memory in self.semantic_index.search(
+                    text, limit=max_count, min_importance=min_importance)]
+            if len(memories) < max_count:
+                for memory in self.get_memories(max_count=max_count, min_importance=min_importance):
+                    if len(memories) >= max_count:
+                        break
+                    if all(memory is not found for found in memories):
+                        memories.append(memory)
+            return memories
+
     def forget_memory(self, memory_id):
-        """删除指定记忆"""
-        self.memories["memories"] = [m for m in self.memories["memories"] if m["id"] != memory_id]
-        self.memories["last_updated"] = get_china_time().strftime("%Y-%m-%d %H:%M:%S")
-        self._save_memories()
+        """删除指定记忆，返回是否删除了记忆"""
+        return bool(self.forget_memories([memory_id]))
+
+    def forget_memories(self, memory_ids):
+        """删除多条记忆
+
+        参数：
+            memory_ids: 记忆ID列表
+
+        返回：
+            实际删除了的记忆ID列表
+        """
+        with self.lock:
+            targets = [self._by_id.pop(memory_id) for memory_id in dict.fromkeys(memory_ids) if memory_id in self._by_id]
+            if not targets:
+                return []
+            for memory in targets:
+                self.index.remove(memory)
+                if self.semantic_index is not None:
+                    self.semantic_index.remove(memory)
+            memories = self.memories["memories"]
+            for memory in targets:
+                # 用列表最后一条记忆填补空位，删除一条记忆不需要遍历整个列表
+                position = self._positions.pop(memory["id"])
+                last = memories.pop()
+                if last is not memory:
+                    memories[position] = last
+                    self._positions[last["id"]] = position
+            self.revision += 1
+            self.memories["last_updated"] = get_china_time().strftime("%Y-%m-%d %H:%M:%S")
+            try:
+                return self.storage.delete_memories(
+                    self.user_id, [memory["id"] for memory in targets], self.memories["last_updated"]
+                )
+            except Exception as e:
+                logging.error(f"保存记忆文件失败: {str(e)}")
+                return []
+
+    def consolidate(self, now=None):
+        """整理记忆：按时间衰减重要性，合并相似的记忆，超出数量上限时淘汰最不重要的记忆
+
+        被合并和淘汰的记忆追加到存储的归档中，不再加载。
+
+        参数：
+            now: 当前时间（不带时区的东八区时间），默认取当前时间
+
+        返回：
+            整理结果：decayed（衰减条数）、merged（合并掉的条数）、evicted（淘汰条数）、
+            remaining（剩余条数）、reclaimed_bytes（移出的记忆序列化后的字节数）
+        """
+        now = now or get_china_time().replace(tzinfo=None)
+        timestamp = now.strftime(TIMESTAMP_FORMAT)
+        with self.lock:
+            memories = self.memories["memories"]
+            decayed = self._decay(memories, now, timestamp)
+            # 合并会修改保留的记忆（访问次数相加、标签取并集），归档失败时要还原到合并前
+            before_merge = [dict(memory) for memory in memories]
+            merged = self._merge_similar(memories)
+            removed = {id(memory) for memory in merged}
+            kept = [memory for memory in memories if id(memory) not in removed]
+
+            evicted = []
+            if MEMORY_MAX_PER_USER > 0 and len(kept) > MEMORY_MAX_PER_USER:
+                evicted = sorted(kept, key=_retention_key)[:len(kept) - MEMORY_MAX_PER_USER]
+                removed.update(id(memory) for memory in evicted)
+                kept = [memory for memory in kept if id(memory) not in removed]
+
+            report = {
+                "decayed": decayed,
+                "merged": len(merged),
+                "evicted": len(evicted),
+                "remaining": len(kept),
+                "reclaimed_bytes": sum(
+                    len(json.dumps(memory, ensure_ascii=False).encode("utf-8")) for memory in merged + evicted
+                ),
+            }
+            if not (decayed or merged or evicted):
+                return report
+
+            try:
+                if merged:
+                    self.storage.archive_memories(self.user_id, merged, "merged", timestamp)
+                if evicted:
+                    self.storage.archive_memories(self.user_id, evicted, "capacity", timestamp)
+            except Exception as e:
+                # 归档失败时不删除也不合并记忆，只保存衰减后的内容
+                logging.error(f"归档记忆失败: {str(e)}")
+                for memory, saved in zip(memories, before_merge):
+                    memory.clear()
+                    memory.update(saved)
+                kept = memories
+                report.update(merged=0, evicted=0, remaining=len(kept), reclaimed_bytes=0)
+            self.memories["memories"] = kept
+            self.memories["last_updated"] = timestamp
+            self._save_memories()
+            return report
+
+    def _decay(self, memories, now, timestamp):
+        """每经过 MEMORY_DECAY_DAYS 天没有更新，重要性降低 1，返回衰减了的记忆条数"""
+        if MEMORY_DECAY_DAYS <= 0:
+            return 0
+        decayed = 0
+        for memory in memories:
+            if memory.get("source") in DECAY_EXEMPT_SOURCES or memory.get("importance", 1) <= 1:
+                continue
+            # 从上次更新或上次衰减（取较晚的）开始计算，每次整理不会重复衰减同一段时间
+            since = [t for t in map(_parse_timestamp, (memory.get("updated_at"), memory.get("decayed_at"))) if t]
+            if not since:
+                continue
+            periods = int((now - max(since)).total_seconds() // (MEMORY_DECAY_DAYS * 86400))
+            if periods <= 0:
+                continue
+            memory["importance"] = max(1, memory["importance"] - periods)
+            memory["decayed_at"] = timestamp
+            decayed += 1
+        return decayed
+
+    def _merge_similar(self, memories):
+        """把内容相似的记忆合并到更值得保留的一条中，返回被合并掉的记忆列表
+
+        保留的记忆取两者中较高的重要性、较早的创建时间、较晚的更新时间，访问次数相加，标签取并集。
+        """
+        merged = []
+        dropped = set()
+        for memory in sorted(memories, key=_retention_key, reverse=True):
+            if id(memory) in dropped:
+                continue
+            while True:
+                other = self.index.find_similar(memory.get("content", ""), threshold=MEMORY_MERGE_THRESHOLD, exclude=memory)
+                if other is None:
+                    break
+                keep, drop = (memory, other) if _retention_key(memory) >= _retention_key(other) else (other, memory)
+                keep["importance"] = max(keep.get("importance", 1), drop.get("importance", 1))
+                keep["access_count"] = keep.get("access_count", 0) + drop.get("access_count", 0)
+                created = [t for t in (keep.get("created_at"), drop.get("created_at")) if t]
+                if created:
+                    keep["created_at"] = min(created)
+                keep["updated_at"] = max(keep.get("updated_at") or "", drop.get("updated_at") or "")
+                tags = list(dict.fromkeys((keep.get("tags") or []) + (drop.get("tags") or [])))
+                if tags:
+                    keep["tags"] = tags
+                self.index.remove(drop)
+                dropped.add(id(drop))
+                merged.append(drop)
+                if drop is memory:
+                    break
+        return merged
     
-    def generate_memory_prompt(self, max_memories=5, system_prompt=None):
+    def render_memory_block(self, max_memories=5, query=None):
+        """返回拼接到系统提示词中的记忆段落，没有可用的记忆时返回空字符串
+
+        提供 query（当前消息）且开启了语义检索时挑选与它最相关的记忆，否则挑选最重要的记忆。
+        挑选最重要的记忆时按 revision 缓存，记忆没有变化时直接返回上一次的文本，不再重新挑选；
+        按 query 挑选时每条消息都要检索，渲染结果按 revision 和挑选出的记忆ID缓存。
+        """
+        with self.lock:
+            by_query = bool(query) and self.semantic_index is not None
+            cache_key = (max_memories, by_query)
+            cached = self._prompt_cache.get(cache_key)
+            if not by_query:
+                if cached is not None and cached[0] == self.revision:
+                    return cached[1]
+                memories = self.get_memories(max_count=max_memories, min_importance=2)
+                key = self.revision
+            else:
+                memories = self.relevant_memories(query, max_count=max_memories, min_importance=2)
+                key = (self.revision, tuple(memory["id"] for memory in memories))
+                if cached is not None and cached[0] == key:
+                    return cached[1]
+
+            memory_text = ""
+            if memories:
+                memory_text = "以下是我之前了解到的关于你的重要信息：\n\n"
+                for idx, memory in enumerate(memories, 1):
+                    memory_text += f"{idx}. {memory['content']}\n"
+                memory_text += "\n请在我们的对话中记住这些信息，但不要主动提及你在'记忆'这些内容。"
+            self._prompt_cache[cache_key] = (key, memory_text)
+            return memory_text
+
+    def generate_memory_prompt(self, max_memories=5, system_prompt=None, query=None):
         """生成包含记忆的系统提示词
         
         参数：
             max_memories: 最大记忆数量
             system_prompt: 系统提示词，如果为None则使用默认值
+            query: 当前消息，提供时优先注入与它相关的记忆
         
         返回：
             增强了记忆的系统提示词
         """
-        memories = self.get_memories(max_count=max_memories, min_importance=2)
+        memory_text = self.render_memory_block(max_memories, query=query)
         
         # 如果没有提供系统提示词，使用默认值
         if system_prompt is None:
             system_prompt = DEFAULT_SYSTEM_PROMPT
         
-        if not memories:
+        if not memory_text:
             return system_prompt
         
-        memory_text = "以下是我之前了解到的关于你的重要信息：\n\n"
-        for idx, memory in enumerate(memories, 1):
-            memory_text += f"{idx}. {memory['content']}\n"
-        memory_text += "\n请在我们的对话中记住这些信息，但不要主动提及你在'记忆'这些内容。"
-        
         # 将记忆添加到系统提示词中
         enhanced_prompt = f"{system_prompt}\n\n{memory_text}"
         return enhanced_prompt
-    
-    def _calculate_similarity(self, text1, text2):
-        """计算两段文本的相似度（简化版）"""
-        # 这是一个简化的实现，实际应用中可以使用更先进的方法
-        words1 = set(text1.lower().split())
-        words2 = set(text2.lower().split())
-        
-        if not words1 or not words2:
-            return 0.0
-        
-        intersection = words1.intersection(words2)
-        union = words1.union(words2)
-        
-        return len(intersection) / len(union)
+
+class MemoryRegistry:
+    """进程内共享的记忆系统缓存
+
+    每个用户只保留一个 MemorySystem，取用时检查存储中的版本，
+    被外部修改过才重新加载；超过容量时淘汰最久没有使用的用户。
+    """
+
+    def __init__(self, capacity=MEMORY_CACHE_SIZE):
+        self.capacity = capacity
+        self._systems = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        user_id = str(user_id)
+        with self._lock:
+            memory_system = self._systems.get(user_id)
+            if memory_system is not None:
+                self._systems.move_to_end(user_id)
+        if memory_system is not None:
+            memory_system.reload_if_changed()
+            return memory_system
+
+        # 第一次加载要读磁盘，在锁外进行，不让其他用户等待；放入缓存前再检查一次，
+        # 同时加载同一个用户时只保留先放入的那个
+        loaded = MemorySystem(user_id)
+        with self._lock:
+            memory_system = self._systems.get(user_id)
+            if memory_system is None:
+                memory_system = self._systems[user_id] = loaded
+                while len(self._systems) > self.capacity:
+                    self._systems.popitem(last=False)
+            else:
+                self._systems.move_to_end(user_id)
+        return memory_system
+
+    def peek(self, user_id):
+        """返回已经缓存的记忆系统，不加载、不调整淘汰顺序，没有缓存时返回 None"""
+        with self._lock:
+            return self._systems.get(str(user_id))
+
+    def invalidate(self, user_id=None):
+        """丢弃缓存的记忆系统，user_id 为 None 时全部丢弃"""
+        with self._lock:
+            if user_id is None:
+                self._systems.clear()
+            else:
+                self._systems.pop(str(user_id), None)
+
+memory_registry = MemoryRegistry()
+
+def get_memory_system(user_id):
+    """获取用户共享的记忆系统"""
+    return memory_registry.get(user_id)
+
+async def get_memory_system_async(user_id):
+    """异步获取用户共享的记忆系统，第一次加载和检查外部修改都在线程池中进行"""
+    return await run_memory_io(memory_registry.get, user_id)
+
+def consolidate_all_memories():
+    """整理所有用户的记忆，返回汇总的整理结果（各项为所有用户之和，另加 users 为处理的用户数）"""
+    totals = {"users": 0, "decayed": 0, "merged": 0, "evicted": 0, "remaining": 0, "reclaimed_bytes": 0}
+    try:
+        user_ids = get_storage().list_memory_user_ids()
+    except Exception as e:
+        logging.error(f"获取记忆用户列表失败: {str(e)}")
+        return totals
+    for user_id in user_ids:
+        try:
+            # 已经缓存的用户直接整理缓存的实例；其余用户用临时实例整理，不放进缓存，
+            # 否则一次整理所有用户会把活跃用户挤出缓存
+            memory_system = memory_registry.peek(user_id)
+            if memory_system is not None:
+                memory_system.reload_if_changed()
+            else:
+                memory_system = MemorySystem(user_id)
+            report = memory_system.consolidate()
+        except Exception as e:
+            logging.error(f"整理用户 {user_id} 的记忆失败: {str(e)}")
+            continue
+        totals["users"] += 1
+        for key, value in report.items():
+            totals[key] += value
+    return totals
+
+async def consolidate_memories_job(context):
+    """JobQueue 定时任务：在记忆线程池中整理所有用户的记忆并记录回收了多少"""
+    totals = await run_memory_io(consolidate_all_memories)
+    logging.info(
+        f"记忆整理完成：{totals['users']} 个用户，衰减 {totals['decayed']} 条，合并 {totals['merged']} 条，"
+        f"淘汰 {totals['evicted']} 条，剩余 {totals['remaining']} 条，回收 {totals['reclaimed_bytes']} 字节"
+    )
+    return totals
 
 # 记忆分析器
 class MemoryAnalyzer:
@@ -167,7 +598,7 @@ class MemoryAnalyzer:
     @staticmethod
     def analyze_message(message, user_id):
         """分析消息，提取需要记忆的信息"""
-        memory_system = MemorySystem(user_id)
+        memory_system = get_memory_system(user_id)
         
         # 提取用户偏好
         preferences = MemoryAnalyzer._extract_preferences(message)
@@ -283,23 +714,22 @@ async def analyze_with_ai(user_id, message, robot):
     """
     
     try:
-        # 创建临时会话ID
-        temp_convo_id = f"memory_analysis_{user_id}_{get_china_time().strftime('%Y%m%d%H%M%S')}"
-        
-        # 添加分析提示和用户消息到临时会话
-        robot.add_to_conversation(analyze_prompt, "system", temp_convo_id)
-        robot.add_to_conversation(message, "user", temp_convo_id)
-        
-        # 使用AI分析
+        # 借用临时会话，分析结束后自动清理
         response = ""
-        async for data in robot.ask_stream_async(message, convo_id=temp_convo_id):
-            if isinstance(data, str):
-                response += data
+        with side_conversations.acquire(robot, "memory_analysis") as temp_convo_id:
+            # 添加分析提示和用户消息到临时会话
+            robot.add_to_conversation(analyze_prompt, "system", temp_convo_id)
+            robot.add_to_conversation(message, "user", temp_convo_id)
+            
+            # 使用AI分析
+            async for data in robot.ask_stream_async(message, convo_id=temp_convo_id):
+                if isinstance(data, str):
+                    response += data
         
         # 尝试解析JSON响应
         try:
             result = json.loads(response)
-            memory_system = MemorySystem(user_id)
+            memory_system = await get_memory_system_async(user_id)
             
             # 添加AI识别的记忆
             memories_added = 0
@@ -307,7 +737,8 @@ async def analyze_with_ai(user_id, message, robot):
                 for memory in result["memories"]:
                     if "content" in memory and memory["content"].strip():
                         importance = int(memory.get("importance", 2))
-                        memory_system.add_memory(
+                        await run_memory_io(
+                            memory_system.add_memory,
                             memory["content"], 
                             importance=min(max(importance, 1), 5),
                             source="ai_analysis"
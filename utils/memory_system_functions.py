@@ -1,11 +1,9 @@
-import os
-import json
 import logging
 import traceback
 from datetime import datetime
 import pytz
 from typing import List, Dict, Any, Optional, Union
-from .memory_system import MemorySystem, MEMORY_DIR
+from .memory_system import get_memory_system, run_memory_io
 
 # 定义东八区时区
 CHINA_TZ = pytz.timezone('Asia/Shanghai')
@@ -19,7 +17,7 @@ class FunctionCallingMemorySystem:
     def __init__(self, user_id: str):
         """初始化记忆系统"""
         self.user_id = user_id
-        self.memory_system = MemorySystem(user_id)
+        self.memory_system = get_memory_system(user_id)
         
     def get_memory_functions(self) -> List[Dict[str, Any]]:
         """获取记忆系统的function定义，用于Gemini模型的function calling"""
@@ -128,22 +126,13 @@ class FunctionCallingMemorySystem:
             tags = arguments.get("tags", [])
             
             # 添加到现有记忆系统
-            success = self.memory_system.add_memory(content, importance, source="model_function_call")
-            if not success:
+            memory = self.memory_system.add_memory(content, importance, source="model_function_call")
+            if not memory:
                 return {"status": "error", "message": "创建记忆失败"}
             
             # 如果提供了标签，更新记忆包含标签
-            if tags and success:
-                # 获取刚创建的记忆ID
-                memories = self.memory_system.memories["memories"]
-                if memories:
-                    # 找到刚添加的记忆（应该是最后一个）
-                    for memory in reversed(memories):
-                        if memory["content"] == content:
-                            memory_id = memory["id"]
-                            # 更新记忆添加标签
-                            self._update_memory_tags(memory_id, tags)
-                            break
+            if tags:
+                self._update_memory_tags(memory["id"], tags)
             
             return {
                 "status": "success", 
@@ -166,36 +155,10 @@ class FunctionCallingMemorySystem:
             max_results = min(int(arguments.get("max_results", 5)), 10)  # 限制最大结果数
             min_importance = min(max(int(arguments.get("min_importance", 1)), 1), 5)
             
-            # 获取所有记忆
-            all_memories = self.memory_system.get_memories(max_count=100, min_importance=min_importance)
-            
-            # 简单相似度匹配 (未来可以换成更高级的语义搜索)
-            matched_memories = []
-            for memory in all_memories:
-                # 计算简单的相似度 (包含关键词)
-                query_terms = query.lower().split()
-                content_lower = memory["content"].lower()
-                
-                # 检查标签匹配 (如果记忆有标签)
-                tag_match = False
-                if "tags" in memory:
-                    for tag in memory.get("tags", []):
-                        if any(term in tag.lower() for term in query_terms):
-                            tag_match = True
-                            break
-                
-                # 检查内容匹配
-                content_match = any(term in content_lower for term in query_terms)
-                
-                # 如果任一匹配，添加到结果中
-                if content_match or tag_match:
-                    matched_memories.append(memory)
-            
-            # 按重要性排序
-            matched_memories.sort(key=lambda x: x["importance"], reverse=True)
-            
-            # 限制结果数量
-            matched_memories = matched_memories[:max_results]
+            # 通过倒排索引按 BM25 相关度检索内容和标签，并按重要性和更新时间加权
+            matched_memories = self.memory_system.search_memories(
+                query, max_count=max_results, min_importance=min_importance
+            )
             
             return {
                 "status": "success",
@@ -215,45 +178,32 @@ class FunctionCallingMemorySystem:
             if memory_id is None:
                 return {"status": "error", "message": "必须提供记忆ID"}
             
-            # 加载用户的所有记忆
-            memory_file = os.path.join(MEMORY_DIR, f"memory_{self.user_id}.json")
-            if not os.path.exists(memory_file):
-                return {"status": "error", "message": "记忆文件不存在"}
-            
-            with open(memory_file, 'r', encoding='utf-8') as f:
-                memory_data = json.load(f)
-            
-            # 查找指定ID的记忆
-            memory_found = False
-            for i, memory in enumerate(memory_data["memories"]):
-                if memory["id"] == memory_id:
+            # 按ID查找指定的记忆
+            with self.memory_system.lock:
+                updated_memory = self.memory_system.get_memory(int(memory_id))
+                if updated_memory is not None:
                     # 更新记忆内容和重要性
                     if "content" in arguments:
-                        memory_data["memories"][i]["content"] = arguments["content"]
-                    
+                        updated_memory["content"] = arguments["content"]
+                
                     if "importance" in arguments:
                         importance = min(max(int(arguments["importance"]), 1), 5)
-                        memory_data["memories"][i]["importance"] = importance
-                    
+                        updated_memory["importance"] = importance
+                
                     if "tags" in arguments:
-                        memory_data["memories"][i]["tags"] = arguments["tags"]
-                    
+                        updated_memory["tags"] = arguments["tags"]
+                
                     # 更新修改时间
                     timestamp = datetime.now(CHINA_TZ).strftime("%Y-%m-%d %H:%M:%S")
-                    memory_data["memories"][i]["updated_at"] = timestamp
-                    memory_data["last_updated"] = timestamp
-                    
-                    memory_found = True
-                    updated_memory = memory_data["memories"][i]
-                    break
+                    updated_memory["updated_at"] = timestamp
+                    self.memory_system.memories["last_updated"] = timestamp
+
+                    # 只保存这一条记忆
+                    self.memory_system._save_memory(updated_memory)
             
-            if not memory_found:
+            if updated_memory is None:
                 return {"status": "error", "message": f"未找到ID为{memory_id}的记忆"}
             
-            # 保存更新后的记忆
-            with open(memory_file, 'w', encoding='utf-8') as f:
-                json.dump(memory_data, f, ensure_ascii=False, indent=2)
-            
             return {
                 "status": "success",
                 "message": "记忆已成功更新",
@@ -273,7 +223,7 @@ class FunctionCallingMemorySystem:
                 return {"status": "error", "message": "必须提供记忆ID"}
             
             # 使用已有的forget_memory方法
-            success = self.memory_system.forget_memory(memory_id)
+            success = self.memory_system.forget_memory(int(memory_id))
             
             if success:
                 return {
@@ -311,32 +261,22 @@ class FunctionCallingMemorySystem:
     def _update_memory_tags(self, memory_id: int, tags: List[str]) -> bool:
         """更新记忆的标签"""
         try:
-            # 加载用户的所有记忆
-            memory_file = os.path.join(MEMORY_DIR, f"memory_{self.user_id}.json")
-            if not os.path.exists(memory_file):
-                return False
-            
-            with open(memory_file, 'r', encoding='utf-8') as f:
-                memory_data = json.load(f)
-            
-            # 查找指定ID的记忆
-            memory_found = False
-            for i, memory in enumerate(memory_data["memories"]):
-                if memory["id"] == memory_id:
-                    # 更新标签
-                    memory_data["memories"][i]["tags"] = tags
-                    memory_found = True
-                    break
-            
-            if not memory_found:
-                return False
-            
-            # 保存更新后的记忆
-            with open(memory_file, 'w', encoding='utf-8') as f:
-                json.dump(memory_data, f, ensure_ascii=False, indent=2)
+            with self.memory_system.lock:
+                memory = self.memory_system.get_memory(memory_id)
+                if memory is None:
+                    return False
+                # 更新标签并只保存这一条记忆
+                memory["tags"] = tags
+                self.memory_system._save_memory(memory)
             
             return True
             
         except Exception as e:
             logging.error(f"更新记忆标签时出错: {str(e)}")
             return False
+
+async def call_memory_function(user_id: str, function_name: str, arguments: Dict[str, Any]) -> Dict[str, Any]:
+    """在记忆线程池中执行一次记忆函数调用，供异步处理函数使用"""
+    def call():
+        return FunctionCallingMemorySystem(user_id).process_function_call(function_name, arguments)
+    return await run_memory_io(call)
@@ -0,0 +1,123 @@
+import os
+import time
+import asyncio
+import logging
+from collections import Counter
+
+# 第一条消息超过这个长度时，认为是被 Telegram 拆开的长文本，等待后续的分片
+LONG_TEXT_THRESHOLD = int(os.environ.get('LONG_TEXT_THRESHOLD', '800'))
+# 距离上一条分片超过这个时间（毫秒）没有新消息就合并发出
+LONG_TEXT_IDLE = int(os.environ.get('LONG_TEXT_IDLE', '2000'))
+# 从第一条分片开始最多等待的时间（毫秒）
+LONG_TEXT_MAX_WAIT = int(os.environ.get('LONG_TEXT_MAX_WAIT', '10000'))
+# 一次最多合并的消息条数和字符数，达到任意一个就立即发出
+LONG_TEXT_MAX_MESSAGES = int(os.environ.get('LONG_TEXT_MAX_MESSAGES', '20'))
+LONG_TEXT_MAX_CHARS = int(os.environ.get('LONG_TEXT_MAX_CHARS', '40000'))
+# 每隔多少秒把合并情况的统计写入日志，0 表示不记录
+LONG_TEXT_STATS_INTERVAL = int(os.environ.get('LONG_TEXT_STATS_INTERVAL', '3600'))
+
+class _Batch:
+    __slots__ = ("messages", "chars", "started_at", "updated_at", "arrived")
+
+    def __init__(self, message):
+        self.messages = [message]
+        self.chars = len(message)
+        self.started_at = self.updated_at = time.monotonic()
+        self.arrived = asyncio.Event()
+
+    def add(self, message):
+        self.messages.append(message)
+        self.chars += len(message)
+        self.updated_at = time.monotonic()
+        self.arrived.set()
+
+class MessageCoalescer:
+    """按对话合并被 Telegram 拆成多条的长消息
+
+    每个对话有自己的缓冲区和计时器，不同对话之间互不等待。
+    第一条消息较短时直接返回；较长时由这条消息的处理协程负责等待后续分片，
+    在空闲超时、达到最长等待时间、条数或字符数上限时把整批消息合并返回，
+    后续分片的处理协程直接得到 None。
+    """
+
+    def __init__(self, threshold=None, idle=None, max_wait=None, max_messages=None, max_chars=None):
+        self.threshold = LONG_TEXT_THRESHOLD if threshold is None else threshold
+        self.idle = (LONG_TEXT_IDLE if idle is None else idle) / 1000
+        self.max_wait = (LONG_TEXT_MAX_WAIT if max_wait is None else max_wait) / 1000
+        self.max_messages = LONG_TEXT_MAX_MESSAGES if max_messages is None else max_messages
+        self.max_chars = LONG_TEXT_MAX_CHARS if max_chars is None else max_chars
+        self._batches = {}
+        # 指标：合并后的批次数、收到的消息数、每批消息条数的分布
+        self.batch_count = 0
+        self.message_count = 0
+        self.batch_sizes = Counter()
+
+    def _is_full(self, batch):
+        return len(batch.messages) >= self.max_messages or batch.chars >= self.max_chars
+
+    def _finish(self, key, batch):
+        size = len(batch.messages)
+        self.batch_count += 1
+        self.message_count += size
+        self.batch_sizes[size] += 1
+        if size > 1:
+            logging.info(f"Chat ID {key} 合并了 {size} 条消息，共 {batch.chars} 个字符，"
+                         f"耗时 {batch.updated_at - batch.started_at:.2f} 秒")
+        return "\n".join(batch.messages)
+
+    async def submit(self, key, message):
+        """提交一条消息
+
+        参数：
+            key: 对话ID，不同对话的消息不会被合并
+            message: 消息文本
+
+        返回：
+            合并后的完整消息；如果这条消息被并入了其他协程负责的批次，返回 None
+        """
+        batch = self._batches.get(key)
+        if batch is not None:
+            batch.add(message)
+            return None
+
+        batch = _Batch(message)
+        if len(message) <= self.threshold:
+            return self._finish(key, batch)
+
+        self._batches[key] = batch
+        try:
+            while not self._is_full(batch):
+                deadline = min(batch.updated_at + self.idle, batch.started_at + self.max_wait)
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                batch.arrived.clear()
+                try:
+                    await asyncio.wait_for(batch.arrived.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if self._batches.get(key) is batch:
+                del self._batches[key]
+        return self._finish(key, batch)
+
+    def stats(self):
+        """返回合并情况的统计信息"""
+        return {
+            "batches": self.batch_count,
+            "messages": self.message_count,
+            "coalesced": self.message_count - self.batch_count,
+            "pending": len(self._batches),
+            "batch_sizes": dict(sorted(self.batch_sizes.items())),
+        }
+
+message_coalescer = MessageCoalescer()
+
+async def log_coalescer_stats_job(context):
+    """JobQueue 定时任务：把长消息合并的统计写入日志"""
+    stats = message_coalescer.stats()
+    logging.info(
+        f"长消息合并：共 {stats['batches']} 批、{stats['messages']} 条消息，合并掉 {stats['coalesced']} 条，"
+        f"等待中 {stats['pending']} 批，每批条数分布 {stats['batch_sizes']}"
+    )
+    return stats
@@ -0,0 +1,99 @@
+import os
+import logging
+from collections import Counter
+
+# 是否先在本地给用户打分，只有分数不明确的用户才请求模型决策
+PROACTIVE_GATE_ENABLED = os.environ.get('PROACTIVE_GATE_ENABLED', 'True').lower() not in ('false', '0', 'no')
+# 分数低于这个值时直接不发送，不调用决策模型
+PROACTIVE_GATE_LOW = float(os.environ.get('PROACTIVE_GATE_LOW', '0.35'))
+# 分数不低于这个值时跳过决策，直接生成并发送主动消息
+PROACTIVE_GATE_HIGH = float(os.environ.get('PROACTIVE_GATE_HIGH', '0.85'))
+# 用户多少小时没有说话时，空闲程度记为满分
+PROACTIVE_GATE_IDLE_HOURS = float(os.environ.get('PROACTIVE_GATE_IDLE_HOURS', '12'))
+
+# 各项特征的权重，合计为 1
+WEIGHTS = {
+    "idle": 0.35,
+    "time_of_day": 0.2,
+    "reply": 0.2,
+    "acceptance": 0.25,
+}
+
+# 没有数据的特征记为中性的得分，新用户不会因为缺少数据被直接发送或直接拒绝
+NEUTRAL_SCORE = 0.5
+
+def time_of_day_score(hour):
+    """一天中不同时段适合主动打扰的程度：上午和晚上最合适，清晨和深夜最不合适"""
+    if hour < 9:
+        return 0.4
+    if hour < 12:
+        return 1.0
+    if hour < 14:
+        return 0.7
+    if hour < 18:
+        return 0.6
+    if hour < 22:
+        return 1.0
+    return 0.3
+
+def score_features(hours_since_chat, hour, reply_ratio, acceptance_rate):
+    """把各项特征合成 0-1 之间的分数
+
+    参数：
+        hours_since_chat: 距离用户最后说话的小时数，没有聊天记录时为 None
+        hour: 当前小时（东八区）
+        reply_ratio: 最近对话中用户消息所占的比例，用户基本不回复时接近 0，没有对话时为 None
+        acceptance_rate: 最近的主动消息得到回复的比例，没有发过主动消息时为 None
+
+    返回：
+        (分数, 各项特征的得分)
+    """
+    if hours_since_chat is None:
+        idle = NEUTRAL_SCORE
+    elif PROACTIVE_GATE_IDLE_HOURS > 0:
+        idle = min(1.0, max(0.0, hours_since_chat) / PROACTIVE_GATE_IDLE_HOURS)
+    else:
+        idle = 1.0
+    features = {
+        "idle": idle,
+        "time_of_day": time_of_day_score(hour),
+        # 用户和机器人各说一半时记为满分
+        "reply": NEUTRAL_SCORE if reply_ratio is None else min(1.0, max(0.0, reply_ratio) * 2),
+        "acceptance": NEUTRAL_SCORE if acceptance_rate is None else min(1.0, max(0.0, acceptance_rate)),
+    }
+    return sum(WEIGHTS[name] * value for name, value in features.items()), features
+
+class ProactiveGate:
+    """在请求模型决策之前做本地判断
+
+    分数低于 low 的用户直接不发送，不低于 high 的用户跳过决策直接生成消息，
+    两者之间的用户才请求决策模型。stats 记录各种结果的次数以及因此节省的模型调用次数。
+    """
+
+    def __init__(self, low=PROACTIVE_GATE_LOW, high=PROACTIVE_GATE_HIGH, enabled=PROACTIVE_GATE_ENABLED):
+        self.low = low
+        self.high = high
+        self.enabled = enabled
+        self.stats = Counter()
+
+    def evaluate(self, hours_since_chat, hour, reply_ratio, acceptance_rate):
+        """返回 ("decline" | "send" | "escalate", 分数)"""
+        if not self.enabled:
+            self.stats["escalated"] += 1
+            return "escalate", None
+        score, features = score_features(hours_since_chat, hour, reply_ratio, acceptance_rate)
+        if score < self.low:
+            verdict = "decline"
+            self.stats["declined"] += 1
+            # 省掉了一次决策调用
+            self.stats["model_calls_saved"] += 1
+        elif score >= self.high:
+            verdict = "send"
+            self.stats["sent"] += 1
+            # 直接生成消息，省掉了决策调用，只调用一次生成消息的模型
+            self.stats["model_calls_saved"] += 1
+        else:
+            verdict = "escalate"
+            self.stats["escalated"] += 1
+        logging.debug(f"主动消息本地判断: {verdict}, 分数 {score:.2f}, 特征 {features}")
+        return verdict, score
@@ -1,17 +1,23 @@
 import os
 import json
 import logging
-import random
 from datetime import datetime, timedelta
 import asyncio
 import re
+import time
 import datetime as dt
 import pytz  # 添加pytz库用于时区转换
 import traceback  # 添加traceback模块用于详细错误信息
+from contextlib import nullcontext
 
 from telegram.ext import ContextTypes
 from config import Users, get_robot, GOOGLE_AI_API_KEY, ChatGPTbot
 from utils.message_splitter import process_structured_messages
+from utils.storage import add_turn, clear_conversation
+from utils.proactive_scheduler import ProactiveScheduler, PROACTIVE_MIN_INTERVAL_HOURS
+from utils.proactive_gate import ProactiveGate
+from utils.conversation_state import conversation_tracker, message_text
+from utils.side_conversation import side_conversations
 
 # 配置项
 PROACTIVE_AGENT_ENABLED = os.environ.get('PROACTIVE_AGENT_ENABLED', 'false').lower() == 'true'
@@ -22,8 +28,9 @@ ADMIN_LIST = os.environ.get('ADMIN_LIST', '')
 MAX_CONTINUOUS_MESSAGES = int(os.environ.get('MAX_CONTINUOUS_MESSAGES', '2'))  # 最大连续消息数量，默认改为2
 CONTINUOUS_MESSAGE_DELAY = int(os.environ.get('CONTINUOUS_MESSAGE_DELAY', '30'))  # 连续消息之间的延迟（秒）
 
-# 添加：用户最后对话时间（用户ID -> 最后对话时间）
-last_user_chat_time = {}
+# 主动消息检查配置
+PROACTIVE_CHECK_CONCURRENCY = int(os.environ.get('PROACTIVE_CHECK_CONCURRENCY', '8'))  # 同时请求模型决策的用户数
+PROACTIVE_CHECK_TIMEOUT = float(os.environ.get('PROACTIVE_CHECK_TIMEOUT', '60'))  # 单个用户决策的超时时间（秒）
 
 # 定义东八区时区
 CHINA_TZ = pytz.timezone('Asia/Shanghai')
@@ -34,8 +41,12 @@ proactive_desire = {}
 # 添加：连续对话状态（用户ID -> 状态）
 continuous_conversation_state = {}
 
-# 添加：计划的消息时间（用户ID -> 时间列表）
-planned_message_times = {}
+# 最后对话时间、最后主动消息时间和规划的消息时间保存在调度器中，重启后恢复
+scheduler = ProactiveScheduler()
+# 调度状态中用户最后对话时间的批量写回间隔（秒）
+PROACTIVE_STATE_FLUSH_INTERVAL = int(os.environ.get('PROACTIVE_STATE_FLUSH_INTERVAL', '60'))
+# 请求决策模型之前的本地判断，记录节省了多少次模型调用
+gate = ProactiveGate()
 
 # 获取当前东八区时间
 def get_china_time():
@@ -45,18 +56,34 @@ def get_china_time():
 # 更新用户最后对话时间
 def update_last_chat_time(user_id):
     """更新用户最后对话时间"""
-    last_user_chat_time[user_id] = get_china_time()
-    logging.info(f"更新用户 {user_id} 的最后对话时间为 {last_user_chat_time[user_id]}")
+    user_id = str(user_id)
+    # 只为会收到主动消息的管理员记录
+    if user_id not in get_admin_ids():
+        return
+    scheduler.record_chat(user_id, get_china_time())
 
 # 检查是否应该发送主动消息
-async def check_proactive_desire(context: ContextTypes.DEFAULT_TYPE):
-    """定期检查所有用户，让模型自主决定是否发送主动消息"""
+async def check_proactive_desire(context: ContextTypes.DEFAULT_TYPE, user_ids=None):
+    """检查到期的用户，让模型自主决定是否发送主动消息
+
+    user_ids 为 None 时检查所有管理员。
+
+    先用不需要调用模型的条件过滤掉不应该打扰的用户，再由本地打分（gate）处理明确的情况：
+    分数很低的直接不发送，分数很高的跳过决策直接生成消息，只有分数不明确的用户请求模型决策。
+    需要调用模型的用户并发处理，同时进行的不超过 PROACTIVE_CHECK_CONCURRENCY 个，
+    单个用户超过 PROACTIVE_CHECK_TIMEOUT 秒就放弃，不会拖慢其他用户。
+
+    返回：
+        本轮检查的统计：skipped（被过滤）、gated（本地判断不发送）、direct（本地判断直接发送）、
+        evaluated（请求了模型决策）、messaged（发送了消息）、failed（出错）、timed_out（决策超时）、
+        elapsed（耗时秒数）；没有执行检查时返回 None
+    """
     if not PROACTIVE_AGENT_ENABLED:
         return
     
     try:
         # 获取管理员ID列表
-        admin_ids = get_admin_ids()
+        admin_ids = get_admin_ids() if user_ids is None else list(user_ids)
         if not admin_ids:
             return
         
@@ -64,86 +91,151 @@ async def check_proactive_desire(context: ContextTypes.DEFAULT_TYPE):
         current_time = get_china_time()
         current_hour = current_time.hour
         
-        # 如果当前时间不在7-24点之间，不执行检查
-        if current_hour < 7 or current_hour > 24:
+        # 如果当前时间在免打扰时间内，不执行检查
+        if current_hour < scheduler.start_hour or current_hour >= scheduler.end_hour:
             logging.info(f"当前时间 {current_hour}点 不在主动消息时间范围内，跳过检查")
             return
         
         logging.info(f"开始检查主动对话，当前时间: {current_time.strftime('%Y-%m-%d %H:%M:%S')}")
+        started = time.monotonic()
+        summary = {"skipped": 0, "gated": 0, "direct": 0, "evaluated": 0, "messaged": 0, "failed": 0, "timed_out": 0}
         
-        # 遍历所有用户
+        # 先过滤和本地打分，只为需要调用模型的用户创建任务
+        candidates = []
         for user_id in admin_ids:
             try:
-                # 获取机器人实例和相关配置
-                robot, _, api_key, api_url = get_robot(str(user_id))
-                main_convo_id = str(user_id)
-                
-                # 检查是否有对话历史
-                if main_convo_id in robot.conversation and len(robot.conversation[main_convo_id]) >= 1:
-                    # 获取最后一条消息
-                    last_message = robot.conversation[main_convo_id][-1]
-                    
-                    # 如果最后一条是用户消息，且不是系统添加的虚拟消息，说明用户正在等待回复
-                    if (last_message.get("role") == "user" and 
-                        "我想和你聊聊天" not in last_message.get("content", "") and
-                        "我想继续和你聊天" not in last_message.get("content", "")):
-                        logging.info(f"用户 {user_id} 正在等待回复，跳过主动消息")
-                        continue
-                
-                # 检查连续主动消息数量
-                continuous_bot_messages = 0
-                if main_convo_id in robot.conversation:
-                    # 从最后一条消息开始向前检查
-                    for msg in reversed(robot.conversation[main_convo_id]):
-                        # 如果遇到用户消息，停止计数
-                        if msg.get("role") == "user" and "我想和你聊聊天" not in msg.get("content", "") and "我想继续和你聊天" not in msg.get("content", ""):
-                            break
-                        # 如果是机器人消息，增加计数
-                        if msg.get("role") == "assistant":
-                            continuous_bot_messages += 1
-                    
-                    # 如果已经有两条或更多连续机器人消息，跳过发送
-                    if continuous_bot_messages >= MAX_CONTINUOUS_MESSAGES:
-                        logging.info(f"用户 {user_id} 已有 {continuous_bot_messages} 条连续机器人消息未回复，跳过主动消息")
-                        continue
-                
-                # 获取上次发送主动消息的时间
-                last_proactive_time = getattr(robot, 'last_proactive_time', {}).get(user_id, datetime.fromtimestamp(0))
-                
-                # 确保 last_proactive_time 有时区信息
-                if last_proactive_time.tzinfo is None:
-                    # 如果没有时区信息，添加东八区时区
-                    last_proactive_time = CHINA_TZ.localize(last_proactive_time)
-                
-                # 计算距离上次主动消息的时间（小时）
-                hours_since_last_proactive = (current_time - last_proactive_time).total_seconds() / 3600
-                
-                # 如果距离上次主动消息不足2小时，跳过检查
-                if hours_since_last_proactive < 2:
-                    logging.info(f"距离上次主动消息仅 {hours_since_last_proactive:.1f} 小时，跳过检查")
-                    continue
-                
-                # 获取上次用户对话时间
-                last_chat = last_user_chat_time.get(user_id, current_time - timedelta(hours=24))
-                
-                # 确保 last_chat 有时区信息
-                if last_chat.tzinfo is None:
-                    # 如果没有时区信息，添加东八区时区
-                    last_chat = CHINA_TZ.localize(last_chat)
-                
-                # 计算距离上次用户对话的时间（小时）
-                hours_since_last_chat = (current_time - last_chat).total_seconds() / 3600
-                
-                # 获取系统提示词
-                system_prompt = Users.get_config(str(user_id), "systemprompt")
-                
-                # 添加当前东八区日期和时间
-                current_datetime = datetime.now(CHINA_TZ)
-                current_date = current_datetime.strftime("%Y-%m-%d")
-                current_time_str = current_datetime.strftime("%H:%M")
+                skip_reason = proactive_skip_reason(user_id, current_time)
+                verdict = None if skip_reason else proactive_gate_verdict(user_id, current_time)
+            except Exception as e:
+                logging.error(f"为用户 {user_id} 检查主动消息条件时出错: {str(e)}")
+                summary["failed"] += 1
+                continue
+            if skip_reason:
+                logging.info(f"用户 {user_id} {skip_reason}，跳过主动消息")
+                summary["skipped"] += 1
+            elif verdict == "decline":
+                summary["gated"] += 1
+            else:
+                candidates.append((user_id, verdict))
+        
+        semaphore = asyncio.Semaphore(max(1, PROACTIVE_CHECK_CONCURRENCY))
+        
+        async def evaluate(user_id, verdict):
+            async with semaphore:
+                if verdict == "send":
+                    sent = await send_proactive_message(context, user_id, "本地判断适合主动聊天")
+                    return "messaged" if sent else "failed"
+                return await decide_and_send_proactive_message(context, user_id, current_time)
+        
+        results = await asyncio.gather(*(evaluate(*candidate) for candidate in candidates), return_exceptions=True)
+        summary["direct"] = sum(1 for _, verdict in candidates if verdict == "send")
+        summary["evaluated"] = len(candidates) - summary["direct"]
+        for (user_id, _), result in zip(candidates, results):
+            if isinstance(result, BaseException):
+                logging.error(f"为用户 {user_id} 处理主动消息时出错: {str(result)}")
+                traceback.print_exception(type(result), result, result.__traceback__)
+                result = "failed"
+            if result in summary:
+                summary[result] += 1
+        
+        summary["elapsed"] = round(time.monotonic() - started, 3)
+        side = side_conversations.stats()
+        logging.info(
+            f"主动对话检查完成：跳过 {summary['skipped']} 个用户，本地判断不发送 {summary['gated']} 个、"
+            f"直接发送 {summary['direct']} 个，模型决策 {summary['evaluated']} 个，"
+            f"发送 {summary['messaged']} 个，超时 {summary['timed_out']} 个，出错 {summary['failed']} 个，"
+            f"耗时 {summary['elapsed']:.1f} 秒；累计节省模型调用 {gate.stats['model_calls_saved']} 次；"
+            f"临时对话正在使用 {side['live']} 个、空闲 {side['idle']} 个、累计创建 {side['created']} 个"
+        )
+        return summary
                 
-                # 构建特殊的系统提示词，让模型自主决定是否发送主动消息
-                decision_prompt = f"""当前日期和时间（东八区）：{current_date} {current_time_str}
+    except Exception as e:
+        logging.error(f"检查主动对话时出错: {str(e)}")
+        traceback.print_exc()
+
+# 获取对话摘要
+def get_conversation_state(robot, convo_id):
+    """返回对话的摘要（最后一条消息、连续机器人消息数、最近的真实消息等），没有对话历史时返回 None
+
+    摘要由 add_turn() 在加入消息时更新；没有经过 add_turn() 的对话第一次用到时从历史建立一次。
+    """
+    messages = robot.conversation[convo_id] if convo_id in robot.conversation else None
+    return conversation_tracker.get(convo_id, messages)
+
+# 判断是否不需要为用户请求主动消息决策
+def proactive_skip_reason(user_id, current_time):
+    """不调用模型的预过滤，返回跳过的原因，需要请求模型决策时返回 None"""
+    robot, _, _, _ = get_robot(str(user_id))
+    main_convo_id = str(user_id)
+    
+    # 获取上次发送主动消息的时间
+    last_proactive_time = scheduler.last_proactive(user_id)
+    
+    # 如果距离上次主动消息的间隔不够，跳过检查
+    if last_proactive_time is not None:
+        hours_since_last_proactive = (current_time - last_proactive_time).total_seconds() / 3600
+        if hours_since_last_proactive < PROACTIVE_MIN_INTERVAL_HOURS:
+            return f"距离上次主动消息仅 {hours_since_last_proactive:.1f} 小时"
+    
+    state = get_conversation_state(robot, main_convo_id)
+    if state is None:
+        return None
+    
+    # 如果最后一条是用户消息，且不是系统添加的虚拟消息，说明用户正在等待回复
+    if state.awaiting_reply:
+        return "正在等待回复"
+    
+    # 检查连续主动消息数量：最后一条真实用户消息之后机器人说了几条
+    if state.trailing_assistant >= MAX_CONTINUOUS_MESSAGES:
+        return f"已有 {state.trailing_assistant} 条连续机器人消息未回复"
+    return None
+
+# 本地判断是否需要请求模型决策
+def proactive_gate_verdict(user_id, current_time):
+    """用空闲时间、时段、回复情况和主动消息回复率给用户打分，返回 decline、send 或 escalate"""
+    robot, _, _, _ = get_robot(str(user_id))
+    main_convo_id = str(user_id)
+    
+    # 没有数据的特征传 None，由本地判断按中性处理
+    last_chat = scheduler.last_chat(user_id)
+    hours_since_chat = (current_time - last_chat).total_seconds() / 3600 if last_chat else None
+    
+    # 最近的对话中真实用户消息所占的比例，不计系统添加的虚拟消息
+    state = get_conversation_state(robot, main_convo_id)
+    reply_ratio = state.reply_ratio if state is not None else None
+    
+    verdict, score = gate.evaluate(
+        hours_since_chat, current_time.hour, reply_ratio, scheduler.acceptance_rate(user_id, current_time, default=None)
+    )
+    if score is not None:
+        logging.info(f"用户 {user_id} 的主动消息本地评分 {score:.2f}，判断结果: {verdict}")
+    return verdict
+
+# 为单个用户请求主动消息决策，决定发送时发送消息
+async def decide_and_send_proactive_message(context: ContextTypes.DEFAULT_TYPE, user_id, current_time):
+    """让模型决定是否给用户发送主动消息
+
+    返回：
+        "messaged"（已发送）、"declined"（模型决定不发送）、"timed_out"（决策超时）或 "failed"（出错）
+    """
+    robot, _, _, _ = get_robot(str(user_id))
+    
+    # 获取上次用户对话时间
+    last_chat = scheduler.last_chat(user_id) or current_time - timedelta(hours=24)
+    
+    # 计算距离上次用户对话的时间（小时）
+    hours_since_last_chat = (current_time - last_chat).total_seconds() / 3600
+    
+    # 获取系统提示词
+    system_prompt = Users.get_config(str(user_id), "systemprompt")
+    
+    # 添加当前东八区日期和时间
+    current_datetime = datetime.now(CHINA_TZ)
+    current_date = current_datetime.strftime("%Y-%m-%d")
+    current_time_str = current_datetime.strftime("%H:%M")
+    
+    # 构建特殊的系统提示词，让模型自主决定是否发送主动消息
+    decision_prompt = f"""当前日期和时间（东八区）：{current_date} {current_time_str}
 
 {system_prompt}
 
@@ -162,85 +254,88 @@ async def check_proactive_desire(context: ContextTypes.DEFAULT_TYPE):
 ```
 
 注意：如果决定不发送消息，message字段可以留空。如果决定发送，请确保message字段包含有意义的内容。"""
-                
-                # 调用AI获取决策
-                model = os.environ.get('PROACTIVE_AGENT_MODEL', 'gemini-2.5-flash-preview-04-17')
-                decision_response = await get_ai_response(user_id, "请决定是否要发送主动消息", decision_prompt, save_to_history=False, model=model)
-                
-                if not decision_response:
-                    logging.error(f"无法为用户 {user_id} 获取主动消息决策")
-                    continue
-                
-                # 尝试解析JSON响应
-                try:
-                    # 尝试提取JSON部分（可能包含在代码块中）
-                    json_match = re.search(r'```(?:json)?\s*({[\s\S]*?})\s*```', decision_response)
-                    if json_match:
-                        decision_json = json.loads(json_match.group(1))
-                    else:
-                        # 尝试直接解析整个响应
-                        decision_json = json.loads(decision_response)
-                    
-                    # 获取决策
-                    should_send = decision_json.get("decision", False)
-                    reason = decision_json.get("reason", "未提供理由")
-                    message_content = decision_json.get("message", "")
-                    
-                    logging.info(f"AI决策: 是否发送主动消息 = {should_send}, 理由: {reason}")
-                    
-                    # 如果决定发送消息
-                    if should_send and message_content:
-                        # 处理结构化消息，检查是否需要拆分发送
-                        processed_result = await process_structured_messages(
-                            message_content, 
-                            context, 
-                            user_id
-                        )
-                        
-                        # 如果处理后的结果不为空字符串，说明消息没有被拆分发送，使用普通方式发送
-                        if processed_result != "":
-                            await context.bot.send_message(chat_id=user_id, text=processed_result)
-                        
-                        # 将消息保存到对话历史
-                        if main_convo_id in robot.conversation:
-                            # 添加虚拟的用户消息，表示用户想聊天（但不会显示给用户）
-                            robot.add_to_conversation({"role": "user", "content": "我想和你聊聊天"}, main_convo_id)
-                            # 添加机器人的回复，并包含时间戳
-                            robot.add_to_conversation({
-                                "role": "assistant", 
-                                "content": message_content,
-                                "timestamp": str(current_datetime.timestamp())
-                            }, main_convo_id)
-                            logging.info(f"已发送主动消息给用户 {user_id} 并加入到主对话历史")
-                        
-                        # 记录本次主动消息时间
-                        if not hasattr(robot, 'last_proactive_time'):
-                            robot.last_proactive_time = {}
-                        robot.last_proactive_time[user_id] = current_datetime
-                        
-                        # 设置检查用户回复的定时任务
-                        # 如果用户在一定时间内没有回复，可能会发送后续消息
-                        job_name = f"check_response_{user_id}"
-                        remove_job_if_exists(job_name, context)
-                        context.job_queue.run_once(
-                            lambda ctx: asyncio.create_task(check_user_response(ctx, user_id)),
-                            CONTINUOUS_MESSAGE_DELAY,
-                            name=job_name
-                        )
-                    else:
-                        logging.info(f"AI决定不发送主动消息给用户 {user_id}: {reason}")
-                
-                except Exception as e:
-                    logging.error(f"解析AI决策时出错: {str(e)}")
-                    traceback.print_exc()
-                
-            except Exception as e:
-                logging.error(f"为用户 {user_id} 处理主动消息时出错: {str(e)}")
-                traceback.print_exc()
-                
+    
+    # 调用AI获取决策，超时只取消决策本身，不会中断已经开始的发送
+    model = os.environ.get('PROACTIVE_AGENT_MODEL', 'gemini-2.5-flash-preview-04-17')
+    try:
+        decision_response = await asyncio.wait_for(
+            get_ai_response(user_id, "请决定是否要发送主动消息", decision_prompt, save_to_history=False, model=model),
+            timeout=PROACTIVE_CHECK_TIMEOUT,
+        )
+    except asyncio.TimeoutError:
+        logging.warning(f"为用户 {user_id} 获取主动消息决策超过 {PROACTIVE_CHECK_TIMEOUT} 秒，本轮跳过")
+        return "timed_out"
+    
+    if not decision_response:
+        logging.error(f"无法为用户 {user_id} 获取主动消息决策")
+        return "failed"
+    
+    # 尝试解析JSON响应
+    try:
+        # 尝试提取JSON部分（可能包含在代码块中）
+        json_match = re.search(r'```(?:json)?\s*({[\s\S]*?})\s*```', decision_response)
+        if json_match:
+            decision_json = json.loads(json_match.group(1))
+        else:
+            # 尝试直接解析整个响应
+            decision_json = json.loads(decision_response)
     except Exception as e:
-        logging.error(f"检查主动对话时出错: {str(e)}")
-        traceback.print_exc()
+        logging.error(f"解析AI决策时出错: {str(e)}")
+        return "failed"
+    
+    # 获取决策
+    should_send = decision_json.get("decision", False)
+    reason = decision_json.get("reason", "未提供理由")
+    message_content = decision_json.get("message", "")
+    
+    logging.info(f"AI决策: 是否发送主动消息 = {should_send}, 理由: {reason}")
+    
+    if not (should_send and message_content):
+        logging.info(f"AI决定不发送主动消息给用户 {user_id}: {reason}")
+        return "declined"
+    
+    await deliver_proactive_message(context, robot, user_id, message_content, current_datetime)
+    return "messaged"
+
+# 发送已经生成好的主动消息，并记录到对话历史和调度器
+async def deliver_proactive_message(context, robot, user_id, message_content, sent_at):
+    """发送主动消息，加入主对话历史，记录发送时间，并安排检查用户是否回复"""
+    # 处理结构化消息，检查是否需要拆分发送
+    processed_result = await process_structured_messages(
+        message_content, 
+        context, 
+        user_id
+    )
+    
+    # 如果处理后的结果不为空字符串，说明消息没有被拆分发送，使用普通方式发送
+    if processed_result != "":
+        await context.bot.send_message(chat_id=user_id, text=processed_result)
+    
+    # 将消息保存到对话历史
+    main_convo_id = str(user_id)
+    if main_convo_id in robot.conversation:
+        # 添加虚拟的用户消息，表示用户想聊天（但不会显示给用户）
+        await add_turn(robot, {"role": "user", "content": "我想和你聊聊天"}, main_convo_id)
+        # 添加机器人的回复，并包含时间戳
+        await add_turn(robot, {
+            "role": "assistant", 
+            "content": message_content,
+            "timestamp": str(sent_at.timestamp())
+        }, main_convo_id)
+        logging.info(f"已发送主动消息给用户 {user_id} 并加入到主对话历史")
+    
+    # 记录本次主动消息时间
+    scheduler.record_proactive(user_id, sent_at)
+    
+    # 设置检查用户回复的定时任务
+    # 如果用户在一定时间内没有回复，可能会发送后续消息
+    job_name = f"check_response_{user_id}"
+    remove_job_if_exists(job_name, context)
+    context.job_queue.run_once(
+        lambda ctx: asyncio.create_task(check_user_response(ctx, user_id)),
+        CONTINUOUS_MESSAGE_DELAY,
+        name=job_name
+    )
 
 # 获取管理员ID列表
 def get_admin_ids():
@@ -262,7 +357,7 @@ def remove_job_if_exists(name, context):
 
 # 发送主动消息
 async def send_proactive_message(context: ContextTypes.DEFAULT_TYPE, user_id: str, reason: str):
-    """发送主动消息给用户"""
+    """发送主动消息给用户，返回是否发送成功"""
     try:
         # 获取机器人实例和相关配置
         robot, _, api_key, api_url = get_robot(str(user_id))
@@ -276,54 +371,21 @@ async def send_proactive_message(context: ContextTypes.DEFAULT_TYPE, user_id: st
         current_time = current_datetime.strftime("%H:%M")
         system_prompt = f"当前日期和时间（东八区）：{current_date} {current_time}\n\n{system_prompt}"
         
-        # 生成消息内容
+        # 生成消息内容，超时由 generate_message_content 处理，超时返回 None
         model = os.environ.get('PROACTIVE_AGENT_MODEL', 'gemini-2.5-flash-preview-04-17')
         message_content = await generate_message_content(user_id, reason, system_prompt, save_to_history=False, model=model)
         
         if not message_content:
             logging.error(f"无法为用户 {user_id} 生成主动消息")
-            return
-        
-        # 处理结构化消息，检查是否需要拆分发送
-        processed_result = await process_structured_messages(
-            message_content, 
-            context, 
-            user_id
-        )
-        
-        # 如果处理后的结果不为空字符串，说明消息没有被拆分发送，使用普通方式发送
-        if processed_result != "":
-            await context.bot.send_message(chat_id=user_id, text=processed_result)
+            return False
         
-        # 将消息保存到对话历史
-        main_convo_id = str(user_id)
-        if main_convo_id in robot.conversation:
-            # 添加虚拟的用户消息，表示用户想聊天（但不会显示给用户）
-            robot.add_to_conversation({"role": "user", "content": "我想和你聊聊天"}, main_convo_id)
-            # 添加机器人的回复，并包含时间戳
-            robot.add_to_conversation({
-                "role": "assistant", 
-                "content": message_content,
-                "timestamp": str(current_datetime.timestamp())
-            }, main_convo_id)
-            logging.info(f"已发送主动消息给用户 {user_id} 并加入到主对话历史")
-        
-        # 记录本次主动消息时间
-        if not hasattr(robot, 'last_proactive_time'):
-            robot.last_proactive_time = {}
-        robot.last_proactive_time[user_id] = current_datetime
-        
-        # 设置检查用户回复的定时任务
-        job_id = f"check_response_{user_id}"
-        context.job_queue.run_once(
-            lambda ctx: asyncio.create_task(check_user_response(ctx, user_id)),
-            30,
-            name=job_id
-        )
+        await deliver_proactive_message(context, robot, user_id, message_content, current_datetime)
+        return True
         
     except Exception as e:
         logging.error(f"发送主动消息给用户 {user_id} 时出错: {str(e)}")
         traceback.print_exc()
+        return False
 
 # 检查用户是否回复
 async def check_user_response(context: ContextTypes.DEFAULT_TYPE, user_id: str):
@@ -333,173 +395,132 @@ async def check_user_response(context: ContextTypes.DEFAULT_TYPE, user_id: str):
         robot, _, api_key, api_url = get_robot(str(user_id))
         main_convo_id = str(user_id)
         
-        # 检查用户是否已回复
-        last_user_message_time = None
-        last_bot_message_time = None
-        last_bot_message = None
+        # 从对话摘要读取最后的消息，不需要重新扫描历史
+        state = get_conversation_state(robot, main_convo_id)
+        if state is None or not state.recent:
+            logging.info(f"用户 {user_id} 没有有效的对话历史")
+            return
+        
+        # 最后一条真实用户消息之后还有机器人消息，说明用户还没有回复
+        if not state.trailing_assistant:
+            logging.info(f"用户 {user_id} 已回复，不需要发送后续消息")
+            return
+        
+        # 如果找不到最后一条机器人消息的时间，无法判断等待了多久
+        if state.last_bot_time is None:
+            return
         
+        # 计算时间差（分钟）
+        current_time = get_china_time()
+        last_message_datetime = datetime.fromtimestamp(state.last_bot_time, CHINA_TZ)
+        time_diff = (current_time - last_message_datetime).total_seconds() / 60
+        
+        logging.info(f"用户 {user_id} 的最后一条机器人消息发送于 {time_diff:.1f} 分钟前")
+        
+        # 已发送的连续消息数量
+        continuous_count = state.trailing_assistant
+        
+        # 严格限制连续消息数量，确保不超过MAX_CONTINUOUS_MESSAGES
+        if continuous_count >= MAX_CONTINUOUS_MESSAGES - 1:
+            logging.info(f"用户 {user_id} 已达到最大连续消息数量 {MAX_CONTINUOUS_MESSAGES}，不再发送后续消息")
+            return
+        if time_diff < 2:
+            logging.info(f"用户 {user_id} 的最后一条消息发送时间未超过阈值，不发送后续消息")
+            return
+        
+        # 生成后续消息
+        logging.info(f"用户 {user_id} 在 {time_diff:.1f} 分钟内没有回复，尝试发送后续消息")
+        
+        # 提取最近的对话历史
+        recent_messages = list(state.recent)[-10:]
+        recent_history = ""
+        for msg in recent_messages:
+            role_text = "用户" if msg.get("role") == "user" else "助手"
+            content = message_text(msg).strip()
+            if content:
+                recent_history += f"{role_text}: {content}\n\n"
+        
+        # 构建API格式的历史记录（用于传递给模型）
+        conversation_history = [
+            {"role": msg.get("role"), "content": msg.get("content")}
+            for msg in recent_messages
+        ]
+        
+        # 构建提示词
+        prompt = f"""
+        我注意到用户在我上一条消息后没有回复。作为一个体贴的AI助手，我想发送一条后续消息来继续对话。
+
+        请根据我们之前的对话历史，生成一条自然、有吸引力的后续消息。这条消息应该：
+        1. 与我们之前的对话主题相关
+        2. 展示出我在倾听并理解用户
+        3. 可能提出一个相关的问题或分享一个相关的想法
+        4. 不要显得太过急切或打扰用户
+
+        最近的对话历史：
+        {recent_history}
+
+        我的上一条消息是：
+        {state.last_bot_message}
+
+        请生成一条自然的后续消息，保持对话的连贯性和吸引力。
+        """
+        
+        # 获取系统提示词
+        system_prompt = Users.get_config(str(user_id), "systemprompt")
+        
+        # 调用AI获取响应，传递对话历史；超时就放弃这次后续消息，不会一直占着任务
+        try:
+            response = await asyncio.wait_for(
+                get_ai_response(
+                    user_id=user_id,
+                    message=prompt,
+                    system_prompt=system_prompt,
+                    save_to_history=False,  # 不保存这个提示到历史记录
+                    model=PROACTIVE_AGENT_MODEL,
+                    conversation_history=conversation_history
+                ),
+                timeout=PROACTIVE_CHECK_TIMEOUT,
+            )
+        except asyncio.TimeoutError:
+            logging.warning(f"为用户 {user_id} 生成后续消息超过 {PROACTIVE_CHECK_TIMEOUT} 秒，放弃发送")
+            return
+        
+        # 确保响应不为空
+        if not (response and response.strip()):
+            logging.warning(f"为用户 {user_id} 生成后续消息失败，内容为空")
+            return
+        
+        # 处理结构化消息，检查是否需要拆分发送
+        processed_result = await process_structured_messages(
+            response, 
+            context, 
+            user_id
+        )
+        
+        # 如果处理后的结果不为空字符串，说明消息没有被拆分发送，使用普通方式发送
+        if processed_result != "":
+            # 发送后续消息
+            await context.bot.send_message(chat_id=user_id, text=processed_result)
+        
+        # 将后续消息保存到对话历史
         if main_convo_id in robot.conversation:
-            # 过滤掉系统消息和特殊指令
-            filtered_messages = []
-            for msg in robot.conversation[main_convo_id]:
-                role = msg.get("role", "")
-                content = msg.get("content", "")
-                
-                # 跳过系统消息
-                if role == "system":
-                    continue
-                
-                # 跳过特殊指令
-                if role == "user" and (
-                    content.startswith("/") or 
-                    "我想和你聊聊天" in content or 
-                    "我想继续和你聊天" in content
-                ):
-                    continue
-                
-                filtered_messages.append(msg)
+            await add_turn(robot, {
+                "role": "assistant",
+                "content": response,
+                "timestamp": str(datetime.now(CHINA_TZ).timestamp())
+            }, main_convo_id)
+        
+        logging.info(f"已向用户 {user_id} 发送后续消息")
+        
+        # 如果还没有达到最大连续消息数量，设置下一次检查
+        if continuous_count + 1 < MAX_CONTINUOUS_MESSAGES:
+            context.job_queue.run_once(
+                lambda ctx: asyncio.ensure_future(check_user_response(ctx, user_id)),
+                when=timedelta(seconds=CONTINUOUS_MESSAGE_DELAY),  # 延迟后再次检查
+                name=f"check_response_{user_id}"
+            )
             
-            # 检查最后的消息
-            if filtered_messages:
-                # 获取最后一条消息的角色
-                last_message_role = filtered_messages[-1].get("role", "")
-                
-                # 如果最后一条是机器人消息，说明用户还没有回复
-                if last_message_role == "assistant":
-                    # 获取最后一条机器人消息的时间
-                    last_message_time = None
-                    for msg in reversed(filtered_messages):
-                        if msg.get("role") == "assistant":
-                            last_message_time = msg.get("timestamp")
-                            last_bot_message = msg.get("content", "")
-                            break
-                    
-                    # 获取最后一条用户消息的时间
-                    for msg in reversed(filtered_messages):
-                        if msg.get("role") == "user":
-                            last_user_message_time = msg.get("timestamp")
-                            break
-                    
-                    # 如果找到了最后一条机器人消息的时间
-                    if last_message_time:
-                        # 计算时间差（分钟）
-                        current_time = get_china_time()
-                        last_message_datetime = datetime.fromtimestamp(last_message_time, CHINA_TZ)
-                        time_diff = (current_time - last_message_datetime).total_seconds() / 60
-                        
-                        logging.info(f"用户 {user_id} 的最后一条机器人消息发送于 {time_diff:.1f} 分钟前")
-                        
-                        # 如果时间差超过阈值且未超过最大连续消息数量，发送后续消息
-                        # 获取已发送的连续消息数量
-                        continuous_count = 0
-                        for msg in reversed(filtered_messages):
-                            if msg.get("role") == "user":
-                                break
-                            if msg.get("role") == "assistant":
-                                continuous_count += 1
-                        
-                        # 严格限制连续消息数量，确保不超过MAX_CONTINUOUS_MESSAGES
-                        if time_diff >= 2 and continuous_count < MAX_CONTINUOUS_MESSAGES:
-                            # 再次检查，确保不会超过限制
-                            if continuous_count >= MAX_CONTINUOUS_MESSAGES - 1:
-                                logging.info(f"用户 {user_id} 已达到最大连续消息数量 {MAX_CONTINUOUS_MESSAGES}，不再发送后续消息")
-                                return
-                            
-                            # 生成后续消息
-                            logging.info(f"用户 {user_id} 在 {time_diff:.1f} 分钟内没有回复，尝试发送后续消息")
-                            
-                            # 提取最近的对话历史
-                            recent_history = ""
-                            for msg in filtered_messages[-10:]:
-                                role_text = "用户" if msg.get("role") == "user" else "助手"
-                                content = msg.get("content", "").strip()
-                                if content:
-                                    recent_history += f"{role_text}: {content}\n\n"
-                            
-                            # 构建API格式的历史记录（用于传递给模型）
-                            conversation_history = [
-                                {"role": msg.get("role"), "content": msg.get("content")}
-                                for msg in filtered_messages[-10:]
-                            ]
-                            
-                            # 构建提示词
-                            prompt = f"""
-                            我注意到用户在我上一条消息后没有回复。作为一个体贴的AI助手，我想发送一条后续消息来继续对话。
-
-                            请根据我们之前的对话历史，生成一条自然、有吸引力的后续消息。这条消息应该：
-                            1. 与我们之前的对话主题相关
-                            2. 展示出我在倾听并理解用户
-                            3. 可能提出一个相关的问题或分享一个相关的想法
-                            4. 不要显得太过急切或打扰用户
-
-                            最近的对话历史：
-                            {recent_history}
-
-                            我的上一条消息是：
-                            {last_bot_message}
-
-                            请生成一条自然的后续消息，保持对话的连贯性和吸引力。
-                            """
-                            
-                            # 获取系统提示词
-                            system_prompt = Users.get_config(str(user_id), "systemprompt")
-                            
-                            # 调用AI获取响应，传递对话历史
-                            response = await get_ai_response(
-                                user_id=user_id,
-                                message=prompt,
-                                system_prompt=system_prompt,
-                                save_to_history=False,  # 不保存这个提示到历史记录
-                                model=PROACTIVE_AGENT_MODEL,
-                                conversation_history=conversation_history
-                            )
-                            
-                            # 确保响应不为空
-                            if response and response.strip():
-                                # 处理结构化消息，检查是否需要拆分发送
-                                processed_result = await process_structured_messages(
-                                    response, 
-                                    context, 
-                                    user_id
-                                )
-                                
-                                # 如果处理后的结果不为空字符串，说明消息没有被拆分发送，使用普通方式发送
-                                if processed_result != "":
-                                    # 发送后续消息
-                                    await context.bot.send_message(chat_id=user_id, text=processed_result)
-                                
-                                # 将后续消息保存到对话历史
-                                if main_convo_id in robot.conversation:
-                                    robot.conversation[main_convo_id].append({
-                                        "role": "assistant",
-                                        "content": response,
-                                        "timestamp": datetime.now(CHINA_TZ).timestamp()
-                                    })
-                                
-                                logging.info(f"已向用户 {user_id} 发送后续消息")
-                                
-                                # 如果还没有达到最大连续消息数量，设置下一次检查
-                                if continuous_count + 1 < MAX_CONTINUOUS_MESSAGES:
-                                    context.job_queue.run_once(
-                                        lambda ctx: asyncio.ensure_future(check_user_response(ctx, user_id)),
-                                        when=timedelta(seconds=CONTINUOUS_MESSAGE_DELAY),  # 延迟后再次检查
-                                        name=f"check_response_{user_id}"
-                                    )
-                                    
-                                    logging.info(f"将在 {CONTINUOUS_MESSAGE_DELAY} 秒后再次检查用户 {user_id} 的回复")
-                            else:
-                                logging.warning(f"为用户 {user_id} 生成后续消息失败，内容为空")
-                        else:
-                            if continuous_count >= MAX_CONTINUOUS_MESSAGES:
-                                logging.info(f"用户 {user_id} 已达到最大连续消息数量 {MAX_CONTINUOUS_MESSAGES}，不再发送后续消息")
-                            else:
-                                logging.info(f"用户 {user_id} 的最后一条消息发送时间未超过阈值，不发送后续消息")
-                else:
-                    logging.info(f"用户 {user_id} 已回复，不需要发送后续消息")
-            else:
-                logging.info(f"用户 {user_id} 没有有效的对话历史")
-        else:
-            logging.info(f"用户 {user_id} 没有对话历史")
+            logging.info(f"将在 {CONTINUOUS_MESSAGE_DELAY} 秒后再次检查用户 {user_id} 的回复")
     
     except Exception as e:
         logging.error(f"检查用户回复时出错: {str(e)}")
@@ -516,43 +537,18 @@ async def generate_message_content(user_id, reason, system_prompt, save_to_histo
         # 提取最近的对话历史
         recent_history = ""
         conversation_history = []
-        last_message_time = None
         
-        if main_convo_id in robot.conversation:
-            # 获取最近的对话（最多20轮，即40条消息）
-            recent_messages = robot.conversation[main_convo_id][-40:]
-            
-            # 过滤掉系统消息和提示词
-            filtered_messages = []
-            for msg in recent_messages:
-                role = msg.get("role", "")
-                content = msg.get("content", "")
-                
-                # 排除系统消息和特定内容
-                if (role in ["user", "assistant"] and 
-                    "我想和你聊聊天" not in content and 
-                    "我希望你主动和我聊天" not in content and 
-                    "我想继续和你聊天" not in content and
-                    "# 你的角色基本信息" not in content and 
-                    "当前日期和时间" not in content and
-                    "# 知识与能力设定" not in content and
-                    "# 语气与风格" not in content and
-                    "# 作为女朋友的部分" not in content and
-                    "# 用户的信息" not in content and
-                    content.strip()):
-                    filtered_messages.append(msg)
-                    # 记录最后一条消息的时间戳（如果有）
-                    if msg.get("timestamp"):
-                        last_message_time = msg.get("timestamp")
-            
+        # 对话摘要中保存着最近的真实消息，已经去掉了系统消息、虚拟消息和提示词
+        state = get_conversation_state(robot, main_convo_id)
+        if state is not None:
             # 确保我们有足够的上下文，但不超过模型的限制
             # 通常保留最近的15条消息
-            filtered_messages = filtered_messages[-15:]
+            filtered_messages = list(state.recent)[-15:]
             
             # 构建文本形式的历史记录（用于提示词）
             for msg in filtered_messages:
                 role_text = "用户" if msg.get("role") == "user" else "助手"
-                content = msg.get("content", "").strip()
+                content = message_text(msg).strip()
                 if content:
                     recent_history += f"{role_text}: {content}\n\n"
             
@@ -591,14 +587,21 @@ async def generate_message_content(user_id, reason, system_prompt, save_to_histo
             logging.info(f"历史对话最后一条: {conversation_history[-1].get('role')}: {conversation_history[-1].get('content')[:30]}...")
         
         # 调用AI获取响应，传递对话历史和系统提示词
-        response = await get_ai_response(
-            user_id=user_id,
-            message=user_prompt,
-            system_prompt=system_prompt,  # 使用用户的系统提示词
-            save_to_history=save_to_history,  
-            model=model,
-            conversation_history=conversation_history
-        )
+        try:
+            response = await asyncio.wait_for(
+                get_ai_response(
+                    user_id=user_id,
+                    message=user_prompt,
+                    system_prompt=system_prompt,  # 使用用户的系统提示词
+                    save_to_history=save_to_history,  
+                    model=model,
+                    conversation_history=conversation_history
+                ),
+                timeout=PROACTIVE_CHECK_TIMEOUT,
+            )
+        except asyncio.TimeoutError:
+            logging.warning(f"为用户 {user_id} 生成主动消息超过 {PROACTIVE_CHECK_TIMEOUT} 秒，放弃发送")
+            return None
         
         # 确保响应不为空
         if not response or not response.strip():
@@ -641,42 +644,37 @@ async def get_ai_response(user_id, message, system_prompt, save_to_history=True,
         if not message or not message.strip():
             raise ValueError("消息内容为空")
             
-        # 创建一个临时的对话ID，避免干扰主对话
-        temp_convo_id = str(user_id)
-        if not save_to_history:
-            # 使用临时对话ID，避免污染主对话
-            temp_convo_id = f"proactive_planning_{user_id}_{get_china_time().strftime('%Y%m%d%H%M%S')}"
-            
+        # 不保存到主对话时借用一个临时对话，避免污染主对话，用完后自动清理
+        if save_to_history:
+            conversation_scope = nullcontext(str(user_id))
+        else:
+            conversation_scope = side_conversations.acquire(robot, "proactive")
+        with conversation_scope as temp_convo_id:
             # 如果提供了对话历史，先添加到临时对话中
-            if conversation_history and isinstance(conversation_history, list):
+            if not save_to_history and conversation_history and isinstance(conversation_history, list):
                 logging.info(f"为临时对话 {temp_convo_id} 添加 {len(conversation_history)} 条历史消息")
-                # 清空临时对话，确保没有残留
-                if temp_convo_id in robot.conversation:
-                    robot.conversation[temp_convo_id] = []
-                
-                # 添加历史对话
                 for msg in conversation_history:
                     if isinstance(msg, dict) and "role" in msg and "content" in msg:
                         robot.add_to_conversation(msg, temp_convo_id)
-        
-        # 添加用户消息到对话历史
-        robot.add_to_conversation({"role": "user", "content": message}, temp_convo_id)
-        
-        # 如果是临时对话，打印对话内容以便调试
-        if not save_to_history and temp_convo_id in robot.conversation:
-            logging.info(f"临时对话 {temp_convo_id} 包含 {len(robot.conversation[temp_convo_id])} 条消息")
             
-        # 调用AI获取响应
-        async for data in robot.ask_stream_async(
-            message, 
-            convo_id=temp_convo_id, 
-            system_prompt=system_prompt,
-            model=model_name,
-            api_key=api_key,
-            api_url=api_url
-        ):
-            if isinstance(data, str):
-                response += data
+            # 添加用户消息到对话历史
+            robot.add_to_conversation({"role": "user", "content": message}, temp_convo_id)
+            
+            # 如果是临时对话，打印对话内容以便调试
+            if not save_to_history and temp_convo_id in robot.conversation:
+                logging.info(f"临时对话 {temp_convo_id} 包含 {len(robot.conversation[temp_convo_id])} 条消息")
+                
+            # 调用AI获取响应
+            async for data in robot.ask_stream_async(
+                message, 
+                convo_id=temp_convo_id, 
+                system_prompt=system_prompt,
+                model=model_name,
+                api_key=api_key,
+                api_url=api_url
+            ):
+                if isinstance(data, str):
+                    response += data
         
         # 确保响应不为空
         if not response or not response.strip():
@@ -688,34 +686,94 @@ async def get_ai_response(user_id, message, system_prompt, save_to_history=True,
         traceback.print_exc()
         return f"无法获取AI响应，请稍后再试。错误: {str(e)}"
 
-# 手动触发消息规划（用于测试）
-async def trigger_message_planning(context: ContextTypes.DEFAULT_TYPE):
-    """手动触发消息规划，用于测试"""
-    await plan_daily_messages(context)
-    
-    # 返回已规划的时间信息
-    result = "已触发消息规划\n\n"
+# 为所有管理员规划今天的主动消息时间
+async def plan_daily_messages(context: ContextTypes.DEFAULT_TYPE):
+    """为每个管理员在今天剩余的允许发送时间内规划主动消息时间，并按最早的到期时间安排唤醒"""
+    now = get_china_time()
+    for user_id in get_admin_ids():
+        plans = scheduler.generate_daily_plans(now)
+        scheduler.set_plans(user_id, plans)
+        logging.info(f"已为用户 {user_id} 规划 {len(plans)} 个主动消息时间: "
+                     f"{[plan['time'].strftime('%H:%M') for plan in plans]}")
+    arm_proactive_wake(context.job_queue)
+
+# 安排下一次唤醒
+def arm_proactive_wake(job_queue):
+    """只保留一个唤醒任务，在最早有用户到期的时间执行"""
+    for job in job_queue.get_jobs_by_name("proactive_wake"):
+        job.schedule_removal()
+    wake_time = scheduler.next_wake()
+    if wake_time is None:
+        return
+    delay = max(0.0, (wake_time - get_china_time()).total_seconds())
+    job_queue.run_once(proactive_wake_job, delay, name="proactive_wake")
+    logging.info(f"下一次主动消息检查安排在 {wake_time.strftime('%Y-%m-%d %H:%M:%S')}")
+
+# 唤醒时只检查到期的用户
+async def proactive_wake_job(context: ContextTypes.DEFAULT_TYPE):
+    """取出已经到期的用户交给 check_proactive_desire，然后安排下一次唤醒"""
+    try:
+        due_users = scheduler.pop_due(get_china_time())
+        if due_users:
+            await check_proactive_desire(context, user_ids=due_users)
+    finally:
+        arm_proactive_wake(context.job_queue)
+
+# 启动时恢复调度
+async def restore_proactive_schedule(context: ContextTypes.DEFAULT_TYPE):
+    """重启后沿用保存的规划；还没有任何规划的管理员立即规划今天的时间"""
+    now = get_china_time()
+    for user_id in get_admin_ids():
+        if not scheduler.plans(user_id, now):
+            scheduler.set_plans(user_id, scheduler.generate_daily_plans(now))
+    arm_proactive_wake(context.job_queue)
+
+# 定期写回调度状态
+async def flush_proactive_state(context: ContextTypes.DEFAULT_TYPE):
+    scheduler.flush()
+
+# 格式化用户的规划时间
+def format_planned_messages(header):
+    result = header
     
     # 获取管理员ID列表
     admin_ids = get_admin_ids()
+    now = get_china_time()
     
     # 检查是否有规划的消息
     has_plans = False
     for user_id in admin_ids:
-        if user_id in planned_message_times and planned_message_times[user_id]:
+        plans = scheduler.plans(user_id, now)
+        if plans:
             has_plans = True
             result += f"用户 {user_id} 的规划时间：\n"
-            for plan in planned_message_times[user_id]:
+            for plan in plans:
                 time_str = plan['time'].strftime('%H:%M')
-                reason = plan.get('reason', '未提供原因')
+                reason = plan.get('reason') or '未提供原因'
                 result += f"- {time_str} - {reason}\n"
+            next_due = scheduler.next_due(user_id)
+            if next_due is not None:
+                result += f"下一次检查：{next_due.strftime('%m-%d %H:%M')}\n"
             result += "\n"
     
     if not has_plans:
         result += "当前没有规划的消息时间。"
     
+    if gate.enabled:
+        result += (f"\n\n本地判断：不发送 {gate.stats['declined']} 次，直接发送 {gate.stats['sent']} 次，"
+                   f"交给模型决策 {gate.stats['escalated']} 次，节省模型调用 {gate.stats['model_calls_saved']} 次")
+    side = side_conversations.stats()
+    result += f"\n\n临时对话：正在使用 {side['live']} 个，空闲 {side['idle']} 个，累计创建 {side['created']} 个"
     return result
 
+# 手动触发消息规划（用于测试）
+async def trigger_message_planning(context: ContextTypes.DEFAULT_TYPE):
+    """手动触发消息规划，用于测试"""
+    await plan_daily_messages(context)
+    
+    # 返回已规划的时间信息
+    return format_planned_messages("已触发消息规划\n\n")
+
 # 手动发送测试消息（用于测试）
 async def send_test_message(context: ContextTypes.DEFAULT_TYPE, user_id=None):
     """手动发送测试消息，用于测试"""
@@ -735,27 +793,7 @@ async def send_test_message(context: ContextTypes.DEFAULT_TYPE, user_id=None):
 # 查看当前已计划的触发器
 async def view_planned_messages():
     """查看当前已计划的触发器"""
-    result = "当前已计划的消息时间：\n\n"
-    
-    # 获取管理员ID列表
-    admin_ids = get_admin_ids()
-    
-    # 检查是否有规划的消息
-    has_plans = False
-    for user_id in admin_ids:
-        if user_id in planned_message_times and planned_message_times[user_id]:
-            has_plans = True
-            result += f"用户 {user_id} 的规划时间：\n"
-            for plan in planned_message_times[user_id]:
-                time_str = plan['time'].strftime('%H:%M')
-                reason = plan.get('reason', '未提供原因')
-                result += f"- {time_str} - {reason}\n"
-            result += "\n"
-    
-    if not has_plans:
-        result += "当前没有规划的消息时间。"
-    
-    return result
+    return format_planned_messages("当前已计划的消息时间：\n\n")
 
 # 初始化主动消息功能
 def init_proactive_messaging(application):
@@ -765,18 +803,21 @@ def init_proactive_messaging(application):
         return
     
     logging.info("初始化主动消息功能")
+    scheduler.load()
     
-    # 设置每小时检查一次主动对话的任务（只在7点到23点之间）
-    for hour in range(7, 24):  # 7点到23点
-        # 在每小时内随机选择一个分钟进行检查
-        random_minute = random.randint(1, 59)
-        # 创建定时任务
-        application.job_queue.run_daily(
-            check_proactive_desire,
-            time=dt.time(hour=hour, minute=random_minute),
-            name=f"proactive_check_{hour}_{random_minute}"
-        )
-        logging.info(f"已设置在 {hour}:{random_minute} 检查主动对话")
+    # 每天在允许发送的时间开始时规划当天的消息时间，唤醒任务只在有用户到期时执行
+    application.job_queue.run_daily(
+        plan_daily_messages,
+        time=dt.time(hour=scheduler.start_hour, minute=0, tzinfo=CHINA_TZ),
+        name="plan_daily_messages"
+    )
+    application.job_queue.run_once(restore_proactive_schedule, 0, name="restore_proactive_schedule")
+    application.job_queue.run_repeating(
+        flush_proactive_state,
+        interval=PROACTIVE_STATE_FLUSH_INTERVAL,
+        first=PROACTIVE_STATE_FLUSH_INTERVAL,
+        name="flush_proactive_state"
+    )
     
     logging.info("主动消息功能初始化完成")
 
@@ -801,6 +842,7 @@ async def clear_conversation_history(update, context):
         if user_id in robot.conversation:
             robot.conversation[user_id] = []
             logging.info(f"已清除用户 {user_id} 的对话历史")
+        await clear_conversation(user_id)
         
         # 清除临时对话ID
         temp_convo_id = f"temp_{user_id}"
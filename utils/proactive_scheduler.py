@@ -0,0 +1,258 @@
+import os
+import json
+import heapq
+import random
+import logging
+from datetime import datetime, timedelta
+import pytz
+
+from utils.storage import USER_CONFIGS_DIR, atomic_write
+
+CHINA_TZ = pytz.timezone('Asia/Shanghai')
+
+# 主动消息调度状态（最后对话时间、最后主动消息时间、规划的时间）保存的位置
+PROACTIVE_STATE_FILE = os.environ.get('PROACTIVE_STATE_FILE', os.path.join(USER_CONFIGS_DIR, "proactive_state.json"))
+# 允许发送主动消息的时间段（东八区，开始小时-结束小时），其余时间是免打扰时间
+PROACTIVE_ACTIVE_HOURS = os.environ.get('PROACTIVE_ACTIVE_HOURS', '7-24')
+# 两条主动消息之间至少间隔的小时数
+PROACTIVE_MIN_INTERVAL_HOURS = float(os.environ.get('PROACTIVE_MIN_INTERVAL_HOURS', '2'))
+# 用户最后一次说话之后至少间隔多少小时才考虑主动发消息
+PROACTIVE_MIN_IDLE_HOURS = float(os.environ.get('PROACTIVE_MIN_IDLE_HOURS', '1'))
+# 每天为每个用户规划多少个主动消息时间
+PROACTIVE_DAILY_PLANS = int(os.environ.get('PROACTIVE_DAILY_PLANS', '3'))
+# 主动消息发出后多少小时内用户说话算作得到了回复
+PROACTIVE_REPLY_WINDOW_HOURS = float(os.environ.get('PROACTIVE_REPLY_WINDOW_HOURS', '6'))
+# 计算主动消息回复率时参考最近多少条主动消息
+PROACTIVE_OUTCOME_HISTORY = 10
+# 调度堆中过期的旧条目超过有效条目数量加上这个值时重建堆
+HEAP_COMPACT_SLACK = 64
+
+def parse_active_hours(value):
+    """把 "7-24" 解析成 (7, 24)"""
+    start, _, end = value.partition("-")
+    start, end = int(start), int(end or 24)
+    if not 0 <= start < end <= 24:
+        raise ValueError(f"PROACTIVE_ACTIVE_HOURS must look like 7-24, got {value!r}")
+    return start, end
+
+def _plan_reason(hour):
+    if hour < 11:
+        return "早上的问候"
+    if hour < 14:
+        return "中午的闲聊"
+    if hour < 18:
+        return "下午的关心"
+    return "晚上的陪伴"
+
+class ProactiveScheduler:
+    """持久化的主动消息调度器
+
+    每个用户保存最后对话时间、最后主动消息时间和当天规划的消息时间（时间戳），
+    由它们算出下一次可以检查的时间：不早于上次主动消息之后 PROACTIVE_MIN_INTERVAL_HOURS、
+    用户最后说话之后 PROACTIVE_MIN_IDLE_HOURS 的第一个规划时间，并避开免打扰时间。
+    下一次检查时间放在最小堆里，pop_due() 只取出已经到期的用户；
+    用户状态变化时压入新的时间（时间没有变化时不压入），堆里过期的旧条目在出堆时丢弃，
+    过期条目太多时重建整个堆。
+    """
+
+    def __init__(self, path=PROACTIVE_STATE_FILE, active_hours=PROACTIVE_ACTIVE_HOURS, tz=CHINA_TZ):
+        self.path = path
+        self.start_hour, self.end_hour = parse_active_hours(active_hours)
+        self.tz = tz
+        self._users = {}
+        self._heap = []
+        self._due = {}
+        self._dirty = False
+
+    def load(self):
+        """从文件恢复状态并重新建立调度堆，文件不存在或损坏时从空状态开始"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self._users = json.load(f).get("users", {})
+        except FileNotFoundError:
+            self._users = {}
+        except Exception as e:
+            logging.error(f"加载主动消息调度状态失败: {str(e)}")
+            self._users = {}
+        self._heap = []
+        self._due = {}
+        for user_id in self._users:
+            self._reschedule(user_id)
+        self._dirty = False
+
+    def flush(self):
+        """有未保存的修改时写回文件"""
+        if not self._dirty:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            atomic_write(self.path, json.dumps({"users": self._users}, ensure_ascii=False).encode("utf-8"))
+            self._dirty = False
+        except Exception as e:
+            logging.error(f"保存主动消息调度状态失败: {str(e)}")
+
+    def _user(self, user_id):
+        return self._users.setdefault(str(user_id), {"last_chat": None, "last_proactive": None, "plans": []})
+
+    def _to_datetime(self, timestamp):
+        return datetime.fromtimestamp(timestamp, self.tz) if timestamp is not None else None
+
+    def _now(self, now):
+        return (now or datetime.now(self.tz)).timestamp()
+
+    def next_active_time(self, timestamp):
+        """timestamp 落在免打扰时间时，顺延到下一个允许发送的时刻"""
+        moment = datetime.fromtimestamp(timestamp, self.tz)
+        if moment.hour < self.start_hour:
+            start = moment.replace(hour=self.start_hour, minute=0, second=0, microsecond=0)
+        elif moment.hour >= self.end_hour:
+            start = (moment + timedelta(days=1)).replace(hour=self.start_hour, minute=0, second=0, microsecond=0)
+        else:
+            return timestamp
+        return self.tz.localize(start.replace(tzinfo=None)).timestamp()
+
+    def eligible_time(self, user_id):
+        """用户最早可以收到下一条主动消息的时间戳"""
+        state = self._user(user_id)
+        candidates = [0.0]
+        if state["last_proactive"] is not None:
+            candidates.append(state["last_proactive"] + PROACTIVE_MIN_INTERVAL_HOURS * 3600)
+        if state["last_chat"] is not None:
+            candidates.append(state["last_chat"] + PROACTIVE_MIN_IDLE_HOURS * 3600)
+        return max(candidates)
+
+    def _reschedule(self, user_id):
+        user_id = str(user_id)
+        state = self._user(user_id)
+        eligible = self.eligible_time(user_id)
+        due = None
+        for plan in state["plans"]:
+            if plan["time"] >= eligible:
+                due = self.next_active_time(plan["time"])
+                break
+        if due is None:
+            self._due.pop(user_id, None)
+            return
+        if self._due.get(user_id) == due:
+            # 堆里已经有这个时间的条目，用户每条消息都会走到这里，不重复压入
+            return
+        self._due[user_id] = due
+        heapq.heappush(self._heap, (due, user_id))
+        if len(self._heap) > 2 * len(self._due) + HEAP_COMPACT_SLACK:
+            self._heap = [(due, user_id) for user_id, due in self._due.items()]
+            heapq.heapify(self._heap)
+
+    def _record_outcome(self, state, replied):
+        outcomes = state.setdefault("outcomes", [])
+        outcomes.append(1 if replied else 0)
+        del outcomes[:-PROACTIVE_OUTCOME_HISTORY]
+        state["awaiting_reply"] = False
+
+    def record_chat(self, user_id, now=None):
+        """记录用户说话的时间；消息很频繁，只标记为待保存，由 flush() 批量写回"""
+        state = self._user(user_id)
+        state["last_chat"] = self._now(now)
+        if state.get("awaiting_reply"):
+            # 上一条主动消息在回复窗口内得到回复才算被接受
+            replied = state["last_chat"] - state["last_proactive"] <= PROACTIVE_REPLY_WINDOW_HOURS * 3600
+            self._record_outcome(state, replied)
+        self._dirty = True
+        self._reschedule(user_id)
+
+    def record_proactive(self, user_id, now=None):
+        """记录发送了主动消息的时间"""
+        state = self._user(user_id)
+        if state.get("awaiting_reply"):
+            # 上一条主动消息一直没有得到回复
+            self._record_outcome(state, False)
+        state["last_proactive"] = self._now(now)
+        state["awaiting_reply"] = True
+        self._dirty = True
+        self._reschedule(user_id)
+        self.flush()
+
+    def last_chat(self, user_id):
+        return self._to_datetime(self._users.get(str(user_id), {}).get("last_chat"))
+
+    def last_proactive(self, user_id):
+        return self._to_datetime(self._users.get(str(user_id), {}).get("last_proactive"))
+
+    def acceptance_rate(self, user_id, now=None, default=0.5):
+        """最近的主动消息得到回复的比例；超过回复窗口仍未回复的最后一条也算作没有回复"""
+        state = self._users.get(str(user_id), {})
+        outcomes = list(state.get("outcomes", []))
+        if state.get("awaiting_reply") and self._now(now) - state["last_proactive"] > PROACTIVE_REPLY_WINDOW_HOURS * 3600:
+            outcomes.append(0)
+        if not outcomes:
+            return default
+        return sum(outcomes) / len(outcomes)
+
+    def set_plans(self, user_id, plans):
+        """替换用户规划的消息时间：[{"time": datetime, "reason": str}]"""
+        self._user(user_id)["plans"] = sorted(
+            ({"time": plan["time"].timestamp(), "reason": plan.get("reason", "")} for plan in plans),
+            key=lambda plan: plan["time"],
+        )
+        self._dirty = True
+        self._reschedule(user_id)
+        self.flush()
+
+    def plans(self, user_id, now=None):
+        """用户还没有到期的规划时间：[{"time": datetime, "reason": str}]"""
+        now = self._now(now)
+        return [
+            {"time": self._to_datetime(plan["time"]), "reason": plan["reason"]}
+            for plan in self._users.get(str(user_id), {}).get("plans", [])
+            if plan["time"] > now
+        ]
+
+    def next_due(self, user_id):
+        """用户下一次会被检查的时间，没有安排时返回 None"""
+        return self._to_datetime(self._due.get(str(user_id)))
+
+    def _pop_stale(self):
+        while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def next_wake(self):
+        """最早到期的时间，没有任何安排时返回 None"""
+        self._pop_stale()
+        return self._to_datetime(self._heap[0][0]) if self._heap else None
+
+    def pop_due(self, now=None):
+        """取出所有已经到期的用户，消耗掉它们已经过去的规划时间并安排下一次检查"""
+        now = self._now(now)
+        due_users = []
+        while True:
+            self._pop_stale()
+            if not self._heap or self._heap[0][0] > now:
+                break
+            _, user_id = heapq.heappop(self._heap)
+            del self._due[user_id]
+            due_users.append(user_id)
+        for user_id in due_users:
+            state = self._user(user_id)
+            state["plans"] = [plan for plan in state["plans"] if plan["time"] > now]
+            self._reschedule(user_id)
+        if due_users:
+            self._dirty = True
+            self.flush()
+        return due_users
+
+    def generate_daily_plans(self, now=None, count=PROACTIVE_DAILY_PLANS, rng=random):
+        """在今天剩余的允许发送时间内随机挑选 count 个时间，今天已经结束时规划明天"""
+        now = now or datetime.now(self.tz)
+        day = now.replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+        start = self.tz.localize(day + timedelta(hours=self.start_hour)).timestamp()
+        end = self.tz.localize(day + timedelta(hours=self.end_hour)).timestamp()
+        begin = max(start, now.timestamp())
+        if end - begin < 600:
+            start += 86400
+            end += 86400
+            begin = start
+        times = sorted(rng.uniform(begin, end) for _ in range(max(0, count)))
+        plans = []
+        for timestamp in times:
+            moment = self._to_datetime(timestamp).replace(second=0, microsecond=0)
+            plans.append({"time": moment, "reason": _plan_reason(moment.hour)})
+        return plans
@@ -1,3 +1,35 @@
+import os
+import logging
+
+# 后台刷新机器人自身信息的间隔（秒）
+BOT_IDENTITY_REFRESH = int(os.environ.get('BOT_IDENTITY_REFRESH', '3600'))
+
+# 机器人自身的信息：在 post_init 中获取一次，之后由后台任务定期刷新，处理消息时不再调用 get_me
+bot_identity = {"id": None, "username": None}
+
+def set_bot_identity(user):
+    bot_identity["id"] = user.id
+    bot_identity["username"] = user.username
+
+async def refresh_bot_identity(bot):
+    """重新获取机器人信息，失败时保留旧值"""
+    try:
+        set_bot_identity(await bot.get_me(read_timeout=time_out, write_timeout=time_out, connect_timeout=time_out, pool_timeout=time_out))
+    except Exception as e:
+        logging.warning(f"刷新机器人信息失败: {type(e)} {str(e)}")
+    return bot_identity
+
+async def refresh_bot_identity_job(context):
+    await refresh_bot_identity(context.bot)
+
+def is_own_message(message):
+    """消息是否由本机器人发送；还没有拿到机器人信息时按是处理"""
+    if message is None or message.from_user is None:
+        return False
+    if bot_identity["id"] is None:
+        return True
+    return message.from_user.id == bot_identity["id"]
+
 def CutNICK(update_text, update_message):
     import config
     botNick = config.NICK.lower() if config.NICK else None
@@ -11,7 +43,7 @@ def CutNICK(update_text, update_message):
         if update_text[:botNicKLength].lower() == botNick:
             return update_text[botNicKLength:].strip()
         else:
-            if update_chat.type == 'private' or (botNick and update_reply_to_message and update_reply_to_message.text and update_reply_to_message.from_user.is_bot and update_reply_to_message.sender_chat == None):
+            if update_chat.type == 'private' or (botNick and update_reply_to_message and update_reply_to_message.text and update_reply_to_message.from_user.is_bot and is_own_message(update_reply_to_message) and update_reply_to_message.sender_chat == None):
                 return update_text
             else:
                 return None
@@ -52,96 +84,157 @@ import os
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-async def GetMesage(update_message, context, voice=True):
-    from aient.src.aient.utils.scripts import Document_extract
-    image_url = None
-    file_url = None
-    reply_to_message_text = None
-    message = None
-    rawtext = None
-    voice_text = None
-    reply_to_message_file_content = None
-
-    chatid = str(update_message.chat_id)
+IMAGE_SUFFIXES = ("jpg", "png", "jpeg")
+
+class MessageInfo:
+    """一次更新解析出的消息信息
+
+    同一个 update 在装饰器链和处理函数中只解析一次，结果缓存在 context 上。
+    解析本身不做任何网络请求：图片、文件和语音只记录 file 对象，
+    真正需要内容时再通过 get_image_url / get_file_url / get_reply_file_content / get_voice_text 获取，
+    每种内容最多请求一次。
+    """
+    __slots__ = (
+        "update", "context", "update_message", "message", "rawtext", "chatid", "messageid",
+        "reply_to_message_text", "message_thread_id", "convo_id",
+        "image_file", "file", "reply_file", "voice_file_id", "_resolved",
+    )
+
+    def __init__(self, update, context, update_message=None):
+        self.update = update
+        self.context = context
+        self.update_message = update_message
+        self.message = None
+        self.rawtext = None
+        self.chatid = None
+        self.messageid = None
+        self.reply_to_message_text = None
+        self.message_thread_id = None
+        self.convo_id = None
+        self.image_file = None
+        self.file = None
+        self.reply_file = None
+        self.voice_file_id = None
+        self._resolved = {}
+
+    async def _resolve(self, key, resolver):
+        if key not in self._resolved:
+            self._resolved[key] = await resolver()
+        return self._resolved[key]
+
+    async def get_file_url(self):
+        """消息附带的文档或音频的下载地址"""
+        async def resolver():
+            if self.file is None:
+                return None
+            return await get_file_url(self.file, self.context)
+        return await self._resolve("file_url", resolver)
+
+    async def get_image_url(self):
+        """消息（或被回复消息）中图片的下载地址，图片格式的文档也算作图片"""
+        async def resolver():
+            if self.image_file is not None:
+                return await get_file_url(self.image_file, self.context)
+            file_url = await self.get_file_url()
+            if file_url and file_url.lower().endswith(IMAGE_SUFFIXES):
+                return file_url
+            return None
+        return await self._resolve("image_url", resolver)
+
+    async def get_reply_file_content(self):
+        """被回复消息中文档的文本内容"""
+        async def resolver():
+            if self.reply_file is None:
+                return None
+            from aient.src.aient.utils.scripts import Document_extract
+            reply_to_message_file_url = await get_file_url(self.reply_file, self.context)
+            return await Document_extract(reply_to_message_file_url, reply_to_message_file_url, None)
+        return await self._resolve("reply_file_content", resolver)
+
+    async def get_voice_text(self):
+        """语音消息的转写文本"""
+        async def resolver():
+            if self.voice_file_id is None:
+                return None
+            return await get_voice(self.voice_file_id, self.context)
+        return await self._resolve("voice_text", resolver)
+
+def GetMesage(update_message, context, info=None):
+    """解析消息的基本信息，只读取 update 本身，不访问网络"""
+    if info is None:
+        info = MessageInfo(None, context, update_message)
+
+    info.chatid = str(update_message.chat_id)
     if update_message.is_topic_message:
-        message_thread_id = update_message.message_thread_id
-    else:
-        message_thread_id = None
-    if message_thread_id:
-        convo_id = str(chatid) + "_" + str(message_thread_id)
+        info.message_thread_id = update_message.message_thread_id
+    if info.message_thread_id:
+        info.convo_id = info.chatid + "_" + str(info.message_thread_id)
     else:
-        convo_id = str(chatid)
+        info.convo_id = info.chatid
 
-    messageid = update_message.message_id
+    info.messageid = update_message.message_id
 
     if update_message.text:
-        message = CutNICK(update_message.text, update_message)
-        rawtext = update_message.text
+        info.message = CutNICK(update_message.text, update_message)
+        info.rawtext = update_message.text
 
     if update_message.reply_to_message:
-        reply_to_message_text = update_message.reply_to_message.text
-        reply_to_message_file = update_message.reply_to_message.document
-
+        info.reply_to_message_text = update_message.reply_to_message.text
+        info.reply_file = update_message.reply_to_message.document
         if update_message.reply_to_message.photo:
-            photo = update_message.reply_to_message.photo[-1]
-            image_url = await get_file_url(photo, context)
-
-        if reply_to_message_file:
-            reply_to_message_file_url = await get_file_url(reply_to_message_file, context)
-            reply_to_message_file_content = await Document_extract(reply_to_message_file_url, reply_to_message_file_url, None)
+            info.image_file = update_message.reply_to_message.photo[-1]
 
     if update_message.photo:
-        photo = update_message.photo[-1]
-
-        image_url = await get_file_url(photo, context)
-
-        if update_message.caption:
-            message = rawtext = CutNICK(update_message.caption, update_message)
+        info.image_file = update_message.photo[-1]
 
-    if voice and update_message.voice:
-        voice = update_message.voice.file_id
-        voice_text = await get_voice(voice, context)
-
-        if update_message.caption:
-            message = rawtext = CutNICK(update_message.caption, update_message)
+    if update_message.voice:
+        info.voice_file_id = update_message.voice.file_id
 
     if update_message.document:
-        file = update_message.document
-
-        file_url = await get_file_url(file, context)
-
-        if image_url == None and file_url and (file_url[-3:] == "jpg" or file_url[-3:] == "png" or file_url[-4:] == "jpeg"):
-            image_url = file_url
-
-        if update_message.caption:
-            message = rawtext = CutNICK(update_message.caption, update_message)
+        info.file = update_message.document
 
     if update_message.audio:
-        file = update_message.audio
+        info.file = update_message.audio
 
-        file_url = await get_file_url(file, context)
+    if update_message.caption and (update_message.photo or update_message.voice or update_message.document or update_message.audio):
+        info.message = info.rawtext = CutNICK(update_message.caption, update_message)
 
-        if image_url == None and file_url and (file_url[-3:] == "jpg" or file_url[-3:] == "png" or file_url[-4:] == "jpeg"):
-            image_url = file_url
+    return info
 
-        if update_message.caption:
-            message = rawtext = CutNICK(update_message.caption, update_message)
+MESSAGE_INFO_ATTR = "message_info"
 
-    return message, rawtext, image_url, chatid, messageid, reply_to_message_text, message_thread_id, convo_id, file_url, reply_to_message_file_content, voice_text
-
-async def GetMesageInfo(update, context, voice=True):
+def get_update_message(update):
     if update.edited_message:
-        message, rawtext, image_url, chatid, messageid, reply_to_message_text, message_thread_id, convo_id, file_url, reply_to_message_file_content, voice_text = await GetMesage(update.edited_message, context, voice)
-        update_message = update.edited_message
+        return update.edited_message
     elif update.callback_query:
-        message, rawtext, image_url, chatid, messageid, reply_to_message_text, message_thread_id, convo_id, file_url, reply_to_message_file_content, voice_text = await GetMesage(update.callback_query.message, context, voice)
-        update_message = update.callback_query.message
+        return update.callback_query.message
     elif update.message:
-        message, rawtext, image_url, chatid, messageid, reply_to_message_text, message_thread_id, convo_id, file_url, reply_to_message_file_content, voice_text = await GetMesage(update.message, context, voice)
-        update_message = update.message
-    else:
-        return None, None, None, None, None, None, None, None, None, None, None, None
-    return message, rawtext, image_url, chatid, messageid, reply_to_message_text, update_message, message_thread_id, convo_id, file_url, reply_to_message_file_content, voice_text
+        return update.message
+    return None
+
+async def GetMesageInfo(update, context):
+    """获取 update 的消息信息，同一个 update 只解析一次
+
+    参数：
+        update: Telegram 更新对象
+        context: 上下文对象，解析结果缓存在其上
+
+    返回：
+        MessageInfo
+    """
+    info = getattr(context, MESSAGE_INFO_ATTR, None)
+    if info is not None and info.update is update:
+        return info
+
+    update_message = get_update_message(update)
+    info = MessageInfo(update, context, update_message)
+    if update_message is not None:
+        GetMesage(update_message, context, info)
+    try:
+        setattr(context, MESSAGE_INFO_ATTR, info)
+    except AttributeError:
+        pass
+    return info
 
 def safe_get(data, *keys):
     for key in keys:
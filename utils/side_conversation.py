@@ -0,0 +1,82 @@
+import os
+import logging
+import threading
+from contextlib import contextmanager
+
+# 每种引擎最多保留多少个空闲的临时对话ID供复用
+SIDE_CONVERSATION_POOL_SIZE = int(os.environ.get('SIDE_CONVERSATION_POOL_SIZE', '8'))
+
+# 机器人实例上按对话ID保存的数据，释放临时对话时全部删除
+ROBOT_CONVERSATION_ATTRIBUTES = ("conversation", "tokens_usage", "current_tokens")
+
+class SideConversationPool:
+    """后台模型调用（主动消息决策、记忆总结、记忆分析）使用的临时对话
+
+    用法：
+
+        with side_conversations.acquire(robot, "memory_summary") as convo_id:
+            robot.add_to_conversation(prompt, "user", convo_id)
+            async for data in robot.ask_stream_async(prompt, convo_id=convo_id):
+                ...
+
+    对话ID从池中取出，退出 with 块时（包括出错时）删除机器人上这个ID的对话历史和 token 统计，
+    再放回池中，机器人的 conversation 不会因为后台调用越积越多。
+    live 是正在使用的临时对话数量。
+
+    空闲的ID按引擎（机器人的类名）分组，不按机器人实例的 id() 分组：实例被回收后 id() 可能被新实例复用，
+    池中也会留下已回收实例的条目。临时对话ID全局唯一，借用时会先在目标机器人上清理，
+    同一种引擎的不同实例共用空闲ID也不会串对话。
+    """
+
+    def __init__(self, pool_size=SIDE_CONVERSATION_POOL_SIZE):
+        self.pool_size = pool_size
+        self._free = {}
+        self._next = 0
+        self._lock = threading.Lock()
+        self.live = 0
+        self.created = 0
+
+    @staticmethod
+    def reset(robot, convo_id):
+        """删除机器人上这个对话ID的全部数据"""
+        for attribute in ROBOT_CONVERSATION_ATTRIBUTES:
+            data = getattr(robot, attribute, None)
+            if isinstance(data, dict):
+                data.pop(convo_id, None)
+
+    @contextmanager
+    def acquire(self, robot, purpose="side"):
+        """借用一个干净的临时对话ID，purpose 只用于日志"""
+        key = type(robot).__name__
+        with self._lock:
+            free = self._free.get(key)
+            if free:
+                convo_id = free.pop()
+            else:
+                self._next += 1
+                self.created += 1
+                convo_id = f"side_conversation_{self._next}"
+            self.live += 1
+        # 复用的ID在放回池中时已经清理过，这里再清理一次，防止其他代码误用过这个ID
+        self.reset(robot, convo_id)
+        logging.debug(f"借用临时对话 {convo_id} 用于 {purpose}，正在使用 {self.live} 个")
+        try:
+            yield convo_id
+        finally:
+            self.reset(robot, convo_id)
+            with self._lock:
+                self.live -= 1
+                free = self._free.setdefault(key, [])
+                if len(free) < self.pool_size:
+                    free.append(convo_id)
+
+    def stats(self):
+        """正在使用的、池中空闲的临时对话数量，以及一共创建过多少个ID"""
+        with self._lock:
+            return {
+                "live": self.live,
+                "idle": sum(len(free) for free in self._free.values()),
+                "created": self.created,
+            }
+
+side_conversations = SideConversationPool()
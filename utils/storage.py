@@ -0,0 +1,857 @@
+import os
+import re
+import json
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import tempfile
+import functools
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import msgspec
+
+from utils.conversation_state import conversation_tracker
+
+# 存储后端：json（每个用户一个文件，默认）或 sqlite（单个数据库文件）
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'json').lower()
+
+CONFIG_DIR = os.environ.get('CONFIG_DIR', 'user_configs')
+# 用户配置文件的编码：json（默认，便于手动查看和修改）或 msgpack（更紧凑，读写更快）
+CONFIG_ENCODING = os.environ.get('CONFIG_ENCODING', 'json').lower()
+
+CONFIG_SUFFIXES = {
+    "json": ".json",
+    "msgpack": ".msgpack",
+}
+if CONFIG_ENCODING not in CONFIG_SUFFIXES:
+    raise ValueError(f"CONFIG_ENCODING must be one of {list(CONFIG_SUFFIXES)}")
+
+# 记忆存储路径 - 修改为使用Docker容器内的路径
+# 在Docker容器中，/home/user_configs是挂载的持久化目录
+if os.path.exists('/home/user_configs'):
+    # Docker容器内路径
+    USER_CONFIGS_DIR = '/home/user_configs'
+else:
+    # 本地开发环境路径
+    USER_CONFIGS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "user_configs")
+
+MEMORY_DIR = os.path.join(USER_CONFIGS_DIR, "memories")
+os.makedirs(MEMORY_DIR, exist_ok=True)
+
+# 记忆日志超过这个大小（字节），并且不小于快照时，在后台合并成新的快照
+MEMORY_JOURNAL_MAX_BYTES = int(os.environ.get('MEMORY_JOURNAL_MAX_BYTES', '262144'))
+
+# 记忆和对话历史的读写在这个线程池中执行，磁盘再慢也不会阻塞事件循环
+MEMORY_IO_WORKERS = int(os.environ.get('MEMORY_IO_WORKERS', '4'))
+memory_executor = ThreadPoolExecutor(max_workers=MEMORY_IO_WORKERS, thread_name_prefix="memory-io")
+
+async def run_memory_io(func, *args, **kwargs):
+    """在线程池中执行可能读写磁盘的操作，供异步处理函数使用"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(memory_executor, functools.partial(func, *args, **kwargs))
+
+# SQLite 数据库文件的位置
+STORAGE_PATH = os.environ.get('STORAGE_PATH', os.path.join(USER_CONFIGS_DIR, "storage.db"))
+# 重启后每个对话最多恢复多少条历史消息
+CONVERSATION_RESTORE_TURNS = int(os.environ.get('CONVERSATION_RESTORE_TURNS', '100'))
+
+def encode_user_config(config, encoding=CONFIG_ENCODING):
+    if encoding == "msgpack":
+        return msgspec.msgpack.encode(config)
+    return json.dumps(config, indent=2, ensure_ascii=False).encode("utf-8")
+
+def decode_user_config(content, encoding=CONFIG_ENCODING):
+    if not content.strip():
+        return {}
+    if encoding == "msgpack":
+        return msgspec.msgpack.decode(content)
+    return json.loads(content)
+
+def atomic_write(filename, content):
+    """先写临时文件再原子替换，写到一半崩溃也不会留下损坏的文件
+
+    临时文件名各不相同，并发的写入不会互相覆盖临时文件；替换后再同步目录，
+    保证断电后替换本身也不会丢失。
+    """
+    directory = os.path.dirname(filename) or "."
+    fd, tmp_filename = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(filename)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        try:
+            os.unlink(tmp_filename)
+        except FileNotFoundError:
+            pass
+        raise
+    try:
+        dir_fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        # 有的平台（例如 Windows）不能打开目录
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+def encode_memories(data):
+    """记忆文件使用紧凑的 JSON（不缩进、不转义中文），由 msgspec 编码"""
+    return msgspec.json.encode(data)
+
+def decode_memories(content):
+    if not content.strip():
+        return empty_memories()
+    # 也能读取旧版本缩进格式的文件
+    return msgspec.json.decode(content)
+
+# 快照开头的序号，只读取文件开头就能得到，不需要解析整个快照
+SNAPSHOT_SEQ_PATTERN = re.compile(rb'^\{"seq":(\d+)')
+
+def read_last_record(f):
+    """从文件末尾向前读取，返回最后一条完整的日志记录，没有时返回 None
+
+    没有以换行结尾的最后一行是写到一半时崩溃留下的，跳过它。
+    """
+    position = f.seek(0, os.SEEK_END)
+    buffer = b""
+    while position > 0:
+        step = min(8192, position)
+        position -= step
+        f.seek(position)
+        buffer = f.read(step) + buffer
+        lines = buffer.split(b"\n")
+        # 还没有读到文件开头时，第一段可能只是某一行的后半部分
+        complete = lines[1:-1] if position > 0 else lines[:-1]
+        for line in reversed(complete):
+            if not line.strip():
+                continue
+            try:
+                return msgspec.json.decode(line)
+            except msgspec.DecodeError:
+                continue
+        if complete:
+            return None
+    return None
+
+def empty_memories():
+    # next_id 是下一条新记忆的ID，只增不减，删除记忆后ID也不会被重新使用
+    return {"memories": [], "last_updated": None, "next_id": 1}
+
+def next_memory_id(data, memory):
+    """保存 memory 之后 next_id 应有的值"""
+    return max(data.get("next_id") or 1, memory["id"] + 1)
+
+class StorageBackend:
+    """用户配置、记忆和对话历史的存储接口
+
+    记忆数据的格式与 MemorySystem.memories 相同：{"memories": [...], "last_updated": ..., "next_id": ...}，
+    保存过记忆向量时另有 "embeddings": {str(记忆ID): 向量记录}（见 memory_embedding.encode_vector），
+    对话消息的格式与 robot.add_to_conversation 接收的字典相同。
+    """
+
+    def load_user_config(self, user_id):
+        raise NotImplementedError
+
+    def save_user_config(self, user_id, config):
+        raise NotImplementedError
+
+    def list_user_ids(self):
+        raise NotImplementedError
+
+    def load_memories(self, user_id):
+        raise NotImplementedError
+
+    def save_memories(self, user_id, data):
+        """整体保存一个用户的全部记忆"""
+        raise NotImplementedError
+
+    def upsert_memory(self, user_id, memory, last_updated=None, embedding=None):
+        """新增或更新一条记忆，embedding 是记忆的向量记录，为 None 时不保存向量"""
+        raise NotImplementedError
+
+    def delete_memory(self, user_id, memory_id, last_updated=None):
+        """删除一条记忆，返回是否删除了记忆"""
+        raise NotImplementedError
+
+    def delete_memories(self, user_id, memory_ids, last_updated=None):
+        """删除多条记忆，返回实际删除了的记忆ID列表"""
+        return [memory_id for memory_id in memory_ids if self.delete_memory(user_id, memory_id, last_updated)]
+
+    def list_memory_user_ids(self):
+        raise NotImplementedError
+
+    def archive_memories(self, user_id, memories, reason, archived_at=None):
+        """把从记忆中移除的记忆追加到冷存储，不会再被加载"""
+        raise NotImplementedError
+
+    def memory_version(self, user_id):
+        """返回记忆数据的版本标记，数据被其他进程修改后会变化；None 表示无法判断"""
+        return None
+
+    def append_turn(self, convo_id, message):
+        """追加一条对话消息"""
+        raise NotImplementedError
+
+    def load_turns(self, convo_id, limit=None):
+        """按时间顺序返回最近的对话消息"""
+        raise NotImplementedError
+
+    def clear_turns(self, convo_id):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class JsonFileStorage(StorageBackend):
+    """基于文件的存储：每个用户一个配置文件，对话历史只保存在内存中
+
+    记忆由快照 memory_{user_id}.json 和追加写入的日志 memory_{user_id}.journal 组成，
+    新增、修改和删除只在日志末尾追加一行，日志足够大时在后台合并进快照。
+    每条日志记录带有递增的序号 seq，快照记录它包含的最后一个序号，
+    合并不改变序号，memory_version() 只在记忆内容变化时改变。
+    """
+
+    # 同一用户的写入（包括先读后写的 upsert 和 delete）按用户ID分到固定数量的锁上串行执行
+    LOCK_STRIPES = 64
+    # 最多为多少个用户缓存现存的记忆ID
+    LIVE_ID_CACHE_SIZE = 1024
+
+    def __init__(self, config_dir=CONFIG_DIR, memory_dir=MEMORY_DIR, encoding=CONFIG_ENCODING):
+        self.config_dir = config_dir
+        self.memory_dir = memory_dir
+        self.encoding = encoding
+        self._locks = [threading.RLock() for _ in range(self.LOCK_STRIPES)]
+        # 后台合并记忆日志的线程，以及正在等待或正在合并的用户
+        self._compactor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="memory-compaction")
+        self._compaction_lock = threading.Lock()
+        self._compacting = set()
+        # 用户ID -> (版本, 现存的记忆ID集合)，删除记忆时不需要重放整个日志就能知道哪些记忆存在
+        self._live_ids = OrderedDict()
+        self._live_ids_lock = threading.Lock()
+
+    def user_lock(self, user_id):
+        """返回用户的写锁，不同的线程和事件循环里的写入都通过它串行化"""
+        digest = hashlib.md5(str(user_id).encode("utf-8")).digest()
+        return self._locks[digest[0] % self.LOCK_STRIPES]
+
+    def user_config_dir(self, user_id):
+        """用户配置所在的分片目录，按用户ID的哈希分到 256 个子目录，避免单个目录下文件过多"""
+        shard = hashlib.md5(str(user_id).encode("utf-8")).hexdigest()[:2]
+        return os.path.join(self.config_dir, shard)
+
+    def user_config_candidates(self, user_id):
+        """按优先级列出用户配置可能所在的文件：(文件名, 编码)
+
+        当前编码优先于另一种编码，分片目录优先于旧版直接放在配置目录下的文件。
+        """
+        encodings = [self.encoding] + [encoding for encoding in CONFIG_SUFFIXES if encoding != self.encoding]
+        candidates = []
+        for directory in (self.user_config_dir(user_id), self.config_dir):
+            for encoding in encodings:
+                candidates.append((os.path.join(directory, f'{user_id}{CONFIG_SUFFIXES[encoding]}'), encoding))
+        return candidates
+
+    def load_user_config(self, user_id):
+        for filename, encoding in self.user_config_candidates(user_id):
+            if os.path.exists(filename):
+                with open(filename, 'rb') as f:
+                    return decode_user_config(f.read(), encoding)
+        return {}
+
+    def save_user_config(self, user_id, config):
+        directory = self.user_config_dir(user_id)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        filename = os.path.join(directory, f'{user_id}{CONFIG_SUFFIXES[self.encoding]}')
+        with self.user_lock(user_id):
+            atomic_write(filename, encode_user_config(config, self.encoding))
+
+            # 旧目录或旧编码的文件已经被新文件取代
+            for legacy, _ in self.user_config_candidates(user_id):
+                if legacy != filename and os.path.exists(legacy):
+                    os.remove(legacy)
+
+    def list_user_ids(self):
+        if not os.path.exists(self.config_dir):
+            return []
+        user_ids = set()
+        directories = [self.config_dir] + [
+            os.path.join(self.config_dir, name) for name in os.listdir(self.config_dir)
+            if len(name) == 2 and os.path.isdir(os.path.join(self.config_dir, name))
+        ]
+        for directory in directories:
+            for filename in os.listdir(directory):
+                for suffix in CONFIG_SUFFIXES.values():
+                    if filename.endswith(suffix):
+                        user_ids.add(filename[:-len(suffix)])
+        return sorted(user_ids)
+
+    def memory_file(self, user_id):
+        return os.path.join(self.memory_dir, f"memory_{user_id}.json")
+
+    def journal_file(self, user_id):
+        return os.path.join(self.memory_dir, f"memory_{user_id}.journal")
+
+    def _load_snapshot(self, user_id):
+        memory_file = self.memory_file(user_id)
+        if not os.path.exists(memory_file):
+            return empty_memories()
+        with open(memory_file, 'rb') as f:
+            return decode_memories(f.read())
+
+    def _snapshot_seq(self, user_id):
+        """快照包含的最后一个序号，旧版本没有序号的快照或者没有快照时返回 None"""
+        try:
+            with open(self.memory_file(user_id), 'rb') as f:
+                match = SNAPSHOT_SEQ_PATTERN.match(f.read(64))
+        except FileNotFoundError:
+            return None
+        return int(match.group(1)) if match else None
+
+    def _journal_seq(self, user_id):
+        """日志中最后一条记录的序号，没有日志或者是旧版本没有序号的记录时返回 None"""
+        try:
+            with open(self.journal_file(user_id), 'rb') as f:
+                record = read_last_record(f)
+        except FileNotFoundError:
+            return None
+        return record.get("seq") if isinstance(record, dict) else None
+
+    def _current_seq(self, user_id):
+        seq = self._journal_seq(user_id)
+        if seq is None:
+            seq = self._snapshot_seq(user_id)
+        return seq or 0
+
+    def _remember_ids(self, user_id, version, ids):
+        with self._live_ids_lock:
+            self._live_ids[str(user_id)] = (version, ids)
+            self._live_ids.move_to_end(str(user_id))
+            while len(self._live_ids) > self.LIVE_ID_CACHE_SIZE:
+                self._live_ids.popitem(last=False)
+
+    def _cached_ids(self, user_id):
+        """返回缓存的现存记忆ID集合，文件在缓存之后被修改过时返回 None"""
+        with self._live_ids_lock:
+            cached = self._live_ids.get(str(user_id))
+        if cached is not None and cached[0] == self.memory_version(user_id):
+            return cached[1]
+        return None
+
+    def load_memories(self, user_id):
+        """读取快照，再按顺序重放日志中快照之后的修改"""
+        # 先取版本再读取，读取期间发生的修改会让缓存的ID在下一次使用时失效
+        version = self.memory_version(user_id)
+        data = self._replay(user_id)
+        self._remember_ids(user_id, version, {memory["id"] for memory in data["memories"]})
+        return data
+
+    def _replay(self, user_id):
+        data = self._load_snapshot(user_id)
+        snapshot_seq = data.pop("seq", 0)
+        journal_file = self.journal_file(user_id)
+        if not os.path.exists(journal_file):
+            return data
+
+        # 日志只会在快照的ID没有重复之后才出现（见 MemorySystem._renumber_duplicate_ids），可以按ID重放
+        memories = {memory["id"]: memory for memory in data["memories"]}
+        with open(journal_file, 'rb') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    record = msgspec.json.decode(line)
+                except msgspec.DecodeError:
+                    # 写到一半时崩溃留下的不完整记录
+                    logging.warning(f"跳过记忆日志中损坏的记录 {journal_file}")
+                    continue
+                if record.get("seq") is not None and record["seq"] <= snapshot_seq:
+                    # 合并时已经写进快照，合并到一半崩溃时会留下这样的日志
+                    continue
+                if record["op"] == "put":
+                    memory = record["memory"]
+                    memories[memory["id"]] = memory
+                    data["next_id"] = next_memory_id(data, memory)
+                    if record.get("embedding") is not None:
+                        data.setdefault("embeddings", {})[str(memory["id"])] = record["embedding"]
+                    elif "embeddings" in data:
+                        data["embeddings"].pop(str(memory["id"]), None)
+                elif record["op"] == "delete":
+                    for memory_id in record["ids"]:
+                        memories.pop(memory_id, None)
+                        if "embeddings" in data:
+                            data["embeddings"].pop(str(memory_id), None)
+                data["last_updated"] = record.get("t")
+        data["memories"] = list(memories.values())
+        return data
+
+    def save_memories(self, user_id, data):
+        """写入完整的快照，之前的日志随之作废"""
+        with self.user_lock(user_id):
+            self._write_snapshot(user_id, data, self._current_seq(user_id) + 1)
+
+    def _write_snapshot(self, user_id, data, seq):
+        # seq 放在最前面，_snapshot_seq() 只需要读取文件开头
+        content = encode_memories({"seq": seq, **{key: value for key, value in data.items() if key != "seq"}})
+        with self.user_lock(user_id):
+            atomic_write(self.memory_file(user_id), content)
+            try:
+                os.remove(self.journal_file(user_id))
+            except FileNotFoundError:
+                pass
+            self._remember_ids(user_id, self.memory_version(user_id), {memory["id"] for memory in data["memories"]})
+
+    def _append_journal(self, user_id, record):
+        # 每个事件只追加一行，写入量与记忆总数无关
+        journal_file = self.journal_file(user_id)
+        with self.user_lock(user_id):
+            record = {"seq": self._current_seq(user_id) + 1, **record}
+            with open(journal_file, 'a+b') as f:
+                content = msgspec.json.encode(record) + b"\n"
+                if f.seek(0, os.SEEK_END):
+                    # 上次写到一半崩溃时，最后一行没有换行，先补上，不能和新记录连在一起
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        content = b"\n" + content
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            journal_size = os.path.getsize(journal_file)
+        self._maybe_compact(user_id, journal_size)
+
+    def _maybe_compact(self, user_id, journal_size):
+        """日志超过阈值并且不小于快照时在后台合并成新的快照
+
+        快照越大，需要积累越多的日志才合并一次，每条记录分摊的合并开销保持不变。
+        """
+        try:
+            snapshot_size = os.path.getsize(self.memory_file(user_id))
+        except FileNotFoundError:
+            snapshot_size = 0
+        if journal_size < max(MEMORY_JOURNAL_MAX_BYTES, snapshot_size):
+            return
+        with self._compaction_lock:
+            if user_id in self._compacting:
+                return
+            self._compacting.add(user_id)
+        self._compactor.submit(self.compact, user_id)
+
+    def compact(self, user_id):
+        """把日志合并进快照，序号保持不变，记忆的版本也就不变
+
+        合并到一半崩溃时快照和日志都还在，快照已经包含的日志记录在重放时跳过。
+        """
+        try:
+            with self.user_lock(user_id):
+                if os.path.exists(self.journal_file(user_id)):
+                    seq = self._current_seq(user_id)
+                    self._write_snapshot(user_id, self.load_memories(user_id), seq)
+        except Exception as e:
+            logging.error(f"合并记忆日志失败 {user_id}: {str(e)}")
+        finally:
+            with self._compaction_lock:
+                self._compacting.discard(user_id)
+
+    def upsert_memory(self, user_id, memory, last_updated=None, embedding=None):
+        record = {"op": "put", "memory": memory, "t": last_updated}
+        if embedding is not None:
+            record["embedding"] = embedding
+        with self.user_lock(user_id):
+            existing = self._cached_ids(user_id)
+            self._append_journal(user_id, record)
+            if existing is not None:
+                existing.add(memory["id"])
+                self._remember_ids(user_id, self.memory_version(user_id), existing)
+
+    def delete_memory(self, user_id, memory_id, last_updated=None):
+        return bool(self.delete_memories(user_id, [memory_id], last_updated))
+
+    def delete_memories(self, user_id, memory_ids, last_updated=None):
+        with self.user_lock(user_id):
+            # 删除前先确认哪些记忆确实存在，通常直接使用缓存的ID，只有缓存失效时才重放日志
+            existing = self._cached_ids(user_id)
+            if existing is None:
+                existing = {memory["id"] for memory in self.load_memories(user_id)["memories"]}
+            deleted = [memory_id for memory_id in dict.fromkeys(memory_ids) if memory_id in existing]
+            if deleted:
+                # 没有删除任何记忆时不写日志，版本不变，缓存也不会失效
+                self._append_journal(user_id, {"op": "delete", "ids": deleted, "t": last_updated})
+                existing.difference_update(deleted)
+            self._remember_ids(user_id, self.memory_version(user_id), existing)
+        return deleted
+
+    def memory_version(self, user_id):
+        """最后一次修改的序号，合并日志不会改变它；旧版本没有序号的文件退回到文件的修改时间和大小"""
+        seq = self._current_seq(user_id)
+        if seq:
+            return seq
+        version = []
+        for filename in (self.memory_file(user_id), self.journal_file(user_id)):
+            try:
+                stat = os.stat(filename)
+                version.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                version.append(None)
+        if version == [None, None]:
+            return None
+        return tuple(version)
+
+    def archive_file(self, user_id):
+        return os.path.join(self.memory_dir, "archive", f"memory_{user_id}.jsonl")
+
+    def archive_memories(self, user_id, memories, reason, archived_at=None):
+        archive_file = self.archive_file(user_id)
+        os.makedirs(os.path.dirname(archive_file), exist_ok=True)
+        content = b"".join(
+            msgspec.json.encode({"reason": reason, "archived_at": archived_at, "memory": memory}) + b"\n"
+            for memory in memories
+        )
+        with self.user_lock(user_id):
+            with open(archive_file, 'ab') as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def list_memory_user_ids(self):
+        if not os.path.exists(self.memory_dir):
+            return []
+        return sorted({
+            filename[len("memory_"):-len(suffix)]
+            for filename in os.listdir(self.memory_dir)
+            for suffix in (".json", ".journal")
+            if filename.startswith("memory_") and filename.endswith(suffix)
+        })
+
+    def append_turn(self, convo_id, message):
+        pass
+
+    def load_turns(self, convo_id, limit=None):
+        return []
+
+    def clear_turns(self, convo_id):
+        pass
+
+class SQLiteStorage(StorageBackend):
+    """单文件 SQLite 存储，使用 WAL 模式
+
+    每次修改只写入变化的行：配置按 (用户, 键) 保存，记忆按 (用户, 记忆ID) 保存，
+    对话消息逐条追加。连接在线程之间共享，由一个锁串行化访问。
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS user_settings (
+        user_id TEXT NOT NULL,
+        key TEXT NOT NULL,
+        value TEXT,
+        PRIMARY KEY (user_id, key)
+    );
+    CREATE TABLE IF NOT EXISTS memories (
+        user_id TEXT NOT NULL,
+        memory_id INTEGER NOT NULL,
+        importance INTEGER NOT NULL DEFAULT 1,
+        updated_at TEXT,
+        data TEXT NOT NULL,
+        embedding TEXT,
+        PRIMARY KEY (user_id, memory_id)
+    );
+    CREATE INDEX IF NOT EXISTS idx_memories_importance ON memories (user_id, importance, updated_at);
+    CREATE TABLE IF NOT EXISTS memory_meta (
+        user_id TEXT PRIMARY KEY,
+        last_updated TEXT,
+        next_id INTEGER NOT NULL DEFAULT 1
+    );
+    CREATE TABLE IF NOT EXISTS memory_archive (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT NOT NULL,
+        memory_id INTEGER NOT NULL,
+        reason TEXT,
+        archived_at TEXT,
+        data TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS conversation_turns (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        convo_id TEXT NOT NULL,
+        data TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_conversation_turns_convo ON conversation_turns (convo_id, id);
+    """
+
+    def __init__(self, path=STORAGE_PATH):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(memory_meta)")]
+        if "next_id" not in columns:
+            # 旧版本的数据库没有 next_id，从现有记忆的最大ID开始
+            self.conn.executescript("""
+            ALTER TABLE memory_meta ADD COLUMN next_id INTEGER NOT NULL DEFAULT 1;
+            UPDATE memory_meta SET next_id = COALESCE(
+                (SELECT MAX(memory_id) + 1 FROM memories WHERE memories.user_id = memory_meta.user_id), 1);
+            """)
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(memories)")]
+        if "embedding" not in columns:
+            # 旧版本的数据库不保存记忆向量，加载时重新计算一次
+            self.conn.execute("ALTER TABLE memories ADD COLUMN embedding TEXT")
+
+    def _execute(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def _transaction(self, statements):
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                for sql, params in statements:
+                    if params and isinstance(params, list):
+                        self.conn.executemany(sql, params)
+                    else:
+                        self.conn.execute(sql, params)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def load_user_config(self, user_id):
+        rows = self._execute("SELECT key, value FROM user_settings WHERE user_id = ?", (str(user_id),))
+        return {key: json.loads(value) for key, value in rows}
+
+    def save_user_config(self, user_id, config):
+        user_id = str(user_id)
+        keys = list(config)
+        # 配置中已经删除的键也要从数据库中删除
+        if keys:
+            statements = [(
+                f"DELETE FROM user_settings WHERE user_id = ? AND key NOT IN ({', '.join('?' * len(keys))})",
+                (user_id, *keys),
+            ), (
+                "INSERT INTO user_settings (user_id, key, value) VALUES (?, ?, ?) "
+                "ON CONFLICT (user_id, key) DO UPDATE SET value = excluded.value",
+                [(user_id, key, json.dumps(value, ensure_ascii=False)) for key, value in config.items()],
+            )]
+        else:
+            statements = [("DELETE FROM user_settings WHERE user_id = ?", (user_id,))]
+        self._transaction(statements)
+
+    def list_user_ids(self):
+        return [row[0] for row in self._execute("SELECT DISTINCT user_id FROM user_settings ORDER BY user_id")]
+
+    def load_memories(self, user_id):
+        user_id = str(user_id)
+        rows = self._execute("SELECT memory_id, data, embedding FROM memories WHERE user_id = ? ORDER BY rowid", (user_id,))
+        meta = self._execute("SELECT last_updated, next_id FROM memory_meta WHERE user_id = ?", (user_id,))
+        data = {
+            "memories": [json.loads(row[1]) for row in rows],
+            "last_updated": meta[0][0] if meta else None,
+            "next_id": meta[0][1] if meta else 1,
+        }
+        embeddings = {str(row[0]): json.loads(row[2]) for row in rows if row[2]}
+        if embeddings:
+            data["embeddings"] = embeddings
+        return data
+
+    def _memory_row(self, user_id, memory, embedding=None):
+        return (
+            user_id,
+            memory["id"],
+            memory.get("importance", 1),
+            memory.get("updated_at"),
+            json.dumps(memory, ensure_ascii=False),
+            json.dumps(embedding) if embedding is not None else None,
+        )
+
+    def _meta_statement(self, user_id, last_updated, next_id=1):
+        # next_id 只增不减
+        return (
+            "INSERT INTO memory_meta (user_id, last_updated, next_id) VALUES (?, ?, ?) "
+            "ON CONFLICT (user_id) DO UPDATE SET last_updated = excluded.last_updated, "
+            "next_id = MAX(memory_meta.next_id, excluded.next_id)",
+            (user_id, last_updated, next_id),
+        )
+
+    def save_memories(self, user_id, data):
+        user_id = str(user_id)
+        statements = [("DELETE FROM memories WHERE user_id = ?", (user_id,))]
+        if data["memories"]:
+            embeddings = data.get("embeddings") or {}
+            statements.append((
+                "INSERT OR REPLACE INTO memories (user_id, memory_id, importance, updated_at, data, embedding) VALUES (?, ?, ?, ?, ?, ?)",
+                [self._memory_row(user_id, memory, embeddings.get(str(memory["id"]))) for memory in data["memories"]],
+            ))
+        next_id = max([data.get("next_id") or 1] + [memory["id"] + 1 for memory in data["memories"]])
+        statements.append(self._meta_statement(user_id, data.get("last_updated"), next_id))
+        self._transaction(statements)
+
+    def upsert_memory(self, user_id, memory, last_updated=None, embedding=None):
+        user_id = str(user_id)
+        self._transaction([
+            (
+                "INSERT INTO memories (user_id, memory_id, importance, updated_at, data, embedding) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (user_id, memory_id) DO UPDATE SET importance = excluded.importance, "
+                "updated_at = excluded.updated_at, data = excluded.data, embedding = excluded.embedding",
+                self._memory_row(user_id, memory, embedding),
+            ),
+            self._meta_statement(user_id, last_updated, memory["id"] + 1),
+        ])
+
+    def delete_memory(self, user_id, memory_id, last_updated=None):
+        return bool(self.delete_memories(user_id, [memory_id], last_updated))
+
+    def delete_memories(self, user_id, memory_ids, last_updated=None):
+        user_id = str(user_id)
+        deleted = []
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                for memory_id in memory_ids:
+                    if self.conn.execute(
+                        "DELETE FROM memories WHERE user_id = ? AND memory_id = ?", (user_id, memory_id)
+                    ).rowcount:
+                        deleted.append(memory_id)
+                self.conn.execute(*self._meta_statement(user_id, last_updated))
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return deleted
+
+    def list_memory_user_ids(self):
+        return [row[0] for row in self._execute("SELECT user_id FROM memory_meta ORDER BY user_id")]
+
+    def archive_memories(self, user_id, memories, reason, archived_at=None):
+        user_id = str(user_id)
+        self._transaction([(
+            "INSERT INTO memory_archive (user_id, memory_id, reason, archived_at, data) VALUES (?, ?, ?, ?, ?)",
+            [(user_id, memory["id"], reason, archived_at, json.dumps(memory, ensure_ascii=False)) for memory in memories],
+        )])
+
+    def memory_version(self, user_id):
+        # data_version 只在其他连接提交修改后变化，本连接自己的写入不会让缓存失效
+        return self._execute("PRAGMA data_version")[0][0]
+
+    def append_turn(self, convo_id, message):
+        self._execute(
+            "INSERT INTO conversation_turns (convo_id, data) VALUES (?, ?)",
+            (str(convo_id), json.dumps(message, ensure_ascii=False)),
+        )
+
+    def load_turns(self, convo_id, limit=None):
+        if limit is None:
+            rows = self._execute(
+                "SELECT data FROM conversation_turns WHERE convo_id = ? ORDER BY id", (str(convo_id),)
+            )
+        else:
+            rows = self._execute(
+                "SELECT data FROM (SELECT id, data FROM conversation_turns WHERE convo_id = ? ORDER BY id DESC LIMIT ?) ORDER BY id",
+                (str(convo_id), limit),
+            )
+        return [json.loads(row[0]) for row in rows]
+
+    def clear_turns(self, convo_id):
+        self._execute("DELETE FROM conversation_turns WHERE convo_id = ?", (str(convo_id),))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+def create_storage(backend=STORAGE_BACKEND):
+    if backend == "sqlite":
+        return SQLiteStorage()
+    if backend == "json":
+        return JsonFileStorage()
+    raise ValueError(f"STORAGE_BACKEND must be json or sqlite, got {backend}")
+
+_storage = None
+
+def get_storage():
+    """返回全局共享的存储后端"""
+    global _storage
+    if _storage is None:
+        _storage = create_storage()
+    return _storage
+
+async def add_turn(robot, message, convo_id):
+    """把消息加入机器人的对话历史，更新对话摘要，并在线程池中持久化到存储后端
+
+    需要 await：同一个对话的消息按调用的顺序写入。
+    message 是 {"role", "content", ...} 字典，机器人只接收内容和角色，存储后端保存整条消息。
+    """
+    robot.add_to_conversation(message["content"], message["role"], convo_id)
+    conversation_tracker.record(convo_id, message)
+    try:
+        await run_memory_io(get_storage().append_turn, convo_id, message)
+    except Exception as e:
+        logging.error(f"保存对话消息失败 {convo_id}: {str(e)}")
+
+async def restore_conversation(robot, convo_id):
+    """重启后第一次用到对话时，从存储后端恢复最近的对话历史"""
+    if convo_id in robot.conversation:
+        return 0
+    try:
+        turns = await run_memory_io(get_storage().load_turns, convo_id, limit=CONVERSATION_RESTORE_TURNS)
+    except Exception as e:
+        logging.error(f"恢复对话历史失败 {convo_id}: {str(e)}")
+        return 0
+    if convo_id in robot.conversation:
+        # 读取期间对话已经被其他消息建立
+        return 0
+    conversation_tracker.reset(convo_id)
+    for message in turns:
+        robot.add_to_conversation(message["content"], message["role"], convo_id)
+        conversation_tracker.record(convo_id, message)
+    if turns:
+        logging.info(f"已恢复对话 {convo_id} 的 {len(turns)} 条历史消息")
+    return len(turns)
+
+async def clear_conversation(convo_id):
+    """清除对话摘要和保存的对话历史，写盘在线程池中进行，需要 await"""
+    conversation_tracker.reset(convo_id)
+    try:
+        await run_memory_io(get_storage().clear_turns, convo_id)
+    except Exception as e:
+        logging.error(f"清除保存的对话历史失败 {convo_id}: {str(e)}")
+
+def migrate(source, target):
+    """把 source 中的用户配置和记忆全部导入 target，返回 (配置数, 记忆文件数)"""
+    config_count = 0
+    for user_id in source.list_user_ids():
+        config = source.load_user_config(user_id)
+        if config:
+            target.save_user_config(user_id, config)
+            config_count += 1
+
+    memory_count = 0
+    for user_id in source.list_memory_user_ids():
+        try:
+            data = source.load_memories(user_id)
+        except Exception as e:
+            logging.error(f"读取记忆失败 {user_id}: {str(e)}")
+            continue
+        target.save_memories(user_id, data)
+        memory_count += 1
+    return config_count, memory_count
+
+if __name__ == "__main__":
+    # 用法：python -m utils.storage [数据库路径]
+    # 把 CONFIG_DIR 下的用户配置和 memories/memory_*.json 导入 SQLite 数据库
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    path = sys.argv[1] if len(sys.argv) > 1 else STORAGE_PATH
+    target = SQLiteStorage(path)
+    config_count, memory_count = migrate(JsonFileStorage(), target)
+    target.close()
+    print(f"已导入 {config_count} 个用户配置和 {memory_count} 个用户的记忆到 {path}")
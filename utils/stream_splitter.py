@@ -0,0 +1,124 @@
+FENCE = "```"
+
+# 找不到换行时，优先在这些标点之后截断
+SENTENCE_ENDINGS = "。！？；!?;."
+
+class StreamSplitter:
+    """把流式输出的长回复切分成 Telegram 能发送的多页
+
+    feed() 每次只扫描新增的完整行，增量维护代码块状态以及可以截断的位置，
+    当前页超过 limit 时立即返回已经完成的页，其余内容留在 pending 中继续累积。
+    截断优先级：代码块外的空行 > 代码块外的换行 > 代码块内的换行 > 句末标点 > 硬截断。
+    在代码块内截断时，当前页补上结束围栏，下一页重新打开同样的代码块。
+
+    参数：
+        limit: 每页最多的字符数（在代码块内截断时补上的结束围栏不计入）
+    """
+
+    def __init__(self, limit=3500):
+        self.limit = limit
+        self.pages = 0
+        self._buffer = ""
+        self._reset_scan()
+
+    def _reset_scan(self):
+        self._scan_pos = 0
+        # 当前代码块的围栏（例如 ``` 或 ````）和开头那一行（例如 ```python）
+        self._fence = None
+        self._fence_header = None
+        # 各类截断位置：(位置, 该位置的围栏, 该位置的代码块开头)
+        self._paragraph_cut = None
+        self._line_cut = None
+        self._fence_cut = None
+
+    @property
+    def pending(self):
+        """当前还没有完成的一页"""
+        return self._buffer
+
+    def _scan_line(self, line_start, line_end):
+        line = self._buffer[line_start:line_end]
+        stripped = line.strip()
+        if stripped.startswith(FENCE):
+            marker = stripped[:len(stripped) - len(stripped.lstrip("`"))]
+            if self._fence is None:
+                self._fence = marker
+                self._fence_header = stripped
+            elif stripped == marker and len(marker) >= len(self._fence):
+                # 只有不短于开头围栏、且不带语言标记的围栏才能关闭代码块，嵌套的 ``` 不算
+                self._fence = None
+                self._fence_header = None
+        elif not stripped and self._fence is None and line_start > 0:
+            self._paragraph_cut = line_start
+
+        next_line = line_end + 1
+        if self._fence is None:
+            self._line_cut = next_line
+        else:
+            self._fence_cut = (next_line, self._fence, self._fence_header)
+
+    def _choose_cut(self):
+        """返回 (截断位置, 需要关闭的围栏, 需要重新打开的代码块开头)"""
+        half = self.limit // 2
+        fence_cut = self._fence_cut
+        if fence_cut and fence_cut[0] <= len(fence_cut[2]) + 1:
+            # 只截掉代码块开头那一行没有意义，下一页还会把它加回来
+            fence_cut = None
+        for cut in (self._paragraph_cut, self._line_cut):
+            if cut and cut >= half:
+                return cut, None, None
+        if fence_cut and fence_cut[0] >= half:
+            return fence_cut
+        for cut in (self._paragraph_cut, self._line_cut):
+            if cut:
+                return cut, None, None
+        if fence_cut:
+            return fence_cut
+
+        # 没有换行（例如很长的中文段落），在句末标点处截断，找不到就硬截断
+        window = self._buffer[self._scan_pos:self.limit]
+        cut = max(window.rfind(mark) for mark in SENTENCE_ENDINGS)
+        cut = self._scan_pos + cut + 1 if cut >= 0 else self.limit
+        if self._fence and cut <= len(self._fence_header) + 1:
+            cut = self.limit
+        return cut, self._fence, self._fence_header
+
+    def _cut_page(self):
+        cut, fence, header = self._choose_cut()
+        page = self._buffer[:cut]
+        rest = self._buffer[cut:]
+        if fence:
+            page = page.rstrip("\n") + "\n" + fence
+            rest = header + "\n" + rest
+        else:
+            page = page.rstrip()
+            rest = rest.lstrip("\n")
+        self._buffer = rest
+        self._reset_scan()
+        self.pages += 1
+        return page
+
+    def feed(self, chunk):
+        """追加一段输出，返回已经完成的页（可能为空列表）"""
+        self._buffer += chunk
+        pages = []
+        while True:
+            while True:
+                line_end = self._buffer.find("\n", self._scan_pos)
+                if line_end == -1 or line_end >= self.limit:
+                    break
+                self._scan_line(self._scan_pos, line_end)
+                self._scan_pos = line_end + 1
+            if len(self._buffer) <= self.limit:
+                break
+            page = self._cut_page()
+            if page.strip():
+                pages.append(page)
+        return pages
+
+    def finish(self):
+        """输出结束，返回最后一页"""
+        page = self._buffer
+        self._buffer = ""
+        self._reset_scan()
+        return page